@@ -0,0 +1,165 @@
+"""
+准入控制
+后台任务持续采样事件循环延迟和进程 CPU，结合活动通话数与排队中的外呼数判断当前容量。
+超出阈值时新外呼进入有界队列等待，队列满或等待超时则拒绝；来电直接返回忙音提示，
+已有通话的音频质量不受影响。
+排空模式（滚动发布）下不再接受任何新通话，已有通话照常进行。
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_ACTIVE_CALLS = int(os.getenv("MAX_ACTIVE_CALLS", "50"))
+MAX_LOOP_LAG_MS = float(os.getenv("MAX_LOOP_LAG_MS", "50"))
+MAX_CPU_PERCENT = float(os.getenv("MAX_CPU_PERCENT", "85"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "20"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# 外呼从拨出到媒体流建立之间占用名额的最长时间（秒）
+ADMISSION_RESERVATION_TTL = float(os.getenv("ADMISSION_RESERVATION_TTL", "60"))
+
+# 采样间隔（秒）
+LAG_SAMPLE_INTERVAL = 0.1
+CPU_SAMPLE_INTERVAL = 1.0
+# 事件循环延迟取最近一段时间的峰值，避免瞬时抖动被平均掉
+LAG_WINDOW = 20
+
+
+class AdmissionController:
+    """
+    根据实时负载决定是否接受新通话
+
+    active_calls: 返回当前活动通话数的回调（通常是 len(active_sessions)）
+    """
+
+    def __init__(self, active_calls: Callable[[], int], max_calls: int = MAX_ACTIVE_CALLS,
+                 max_loop_lag_ms: float = MAX_LOOP_LAG_MS, max_cpu_percent: float = MAX_CPU_PERCENT,
+                 queue_size: int = ADMISSION_QUEUE_SIZE, reservation_ttl: float = ADMISSION_RESERVATION_TTL):
+        self.active_calls = active_calls
+        self.max_calls = max_calls
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.max_cpu_percent = max_cpu_percent
+        self.queue_size = queue_size
+        self.reservation_ttl = reservation_ttl
+
+        self.reservations: Dict[str, float] = {}  # key → 过期时间
+        self.queued = 0
+        self.loop_lag_ms = 0.0
+        self.cpu_percent = 0.0
+        self.rejected = 0
+        self.draining = False
+        self._lag_samples = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _monitor(self):
+        """定时睡眠并测量实际唤醒时间的偏差作为事件循环延迟"""
+        cpu_started, cpu_time = time.monotonic(), time.process_time()
+        while True:
+            expected = time.monotonic() + LAG_SAMPLE_INTERVAL
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            now = time.monotonic()
+            self._lag_samples.append(max(0.0, now - expected) * 1000)
+            if len(self._lag_samples) > LAG_WINDOW:
+                self._lag_samples.pop(0)
+            self.loop_lag_ms = max(self._lag_samples)
+
+            if now - cpu_started >= CPU_SAMPLE_INTERVAL:
+                process_time = time.process_time()
+                self.cpu_percent = (process_time - cpu_time) / (now - cpu_started) * 100
+                cpu_started, cpu_time = now, process_time
+
+    def _expire_reservations(self):
+        now = time.monotonic()
+        for key in [key for key, expires in self.reservations.items() if expires < now]:
+            del self.reservations[key]
+
+    @property
+    def load(self) -> int:
+        """活动通话 + 已拨出但尚未建立媒体流的通话"""
+        self._expire_reservations()
+        return self.active_calls() + len(self.reservations)
+
+    def overload_reason(self) -> Optional[str]:
+        """返回超出的阈值，未超出时返回 None"""
+        if self.draining:
+            return "draining"
+        if self.load >= self.max_calls:
+            return "max_calls"
+        if self.loop_lag_ms > self.max_loop_lag_ms:
+            return "loop_lag"
+        if self.cpu_percent > self.max_cpu_percent:
+            return "cpu"
+        return None
+
+    def try_reserve(self, key: str) -> bool:
+        """容量足够时立即占用一个名额；检查和占用之间没有 await，不会超发"""
+        if key in self.reservations:
+            return True
+        if self.overload_reason():
+            return False
+        self.reservations[key] = time.monotonic() + self.reservation_ttl
+        return True
+
+    async def acquire(self, key: str, timeout: float = ADMISSION_QUEUE_TIMEOUT) -> bool:
+        """占用名额，过载时排队等待；队列已满、等待超时或正在排空时返回 False"""
+        if not self.queued and self.try_reserve(key):
+            return True
+        if self.draining or self.queued >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        self.queued += 1
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+                if self.draining:
+                    break
+                if self.try_reserve(key):
+                    return True
+        finally:
+            self.queued -= 1
+        self.rejected += 1
+        return False
+
+    def rebind(self, key: str, new_key: str):
+        """把名额转到新的键上（例如拿到 CallSid 之后）"""
+        expires = self.reservations.pop(key, None)
+        if expires is not None:
+            self.reservations[new_key] = expires
+
+    def release(self, key: str):
+        self.reservations.pop(key, None)
+
+    def capacity(self) -> dict:
+        reason = self.overload_reason()
+        return {
+            "accepting": reason is None,
+            "reason": reason,
+            "draining": self.draining,
+            "active_calls": self.active_calls(),
+            "reserved_calls": len(self.reservations),
+            "max_calls": self.max_calls,
+            "available": max(0, self.max_calls - self.load),
+            "queued_dials": self.queued,
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+            "cpu_percent": round(self.cpu_percent, 1),
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,408 @@
+"""
+外呼答录机检测（AMD）
+外呼接通后先不连接 OpenAI，只在前几秒的 8kHz μ-law 来电音频上用几个廉价特征判断对方是真人还是语音信箱：
+- 真人接听通常只说一句很短的"喂？"，然后安静等待对方开口
+- 语音信箱的问候语长且连续，停顿短而多，结尾往往有一声单频"嘀"
+- 提示音：能量稳定、过零率恒定的单频音持续 BEEP_FRAMES 帧以上
+
+判定为真人（或无法判断）才建立 OpenAI 会话；判定为答录机时按 AMD_ACTION 等问候语结束（提示音或长静音）
+后播放一段缓存好的留言再挂断（默认），或直接挂断，不为和机器对话付费。
+一口气说了两秒多的真人和语音信箱很像，判为答录机需要留出余量：有提示音、分成多段，或连续语音明显更长；
+拿不准时按无法判断处理，宁可多接通一通答录机，也不挂断真人。
+可以同时启用 Twilio 的异步 machine_detection（AMD_TWILIO=true），本地尚未判定时采用 Twilio 的结果。
+"""
+
+import os
+import time
+import asyncio
+import audioop
+import logging
+from typing import Optional
+
+from audio_assets import AssetPlayback, MemoryAsset
+from turn_detector import LOCAL_VAD_MIN_RMS, LOCAL_VAD_RATIO_DB
+
+logger = logging.getLogger(__name__)
+
+AMD_ENABLED = os.getenv("AMD_ENABLED", "false").lower() == "true"
+AMD_ACTION = os.getenv("AMD_ACTION", "message")  # message / hangup；误判的真人听到留言总比被直接挂断好
+# 留言文本：用本通电话的指令和语音从问候缓存读取，未命中时在后台合成供之后使用
+AMD_MESSAGE = os.getenv("AMD_MESSAGE", "")
+# 留言素材：没有留言文本或缓存未命中时使用
+AMD_MESSAGE_ASSET = os.getenv("AMD_MESSAGE_ASSET", "voicemail")
+AMD_TWILIO = os.getenv("AMD_TWILIO", "false").lower() == "true"
+AMD_TIMEOUT_MS = float(os.getenv("AMD_TIMEOUT_MS", "4000"))
+
+# 短于此值的停顿不切分语音段（音节之间）
+SEGMENT_GAP_MS = 250
+# 真人问候语的最长语音时长
+HUMAN_MAX_GREETING_MS = 1800
+# 短问候之后静音这么久判定为真人
+HUMAN_SILENCE_MS = 700
+# 稍长的问候之后静音这么久也判定为真人（语音信箱很少在问候中途停这么久）
+LONG_SILENCE_MS = 1500
+# 累计语音超过此值判定为答录机（还需满足下面的余量）
+MACHINE_GREETING_MS = 2000
+# 余量：语音至少分成这么多段，或者连续语音达到 MACHINE_CONFIDENT_MS
+MACHINE_CONFIDENT_SEGMENTS = 2
+MACHINE_CONFIDENT_MS = 3500
+# 语音段数达到此值且中间没有像样的停顿，判定为答录机
+MACHINE_SEGMENTS = 4
+# 接通后一直没人说话，无法判断
+NO_SPEECH_MS = 2500
+# 提示音：过零率对应 400 ~ 2500 Hz，相邻帧过零数相差不超过 1，持续 160ms
+BEEP_MIN_CROSSINGS = 16
+BEEP_MAX_CROSSINGS = 100
+BEEP_FRAMES = 8
+# 判定为答录机后，问候语结束的静音时长（没有提示音时）
+MESSAGE_SILENCE_MS = 1500
+# 判定为答录机后最多等待问候语结束的时间（秒）
+MESSAGE_WAIT = 20.0
+# 留言播完后等 Twilio 端缓冲播放完的时间（秒），与素材播放的预缓冲时长一致
+PLAYOUT_TAIL = 0.2
+# Twilio AnsweredBy 中表示答录机的取值
+TWILIO_MACHINE_RESULTS = ("machine_start", "machine_end_beep", "machine_end_silence", "machine_end_other", "fax")
+
+
+class AnsweringMachineDetector:
+    """
+    单通电话的答录机检测状态机，只做计算不做 I/O
+    process() 每收到一帧来电音频调用一次，返回：
+        "human"          判定为真人
+        "machine"        判定为答录机
+        "unknown"        无法判断（一直没人说话、超时），按真人处理
+        "message_ready"  判定为答录机后，问候语已结束（提示音或长静音），可以开始留言
+        None             无变化
+    """
+
+    def __init__(self, timeout_ms: float = AMD_TIMEOUT_MS, ratio_db: float = LOCAL_VAD_RATIO_DB,
+                 min_rms: int = LOCAL_VAD_MIN_RMS):
+        self.timeout_ms = timeout_ms
+        self.ratio = 10 ** (ratio_db / 20)
+        self.min_rms = min_rms
+        self.noise_floor = float(min_rms) / self.ratio
+
+        self.time_ms = 0.0
+        self.speech_ms = 0.0
+        self.segments = 0
+        self.silence_run_ms = 0.0
+        self.in_segment = False
+        self.tone_frames = 0
+        self.last_crossings = -1
+        self.beeped = False
+
+        self.decision: Optional[str] = None
+        self.reason: Optional[str] = None
+        self.decided_at_ms: Optional[float] = None
+        self.message_ready = False
+
+    def process(self, mulaw: bytes) -> Optional[str]:
+        if self.message_ready:
+            return None
+        frame_ms = len(mulaw) / 8
+        self.time_ms += frame_ms
+        pcm = audioop.ulaw2lin(mulaw, 2)
+        rms = audioop.rms(pcm, 2)
+        voiced = rms >= max(self.min_rms, self.noise_floor * self.ratio)
+
+        if voiced and self._tone(pcm):
+            self.tone_frames += 1
+            if self.tone_frames == BEEP_FRAMES:
+                self.beeped = True
+                if self.decision is None:
+                    return self._decide("machine", "beep")
+            return None
+        if self.tone_frames >= BEEP_FRAMES and self.decision == "machine":
+            # 提示音结束，开始录音
+            return self._ready("beep")
+        self.tone_frames = 0
+
+        if voiced:
+            self.speech_ms += frame_ms
+            if not self.in_segment:
+                self.in_segment = True
+                self.segments += 1
+            self.silence_run_ms = 0.0
+        else:
+            if rms < self.noise_floor:
+                self.noise_floor = self.noise_floor * 0.9 + rms * 0.1
+            else:
+                self.noise_floor = self.noise_floor * 0.995 + rms * 0.005
+            self.silence_run_ms += frame_ms
+            if self.silence_run_ms >= SEGMENT_GAP_MS:
+                self.in_segment = False
+
+        if self.decision is None:
+            return self._classify()
+        if self.decision == "machine" and self.silence_run_ms >= MESSAGE_SILENCE_MS:
+            return self._ready("silence")
+        return None
+
+    def _tone(self, pcm: bytes) -> bool:
+        """单频音：过零数落在提示音频段内，且与上一帧几乎相同"""
+        crossings = audioop.cross(pcm, 2)
+        steady = abs(crossings - self.last_crossings) <= 1
+        self.last_crossings = crossings
+        return BEEP_MIN_CROSSINGS <= crossings <= BEEP_MAX_CROSSINGS and steady
+
+    def _classify(self) -> Optional[str]:
+        confident = self.segments >= MACHINE_CONFIDENT_SEGMENTS or self.speech_ms >= MACHINE_CONFIDENT_MS
+        if self.speech_ms >= MACHINE_GREETING_MS and confident:
+            return self._decide("machine", "long_greeting")
+        if self.segments >= MACHINE_SEGMENTS and self.silence_run_ms < HUMAN_SILENCE_MS:
+            return self._decide("machine", "cadence")
+        if self.speech_ms > 0:
+            if self.speech_ms <= HUMAN_MAX_GREETING_MS and self.silence_run_ms >= HUMAN_SILENCE_MS:
+                return self._decide("human", "short_greeting")
+            if self.silence_run_ms >= LONG_SILENCE_MS:
+                return self._decide("human", "greeting_then_silence")
+        elif self.time_ms >= NO_SPEECH_MS:
+            return self._decide("unknown", "silence")
+        if self.time_ms >= self.timeout_ms:
+            if self.speech_ms > HUMAN_MAX_GREETING_MS and confident:
+                return self._decide("machine", "timeout")
+            return self._decide("unknown", "timeout")
+        return None
+
+    def _decide(self, decision: str, reason: str) -> str:
+        self.decision = decision
+        self.reason = reason
+        self.decided_at_ms = self.time_ms
+        return decision
+
+    def _ready(self, reason: str) -> str:
+        self.message_ready = True
+        self.reason = f"{self.reason}+{reason}"
+        return "message_ready"
+
+    def on_twilio_result(self, answered_by: str) -> Optional[str]:
+        """合入 Twilio 异步 AMD 的 AnsweredBy；本地已判定时只补充留言时机"""
+        if answered_by in TWILIO_MACHINE_RESULTS:
+            if self.decision is None:
+                return self._decide("machine", f"twilio:{answered_by}")
+            if self.decision == "machine" and answered_by.startswith("machine_end") and not self.message_ready:
+                return self._ready(f"twilio:{answered_by}")
+        elif answered_by == "human" and self.decision is None:
+            return self._decide("human", "twilio:human")
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "decision": self.decision,
+            "reason": self.reason,
+            "decided_at_ms": round(self.decided_at_ms) if self.decided_at_ms is not None else None,
+            "speech_ms": round(self.speech_ms),
+            "segments": self.segments,
+            "beep": self.beeped,
+        }
+
+
+class CallScreener:
+    """
+    单通电话的答录机筛选：CallBridge 在连接 OpenAI 之前调用 screen()
+    检测期间来电音频照常进入 pending_audio 缓冲；判定为真人后由 CallBridge 连接 OpenAI 并补发
+    """
+
+    def __init__(self, bridge, detector: Optional[AnsweringMachineDetector] = None, action: str = AMD_ACTION,
+                 message: str = AMD_MESSAGE, message_asset: str = AMD_MESSAGE_ASSET):
+        self.bridge = bridge
+        self.detector = detector or AnsweringMachineDetector()
+        self.action = action
+        self.message = message
+        self.message_asset = message_asset
+        self.decided = asyncio.Event()
+        self.message_ready = asyncio.Event()
+        self.started: Optional[float] = None
+
+    def process(self, mulaw: bytes):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.on_result(self.detector.process(mulaw))
+
+    def on_twilio_result(self, answered_by: str):
+        logger.info(f"[{self.bridge.call_sid}] 📠 Twilio AMD 结果: {answered_by}（本地: {self.detector.decision}）")
+        self.on_result(self.detector.on_twilio_result(answered_by))
+
+    def on_result(self, result: Optional[str]):
+        if result == "message_ready":
+            self.message_ready.set()
+        elif result:
+            self.decided.set()
+
+    async def screen(self, twilio_forwarder: asyncio.Task) -> bool:
+        """等待检测结果；返回 True 表示应连接 OpenAI 继续通话"""
+        bridge = self.bridge
+        session = bridge.session
+        decided = asyncio.create_task(self.decided.wait())
+        # 按墙钟再留一秒余量，防止来电音频中断时一直等下去
+        await asyncio.wait({decided, twilio_forwarder}, timeout=self.detector.timeout_ms / 1000 + 1,
+                           return_when=asyncio.FIRST_COMPLETED)
+        decided.cancel()
+        if twilio_forwarder.done():
+            return False
+
+        detector = self.detector
+        if detector.decision is None:
+            detector._decide("unknown", "no_audio")
+        stats = detector.stats()
+        logger.info(f"[{bridge.call_sid}] 📠 答录机检测: {detector.decision}（{detector.reason}，"
+                    f"{stats['decided_at_ms']} ms）")
+        if bridge.services.transcript_store:
+            bridge.services.transcript_store.record(bridge.call_sid, "amd", detector.decision,
+                                                    latency_ms=stats["decided_at_ms"], **stats)
+
+        if detector.decision != "machine":
+            if session.get("greeting"):
+                # 问候语会回应对方的"喂"，检测期间的音频不再发给模型，避免模型再回一遍
+                session["pending_audio"].clear()
+            return True
+
+        if self.action == "message":
+            await self.leave_message()
+        session["closing"] = True
+        twilio_forwarder.cancel()
+        await bridge.transport.close()
+        logger.info(f"[{bridge.call_sid}] 📠 答录机接听，已挂断，未建立 OpenAI 会话")
+        return False
+
+    def message_playback(self) -> Optional[AssetPlayback]:
+        """优先使用按本通电话语音合成的留言，其次使用素材库中的通用留言"""
+        services = self.bridge.services
+        if self.message and services.greeting_cache:
+            audio = services.greeting_cache.get(self.bridge.speech_key(self.message))
+            if audio is not None:
+                return AssetPlayback(MemoryAsset(self.message, audio))
+            self.bridge.render_speech(self.message)
+        if services.audio_assets:
+            return services.audio_assets.playback(self.message_asset)
+        return None
+
+    async def leave_message(self):
+        bridge = self.bridge
+        playback = self.message_playback()
+        if not playback:
+            logger.warning(f"[{bridge.call_sid}] ⚠️ 没有可用的留言音频，直接挂断")
+            return
+        try:
+            await asyncio.wait_for(self.message_ready.wait(), timeout=MESSAGE_WAIT)
+        except asyncio.TimeoutError:
+            logger.warning(f"[{bridge.call_sid}] ⚠️ 等待语音信箱问候语结束超时，直接挂断")
+            return
+        logger.info(f"[{bridge.call_sid}] 📠 语音信箱问候语结束（{self.detector.reason}），开始留言")
+        bridge.start_playback(playback)
+        while bridge.session.get("asset_playback") is playback:
+            await asyncio.sleep(0.05)
+        # 等 Twilio 端缓冲的最后一段播完
+        await asyncio.sleep(PLAYOUT_TAIL)
+
+
+if __name__ == "__main__":
+    # 在带标注的语料上测量准确率和判定延迟
+    # 语料目录结构：<目录>/human/*.wav、<目录>/machine/*.wav（CallRecorder 录音取来电方声道，或单声道 μ-law WAV）
+    # 不指定目录时使用合成语料：真人（短问候、长问候、一长串、不出声）和语音信箱（有/无提示音）
+    import sys
+    import glob
+    import math
+    import random
+    import statistics
+
+    from audio_assets import FRAME_BYTES, iter_frames
+
+    def read_caller_audio(path: str) -> bytes:
+        with open(path, "rb") as f:
+            data = f.read()
+        start = data.find(b"data") + 8
+        channels = int.from_bytes(data[22:24], "little")
+        audio = data[start:]
+        return audio[0::2] if channels == 2 else audio
+
+    def synth(rng: random.Random, kind: str) -> bytes:
+        samples = []
+
+        def silence(ms):
+            samples.extend(rng.gauss(0, 60) for _ in range(int(ms * 8)))
+
+        def speech(ms):
+            end = len(samples) + int(ms * 8)
+            while len(samples) < end:
+                length = int(rng.uniform(150, 250) * 8)
+                amplitude = rng.uniform(2500, 6000)
+                samples.extend(amplitude * math.sin(math.pi * i / length) * rng.gauss(0, 1) for i in range(length))
+
+        def beep(ms):
+            samples.extend(8000 * math.sin(2 * math.pi * 1000 * i / 8000) for i in range(int(ms * 8)))
+
+        silence(rng.uniform(100, 800))
+        if kind == "human_short":
+            speech(rng.uniform(300, 1200))
+            silence(rng.uniform(2000, 3000))
+            speech(rng.uniform(300, 800))
+        elif kind == "human_long":
+            speech(rng.uniform(1300, 1800))
+            silence(rng.uniform(2000, 3000))
+        elif kind == "human_chatty":
+            # 一接起来就说一长串的真人，容易被误判为答录机
+            speech(rng.uniform(1800, 3000))
+            silence(rng.uniform(2000, 3000))
+        elif kind == "human_silent":
+            silence(rng.uniform(3000, 4000))
+            speech(rng.uniform(300, 800))
+        else:
+            for _ in range(rng.randint(4, 9)):
+                speech(rng.uniform(500, 1200))
+                silence(rng.uniform(150, 450))
+            if kind == "machine_beep":
+                silence(rng.uniform(200, 600))
+                beep(rng.uniform(300, 700))
+            silence(3000)
+        silence(2000)
+        pcm = b"".join(int(max(-32767, min(32767, s))).to_bytes(2, "little", signed=True) for s in samples)
+        return audioop.lin2ulaw(pcm, 2)
+
+    if len(sys.argv) > 1:
+        corpus = [(label, os.path.basename(path), read_caller_audio(path))
+                  for label in ("human", "machine")
+                  for path in sorted(glob.glob(os.path.join(sys.argv[1], label, "*.wav")))]
+    else:
+        rng = random.Random(11)
+        corpus = [(kind.split("_")[0], kind, synth(rng, kind))
+                  for kind in ("human_short", "human_long", "human_chatty", "human_silent",
+                                "machine_beep", "machine_nobeep")
+                  for _ in range(40)]
+    if not corpus:
+        print(f"❌ 语料为空：{sys.argv[1]} 下没有 human/*.wav 或 machine/*.wav")
+        sys.exit(1)
+
+    results = {}
+    for label, name, audio in corpus:
+        detector = AnsweringMachineDetector()
+        ready_ms = None
+        for frame in iter_frames(audio, FRAME_BYTES):
+            if detector.process(bytes(frame)) == "message_ready":
+                ready_ms = detector.time_ms
+                break
+        decision = detector.decision or "unknown"
+        results.setdefault(label, []).append((decision, detector.decided_at_ms, ready_ms, detector.reason))
+
+    print(f"语料 {len(corpus)} 条{'（合成）' if len(sys.argv) <= 1 else ''}")
+    print(f"{'标注':<8} {'条数':>4} {'真人':>5} {'无法判断':>8} {'答录机':>6} {'判定延迟 p50/p90 ms':>20}")
+    correct = 0
+    for label, rows in results.items():
+        counts = {decision: sum(1 for row in rows if row[0] == decision) for decision in ("human", "unknown", "machine")}
+        latencies = sorted(row[1] for row in rows if row[1] is not None)
+        p50 = statistics.median(latencies) if latencies else 0
+        p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))] if latencies else 0
+        print(f"{label:<8} {len(rows):>4} {counts['human']:>5} {counts['unknown']:>8} {counts['machine']:>6} "
+              f"{p50:>10.0f} / {p90:<8.0f}")
+        # 真人判为真人或无法判断都会正常接通；答录机必须判为答录机
+        correct += counts["machine"] if label == "machine" else counts["human"] + counts["unknown"]
+    print(f"准确率（接通/挂断是否正确）: {correct / len(corpus):.1%}")
+    machines = results.get("machine", [])
+    ready = [row[2] for row in machines if row[2] is not None]
+    if ready:
+        print(f"答录机可留言时刻: 均值 {statistics.mean(ready):.0f} ms，{len(ready)}/{len(machines)} 条检测到问候语结束")
+    reasons = {}
+    for rows in results.values():
+        for row in rows:
+            reasons[row[3]] = reasons.get(row[3], 0) + 1
+    print(f"判定依据: {reasons}")
@@ -0,0 +1,63 @@
+"""
+原生 ASGI 媒体流入口
+Twilio 的 /media-stream WebSocket 直接在 ASGI 层处理，不经过框架的路由、中间件和 WebSocket 封装；
+其余请求原样交给 FastAPI / Quart 应用。
+"""
+
+import logging
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+
+class ASGIWebSocketTransport:
+    """基于 ASGI receive / send 的 CallBridge 传输适配器"""
+
+    def __init__(self, receive, send):
+        self._receive = receive
+        self._send = send
+        self.closed = False
+
+    async def receive_text(self):
+        while not self.closed:
+            message = await self._receive()
+            if message["type"] == "websocket.receive":
+                text = message.get("text")
+                return text if text is not None else message["bytes"].decode("utf-8")
+            if message["type"] == "websocket.disconnect":
+                self.closed = True
+        return None
+
+    async def send_text(self, text: str):
+        if not self.closed:
+            await self._send({"type": "websocket.send", "text": text})
+
+    async def close(self, code: int = 1000):
+        if not self.closed:
+            self.closed = True
+            await self._send({"type": "websocket.close", "code": code})
+
+
+def media_stream_fast_path(app, handler, path: str = "/media-stream"):
+    """
+    包装 ASGI 应用：path 上的 WebSocket 直接交给 handler(transport, params)，其余请求交给 app
+    """
+
+    async def asgi_app(scope, receive, send):
+        if scope["type"] != "websocket" or scope["path"] != path:
+            await app(scope, receive, send)
+            return
+
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        await send({"type": "websocket.accept"})
+
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        transport = ASGIWebSocketTransport(receive, send)
+        try:
+            await handler(transport, params)
+        finally:
+            await transport.close()
+
+    return asgi_app
@@ -0,0 +1,222 @@
+"""
+预编码音频素材库
+保持音乐、垫话、固定的合规声明等预先编码为 8kHz μ-law 的文件，
+启动时一次性 mmap，按 20ms 切片成 Twilio media 帧。
+所有通话共享同一份映射，每通电话只保存播放位置，内存占用与并发数无关。
+"""
+
+import os
+import mmap
+import base64
+import struct
+import audioop
+import logging
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+AUDIO_ASSETS_DIR = os.getenv("AUDIO_ASSETS_DIR", "assets/audio")
+
+# Twilio 媒体帧：8kHz μ-law，每 20ms 160 字节
+FRAME_BYTES = 160
+FRAME_SECONDS = 0.02
+
+# WAV 格式码：7 = μ-law
+WAVE_FORMAT_MULAW = 7
+
+
+def iter_frames(audio, frame_bytes: int = FRAME_BYTES) -> Iterator[memoryview]:
+    """按 20ms 切分 μ-law 音频，返回 memoryview 切片，不产生拷贝"""
+    view = memoryview(audio)
+    for offset in range(0, len(view), frame_bytes):
+        yield view[offset:offset + frame_bytes]
+
+
+def media_message(stream_sid: str, frame) -> dict:
+    """构造发送给 Twilio 的 media 消息"""
+    return {
+        "event": "media",
+        "streamSid": stream_sid,
+        "media": {
+            "payload": base64.b64encode(frame).decode("utf-8")
+        }
+    }
+
+
+def mix_mulaw(speech: bytes, background, background_gain: float = 0.3) -> bytes:
+    """把背景音（按增益衰减）混入语音，两路都是 μ-law 8kHz"""
+    length = min(len(speech), len(background))
+    speech_pcm = audioop.ulaw2lin(speech[:length], 2)
+    background_pcm = audioop.mul(audioop.ulaw2lin(bytes(background[:length]), 2), 2, background_gain)
+    mixed = audioop.lin2ulaw(audioop.add(speech_pcm, background_pcm, 2), 2)
+    return mixed + speech[length:]
+
+
+def _wav_data_range(mm: mmap.mmap, path: str):
+    """解析 μ-law WAV 文件头，返回 data 块的 (偏移, 长度)"""
+    if mm[:4] != b"RIFF" or mm[8:12] != b"WAVE":
+        raise ValueError(f"{path}: not a RIFF/WAVE file")
+
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(mm):
+        chunk_id = mm[offset:offset + 4]
+        chunk_size = struct.unpack("<I", mm[offset + 4:offset + 8])[0]
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHI", mm[body:body + 8])
+        elif chunk_id == b"data":
+            if fmt is None or fmt != (WAVE_FORMAT_MULAW, 1, 8000):
+                raise ValueError(f"{path}: expected mono 8kHz μ-law, got {fmt}")
+            return body, min(chunk_size, len(mm) - body)
+        offset = body + chunk_size + (chunk_size & 1)
+    raise ValueError(f"{path}: missing data chunk")
+
+
+class AudioAsset:
+    """一段已映射到内存的 μ-law 音频"""
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if path.endswith(".wav"):
+            start, length = _wav_data_range(self._mmap, path)
+        else:
+            start, length = 0, len(self._mmap)
+        # 对齐到整帧，避免循环播放时出现半帧
+        length -= length % FRAME_BYTES
+        self.audio = memoryview(self._mmap)[start:start + length]
+
+    @property
+    def duration(self) -> float:
+        return len(self.audio) / 8000
+
+    def frames(self) -> Iterator[memoryview]:
+        return iter_frames(self.audio)
+
+
+class MemoryAsset:
+    """内存或 mmap 中的一段 μ-law 音频（如问候缓存中合成好的垫话），可与文件素材一样播放"""
+
+    def __init__(self, name: str, audio):
+        self.name = name
+        view = memoryview(audio)
+        self.audio = view[:len(view) - len(view) % FRAME_BYTES]
+
+    @property
+    def duration(self) -> float:
+        return len(self.audio) / 8000
+
+    def frames(self) -> Iterator[memoryview]:
+        return iter_frames(self.audio)
+
+
+class AssetPlayback:
+    """
+    单通电话的素材播放状态，只记录位置，不复制音频
+
+    mode:
+        interleave - 模型音频到来时立即停止素材（垫话、合规声明）
+        mix        - 模型说话时素材作为背景音混入（保持音乐）
+    """
+
+    def __init__(self, asset: AudioAsset, loop: bool = False, mode: str = "interleave",
+                 background_gain: float = 0.3):
+        self.asset = asset
+        self.loop = loop
+        self.mode = mode
+        self.background_gain = background_gain
+        self.position = 0
+
+    @property
+    def finished(self) -> bool:
+        return not self.loop and self.position >= len(self.asset.audio)
+
+    def next_frame(self) -> Optional[memoryview]:
+        audio = self.asset.audio
+        if self.position >= len(audio):
+            if not self.loop or not audio:
+                return None
+            self.position = 0
+        frame = audio[self.position:self.position + FRAME_BYTES]
+        self.position += FRAME_BYTES
+        return frame
+
+    def mix_into(self, speech: bytes) -> bytes:
+        """取出与语音等长的素材混入语音中"""
+        background = bytearray()
+        while len(background) < len(speech):
+            frame = self.next_frame()
+            if frame is None:
+                break
+            background += frame
+        if not background:
+            return speech
+        return mix_mulaw(speech, background, self.background_gain)
+
+
+class AudioAssetLibrary:
+    """
+    进程级共享的素材库
+    目录中的 *.ulaw（裸 μ-law）和 *.wav（μ-law WAV）按文件名（不含扩展名）注册
+    """
+
+    def __init__(self, directory: str = AUDIO_ASSETS_DIR):
+        self.directory = directory
+        self.assets: Dict[str, AudioAsset] = {}
+        self.reload()
+
+    def reload(self):
+        assets = {}
+        if os.path.isdir(self.directory):
+            for filename in sorted(os.listdir(self.directory)):
+                name, ext = os.path.splitext(filename)
+                if ext not in (".ulaw", ".wav"):
+                    continue
+                try:
+                    assets[name] = AudioAsset(name, os.path.join(self.directory, filename))
+                except (OSError, ValueError) as e:
+                    logger.error(f"❌ 加载音频素材失败 {filename}: {e}")
+        self.assets = assets
+        if assets:
+            total = sum(len(asset.audio) for asset in assets.values())
+            logger.info(f"🎵 已加载 {len(assets)} 个音频素材 ({total / 8000:.1f} 秒)")
+
+    def get(self, name: str) -> Optional[AudioAsset]:
+        return self.assets.get(name)
+
+    def playback(self, name: str, loop: bool = False, mode: str = "interleave") -> Optional[AssetPlayback]:
+        asset = self.get(name)
+        return AssetPlayback(asset, loop=loop, mode=mode) if asset else None
+
+    def names(self):
+        return list(self.assets)
+
+
+if __name__ == "__main__":
+    # 基准测试：并发播放数增加时的内存占用
+    import tempfile
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "hold_music.ulaw"), "wb") as f:
+            f.write(os.urandom(8000 * 60))  # 60 秒保持音乐
+
+        library = AudioAssetLibrary(directory)
+        print("=" * 60)
+        print("📊 音频素材库内存基准测试（60 秒素材，每路播放 10 秒）")
+        print("=" * 60)
+
+        for calls in (1, 100, 1000, 5000):
+            tracemalloc.start()
+            playbacks = [library.playback("hold_music", loop=True) for _ in range(calls)]
+            for playback in playbacks:
+                for _ in range(500):
+                    playback.next_frame()
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{calls:>5} 路并发: 共 {current / 1024:.1f} KiB, 每路 {current / calls:.0f} 字节")
+            del playbacks
@@ -0,0 +1,211 @@
+"""
+模型输出音频整形
+Realtime 返回的音频开头常有一段静音，原样转发会让来电者多等这段时间才听到声音。
+OutboundShaper 接在 24kHz → 8kHz 重采样之后、μ-law 编码之前：
+- 去掉每次回复开头的静音，只保留 OUTBOUND_PREROLL_MS 的前导，避免切掉轻声的起音
+- 可选响度归一化：按本通电话模型语音的平均能量计算增益，并按峰值限幅
+- 记录每次回复第一个可听见样本的播出时间（用户说完或回复开始 → 首个可听见样本）
+
+能量计算全部交给 audioop 的 C 实现：整块音频先用一次 audioop.max 判断是否全为静音，
+只有含声音的块才逐帧（20ms）计算 RMS 找出起音位置。
+全部关闭时 CallBridge 不创建 OutboundShaper，转码路径上没有任何额外开销。
+"""
+
+import os
+import time
+import audioop
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_TRIM_SILENCE = os.getenv("OUTBOUND_TRIM_SILENCE", "false").lower() == "true"
+OUTBOUND_NORMALIZE = os.getenv("OUTBOUND_NORMALIZE", "false").lower() == "true"
+# 只统计首个可听见样本的时间，不修改音频（用于对比开启前后的效果）
+OUTBOUND_MEASURE = os.getenv("OUTBOUND_MEASURE", "false").lower() == "true"
+OUTBOUND_SHAPING = OUTBOUND_TRIM_SILENCE or OUTBOUND_NORMALIZE or OUTBOUND_MEASURE
+
+OUTBOUND_SILENCE_RMS = int(os.getenv("OUTBOUND_SILENCE_RMS", "200"))  # 低于此能量的帧视为静音（16 位 PCM RMS）
+OUTBOUND_PREROLL_MS = float(os.getenv("OUTBOUND_PREROLL_MS", "40"))
+OUTBOUND_MAX_TRIM_MS = float(os.getenv("OUTBOUND_MAX_TRIM_MS", "1000"))  # 每次回复最多去掉的静音
+OUTBOUND_TARGET_RMS = int(os.getenv("OUTBOUND_TARGET_RMS", "3000"))  # 约 -21 dBFS
+OUTBOUND_MAX_GAIN = float(os.getenv("OUTBOUND_MAX_GAIN", "4.0"))
+
+# 8kHz 16 位 PCM，每 20ms 一帧
+FRAME_BYTES = 320
+BYTES_PER_MS = 16
+# 限幅后的最大峰值
+PEAK_LIMIT = 32000
+# 平均能量的平滑系数
+LEVEL_SMOOTHING = 0.2
+
+
+class OutboundShaper:
+    """
+    单通电话的输出音频整形，只做计算不做 I/O
+    每次回复开始时调用 start_response()，每个音频增量调用 process()；
+    process() 返回后 first_audible_ms 不为 None 表示本块中出现了本次回复第一个可听见的样本，
+    值为它在返回音频中的位置（毫秒）
+    """
+
+    def __init__(self, trim: bool = OUTBOUND_TRIM_SILENCE, normalize: bool = OUTBOUND_NORMALIZE,
+                 silence_rms: int = OUTBOUND_SILENCE_RMS, preroll_ms: float = OUTBOUND_PREROLL_MS,
+                 max_trim_ms: float = OUTBOUND_MAX_TRIM_MS, target_rms: int = OUTBOUND_TARGET_RMS,
+                 max_gain: float = OUTBOUND_MAX_GAIN):
+        self.trim = trim
+        self.normalize = normalize
+        self.silence_rms = silence_rms
+        self.preroll_bytes = int(preroll_ms * BYTES_PER_MS) // 2 * 2
+        self.max_trim_bytes = int(max_trim_ms * BYTES_PER_MS)
+        self.target_rms = target_rms
+        self.max_gain = max_gain
+
+        self.level: Optional[float] = None  # 模型语音的平均能量，跨回复保持
+        self.gain = 1.0
+        self.responses = 0
+        self.trimmed_ms_total = 0.0
+        self.first_audible: list = []
+        self.start_response()
+
+    def start_response(self):
+        self.leading = True
+        self.trimmed_bytes = 0
+        self.preroll = b""
+        self.started_at = time.monotonic()
+        self.first_audible_ms: Optional[float] = None
+
+    def process(self, pcm: bytes) -> bytes:
+        """处理一块 8kHz 16 位 PCM；开头的静音块被整块去掉时返回空字节串"""
+        self.first_audible_ms = None
+        if self.leading:
+            pcm = self._leading(pcm)
+        if self.normalize and pcm and not self.leading:
+            pcm = self._normalize(pcm)
+        return pcm
+
+    def _onset(self, pcm: bytes) -> Optional[int]:
+        """第一个非静音帧的字节偏移；整块静音返回 None"""
+        if audioop.max(pcm, 2) < self.silence_rms:
+            return None
+        view = memoryview(pcm)
+        for offset in range(0, len(view), FRAME_BYTES):
+            if audioop.rms(view[offset:offset + FRAME_BYTES], 2) >= self.silence_rms:
+                return offset
+        return None
+
+    def _leading(self, pcm: bytes) -> bytes:
+        onset = self._onset(pcm)
+        trimming = self.trim and self.trimmed_bytes < self.max_trim_bytes
+        if onset is None:
+            if not trimming:
+                return pcm
+            # 整块静音：丢掉，只留最后一小段作为起音前导
+            kept = (self.preroll + pcm)[-self.preroll_bytes:] if self.preroll_bytes else b""
+            self.trimmed_bytes += len(self.preroll) + len(pcm) - len(kept)
+            self.preroll = kept
+            return b""
+
+        self.leading = False
+        self.responses += 1
+        if trimming:
+            head = (self.preroll + pcm[:onset])[-self.preroll_bytes:] if self.preroll_bytes else b""
+            self.trimmed_bytes += len(self.preroll) + onset - len(head)
+            pcm = head + pcm[onset:]
+            onset = len(head)
+            self.trimmed_ms_total += self.trimmed_bytes / BYTES_PER_MS
+        self.preroll = b""
+        self.first_audible_ms = onset / BYTES_PER_MS
+        return pcm
+
+    def _normalize(self, pcm: bytes) -> bytes:
+        rms = audioop.rms(pcm, 2)
+        if rms >= self.silence_rms:
+            self.level = rms if self.level is None else self.level * (1 - LEVEL_SMOOTHING) + rms * LEVEL_SMOOTHING
+        if self.level is None:
+            return pcm
+        gain = min(self.max_gain, max(1 / self.max_gain, self.target_rms / self.level))
+        peak = audioop.max(pcm, 2)
+        if peak:
+            gain = min(gain, PEAK_LIMIT / peak)
+        self.gain = gain
+        if abs(gain - 1.0) < 0.05:
+            return pcm
+        return audioop.mul(pcm, 2, gain)
+
+    def observe_first_audible(self, ms: float):
+        """登记本次回复从用户说完（或回复开始）到首个可听见样本播出的时间"""
+        self.first_audible.append(ms)
+        del self.first_audible[:-200]
+
+    def stats(self) -> dict:
+        samples = sorted(self.first_audible)
+        p50 = samples[len(samples) // 2] if samples else None
+        p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))] if samples else None
+        return {
+            "responses": self.responses,
+            "trimmed_ms_mean": round(self.trimmed_ms_total / self.responses) if self.responses else 0,
+            "first_audible_p50_ms": round(p50) if p50 is not None else None,
+            "first_audible_p90_ms": round(p90) if p90 is not None else None,
+            "gain": round(self.gain, 2),
+        }
+
+
+if __name__ == "__main__":
+    # 合成模型回复：开头 100~400ms 静音，随后是语音；按 Realtime 的节奏每块 100ms（24kHz PCM）
+    # 对比首个可听见样本的播出位置，以及每块音频的处理开销
+    import math
+    import random
+    import statistics
+
+    rng = random.Random(5)
+
+    def synth_response(leading_ms: float, speech_ms: float = 2000, amplitude: float = 1500) -> bytes:
+        samples = [rng.gauss(0, 20) for _ in range(int(leading_ms * 24))]
+        length = int(speech_ms * 24)
+        samples += [amplitude * math.sin(2 * math.pi * 220 * i / 24000) * (0.6 + 0.4 * math.sin(i / 2400))
+                    for i in range(length)]
+        return b"".join(int(s).to_bytes(2, "little", signed=True) for s in samples)
+
+    def chunks(pcm: bytes, chunk_ms: int = 100):
+        size = chunk_ms * 48
+        return [pcm[offset:offset + size] for offset in range(0, len(pcm), size)]
+
+    def to_8k(pcm_24k: bytes) -> bytes:
+        return audioop.ratecv(pcm_24k, 2, 1, 24000, 8000, None)[0]
+
+    responses = [(leading, chunks(synth_response(leading))) for leading in [rng.uniform(100, 400) for _ in range(20)]]
+
+    print("首个可听见样本相对首个音频包的播出位置（ms，均值）")
+    for label, shaper in [("不整形（仅测量）", OutboundShaper(trim=False)),
+                          ("去掉开头静音", OutboundShaper(trim=True)),
+                          ("去静音 + 归一化", OutboundShaper(trim=True, normalize=True))]:
+        offsets = []
+        for leading, response in responses:
+            shaper.start_response()
+            played_ms = 0.0
+            for chunk in response:
+                out = shaper.process(to_8k(chunk))
+                if shaper.first_audible_ms is not None:
+                    offsets.append(played_ms + shaper.first_audible_ms)
+                    shaper.observe_first_audible(offsets[-1])
+                played_ms += len(out) / BYTES_PER_MS
+        print(f"  {label:<14} {statistics.mean(offsets):6.0f}   {shaper.stats()}")
+
+    print("每块 100ms 音频的转码开销（µs，中位数）")
+    all_chunks = [chunk for _, response in responses for chunk in response]
+    for label, factory in [("关闭（不创建）", None),
+                           ("去掉开头静音", lambda: OutboundShaper(trim=True)),
+                           ("去静音 + 归一化", lambda: OutboundShaper(trim=True, normalize=True))]:
+        timings = []
+        for _ in range(5):
+            shaper = factory() if factory else None
+            for index, chunk in enumerate(all_chunks):
+                if shaper and index % 21 == 0:
+                    shaper.start_response()
+                started = time.perf_counter()
+                pcm_8k = to_8k(chunk)
+                if shaper:
+                    pcm_8k = shaper.process(pcm_8k)
+                audioop.lin2ulaw(pcm_8k, 2)
+                timings.append((time.perf_counter() - started) * 1e6)
+        print(f"  {label:<14} {statistics.median(timings):6.1f}")
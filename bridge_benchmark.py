@@ -0,0 +1,214 @@
+"""
+CallBridge 适配器基准测试
+模拟的 Twilio 客户端直接在 ASGI 层收发消息，OpenAI 连接替换为回声连接（收到一帧输入即返回一帧输出），
+逐帧测量从发出 media 消息到收到回传 media 消息的往返耗时：
+
+    direct        内存传输直接驱动 CallBridge（基线）
+    fastapi       FastAPI 路由 /media-stream
+    fastapi-asgi  FastAPI 模块的原生 ASGI 入口 asgi_app
+    quart         Quart 路由 /media-stream
+    quart-asgi    Quart 模块的原生 ASGI 入口 asgi_app
+
+与基线的差值即为各适配器的单帧开销。
+
+用法：python bridge_benchmark.py [帧数]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import logging
+import tempfile
+import statistics
+
+# 基准测试不落盘、不做上下文管理，只测转发路径
+os.environ.setdefault("TRANSCRIPT_SINK", "none")
+os.environ.setdefault("CONTEXT_STRATEGY", "none")
+os.environ.setdefault("GREETING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bridge-benchmark-greetings"))
+
+from call_bridge import BridgeServices, CallBridge  # noqa: E402
+
+WARMUP_FRAMES = 200
+# 20ms 的 μ-law 帧
+FRAME = base64.b64encode(bytes(range(160))).decode("utf-8")
+
+
+class EchoRealtime:
+    """回声式 OpenAI 连接：每收到一帧输入音频，立即返回一帧输出音频"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def send(self, message: str):
+        data = json.loads(message)
+        if data["type"] == "input_audio_buffer.append":
+            self.queue.put_nowait(json.dumps({"type": "response.audio.delta", "delta": data["audio"]}))
+
+    async def close(self):
+        self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+async def echo_connect():
+    return EchoRealtime()
+
+
+class MemoryTransport:
+    """基线：用两个队列直接对接 CallBridge"""
+
+    def __init__(self):
+        self.inbound = asyncio.Queue()
+        self.outbound = asyncio.Queue()
+
+    async def receive_text(self):
+        return await self.inbound.get()
+
+    async def send_text(self, text: str):
+        self.outbound.put_nowait(text)
+
+    async def close(self, code: int = 1000):
+        self.inbound.put_nowait(None)
+
+
+class DirectClient:
+    def __init__(self, services: BridgeServices):
+        self.transport = MemoryTransport()
+        self.bridge = CallBridge("CA-bench", self.transport, services, "bench", "alloy")
+
+    async def start(self):
+        self.task = asyncio.create_task(self.bridge.run())
+
+    async def send_text(self, text: str):
+        self.transport.inbound.put_nowait(text)
+
+    async def receive_text(self) -> str:
+        return await self.transport.outbound.get()
+
+    async def close(self):
+        await self.task
+
+
+class ASGIClient:
+    """模拟 Twilio：直接调用 ASGI 应用，不经过网络"""
+
+    def __init__(self, app):
+        self.app = app
+        self.inbound = asyncio.Queue()
+        self.outbound = asyncio.Queue()
+        self.scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0", "spec_version": "2.3"},
+            "http_version": "1.1",
+            "scheme": "wss",
+            "path": "/media-stream",
+            "raw_path": b"/media-stream",
+            "root_path": "",
+            "query_string": b"call_sid=CA-bench&instructions=bench&voice=alloy",
+            "headers": [(b"host", b"bench.local")],
+            "client": ("127.0.0.1", 50000),
+            "server": ("bench.local", 443),
+            "subprotocols": [],
+            "extensions": {},
+            "state": {},
+        }
+
+    async def _receive(self):
+        return await self.inbound.get()
+
+    async def _send(self, message: dict):
+        self.outbound.put_nowait(message)
+
+    async def start(self):
+        self.inbound.put_nowait({"type": "websocket.connect"})
+        self.task = asyncio.create_task(self.app(self.scope, self._receive, self._send))
+
+    async def send_text(self, text: str):
+        self.inbound.put_nowait({"type": "websocket.receive", "text": text})
+
+    async def receive_text(self) -> str:
+        while True:
+            message = await self.outbound.get()
+            if message["type"] == "websocket.send":
+                return message.get("text") or message["bytes"].decode("utf-8")
+            if message["type"] == "websocket.close":
+                raise ConnectionError("server closed the stream")
+
+    async def close(self):
+        self.inbound.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, timeout=5)
+
+
+async def measure(client, frames: int):
+    await client.start()
+    await client.send_text(json.dumps({"event": "start", "start": {"streamSid": "MZ-bench"}}))
+    media = json.dumps({"event": "media", "media": {"payload": FRAME}})
+
+    samples = []
+    for i in range(WARMUP_FRAMES + frames):
+        started = time.perf_counter()
+        await client.send_text(media)
+        await client.receive_text()
+        if i >= WARMUP_FRAMES:
+            samples.append((time.perf_counter() - started) * 1e6)
+
+    await client.send_text(json.dumps({"event": "stop"}))
+    await client.close()
+    samples.sort()
+    return samples
+
+
+def load_adapters():
+    """按已安装的框架返回 (名称, 客户端工厂)"""
+    adapters = [("direct", lambda: DirectClient(BridgeServices("", "", "", connect=echo_connect)))]
+
+    try:
+        import twilio_openai_agent_fastapi as fastapi_agent
+        fastapi_agent.bridge_services.connect = echo_connect
+        adapters.append(("fastapi", lambda: ASGIClient(fastapi_agent.app)))
+        adapters.append(("fastapi-asgi", lambda: ASGIClient(fastapi_agent.asgi_app)))
+    except ImportError as e:
+        print(f"⚠️ 跳过 FastAPI: {e}")
+
+    try:
+        import twilio_openai_agent_quart as quart_agent
+        quart_agent.bridge_services.connect = echo_connect
+        adapters.append(("quart", lambda: ASGIClient(quart_agent.app)))
+        adapters.append(("quart-asgi", lambda: ASGIClient(quart_agent.asgi_app)))
+    except ImportError as e:
+        print(f"⚠️ 跳过 Quart: {e}")
+
+    # 应用模块导入时会配置 INFO 日志，测量时只保留警告
+    logging.getLogger().setLevel(logging.WARNING)
+    return adapters
+
+
+async def main(frames: int):
+    adapters = load_adapters()
+    results = {}
+    for name, factory in adapters:
+        results[name] = await measure(factory(), frames)
+
+    baseline = statistics.median(results["direct"])
+    print("=" * 72)
+    print(f"📊 CallBridge 适配器单帧往返耗时（{frames} 帧，含转码）")
+    print("=" * 72)
+    print(f"{'入口':<14} {'p50 µs':>10} {'p99 µs':>10} {'均值 µs':>10} {'相对基线 µs':>14}")
+    for name, samples in results.items():
+        p50 = statistics.median(samples)
+        p99 = samples[int(len(samples) * 0.99)]
+        print(f"{name:<14} {p50:>10.1f} {p99:>10.1f} {statistics.mean(samples):>10.1f} {p50 - baseline:>+14.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
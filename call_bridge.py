@@ -0,0 +1,758 @@
+"""
+与 Web 框架无关的通话桥接核心
+CallBridge 负责一通电话里 Twilio 媒体流与 OpenAI Realtime 会话之间的全部逻辑：
+音频转码转发、问候语、素材播放、录音、转录、上下文管理和断线重连。
+FastAPI、Quart 和原生 ASGI 只需提供一个实现 receive_text / send_text / close 的传输适配器。
+"""
+
+import json
+import time
+import base64
+import asyncio
+import audioop
+import logging
+from collections import deque
+from typing import Callable, List, Optional
+
+import websockets
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+from audio_assets import FRAME_SECONDS, iter_frames, media_message
+from context_window import ContextWindowManager, truncation_config
+from conversation_log import ConversationLog
+from event_dispatcher import EventDispatcher
+from tool_calls import RESPONSE_CREATE, ToolCallSession
+from tool_filler import ToolFiller
+from turn_detector import TurnDetector
+from turn_tuner import TurnTuner
+from answering_machine import CallScreener
+from audio_shaping import OutboundShaper
+from prompt_templates import PromptCacheMeter
+from cost_accounting import CallCostTracker
+from greeting_cache import greeting_key
+
+logger = logging.getLogger(__name__)
+
+# 重连期间最多缓冲的来电音频帧数（每帧 20ms，共 5 秒）
+RECONNECT_AUDIO_FRAMES = 250
+
+# 素材播放时在 Twilio 端预先缓冲的时长（秒）
+ASSET_PLAYOUT_LEAD = 0.2
+
+
+class AudioProcessor:
+    """音频格式转换处理器"""
+
+    @staticmethod
+    def mulaw_to_pcm24k(mulaw_data: bytes) -> bytes:
+        """
+        将 μ-law 8kHz 转换为 PCM 24kHz
+        Twilio 使用 μ-law, OpenAI 使用 PCM
+        """
+        try:
+            # μ-law 解码为 PCM 16-bit
+            pcm_8k = audioop.ulaw2lin(mulaw_data, 2)
+            # 重采样 8kHz → 24kHz
+            pcm_24k, _ = audioop.ratecv(pcm_8k, 2, 1, 8000, 24000, None)
+            return pcm_24k
+        except Exception as e:
+            logger.error(f"音频转换错误 (μ-law→PCM): {e}")
+            return b""
+
+    @staticmethod
+    def pcm24k_to_mulaw(pcm_data: bytes, shaper=None) -> bytes:
+        """
+        将 PCM 24kHz 转换为 μ-law 8kHz
+        OpenAI 输出 PCM, Twilio 需要 μ-law
+        shaper: 可选的 OutboundShaper，在 8kHz PCM 上去掉开头静音、归一化响度
+        """
+        try:
+            # 重采样 24kHz → 8kHz
+            pcm_8k, _ = audioop.ratecv(pcm_data, 2, 1, 24000, 8000, None)
+            if shaper:
+                pcm_8k = shaper.process(pcm_8k)
+            # PCM 编码为 μ-law
+            mulaw = audioop.lin2ulaw(pcm_8k, 2)
+            return mulaw
+        except Exception as e:
+            logger.error(f"音频转换错误 (PCM→μ-law): {e}")
+            return b""
+
+
+class BridgeServices:
+    """
+    所有通话共享的配置和组件
+    可选组件（问候缓存、素材库、录音、转录）为 None 时对应功能关闭
+    connect: 建立 OpenAI 连接的协程函数，默认使用 websockets
+    tools: ToolRegistry，有工具时在会话配置中声明并处理模型的函数调用
+    turn_detection: server（OpenAI 服务端 VAD）或 local（本地断句，见 turn_detector.py）
+    turn_tuning: 服务端 VAD 时按每通电话的轮次统计在通话中调整参数（见 turn_tuner.py）
+    outbound_shaping: 模型音频去掉开头静音、归一化响度并统计首个可听见样本的时间（见 audio_shaping.py）
+    plugins: 每通电话创建时调用 plugin(bridge)，插件在 bridge.dispatcher 上订阅所需事件
+    prompt_report: PromptCacheReport，按提示词模板汇总各通电话的缓存命中率（见 prompt_templates.py）
+    cost_ledger: CostLedger，累计各通电话的 token 用量和费用并执行预算（见 cost_accounting.py）
+    prompt_library: PromptLibrary，使用模板的通话按模板的静态前缀合成和缓存问候语、垫话
+    """
+
+    def __init__(self, openai_url: str, api_key: str, model: str, greeting_cache=None, audio_assets=None,
+                 recorder=None, transcript_store=None, context_strategy: str = "none",
+                 reconnect_timeout: float = 5.0, connect=None, tools=None, turn_detection: str = "server",
+                 turn_tuning: bool = False, outbound_shaping: bool = False, plugins=None, prompt_report=None,
+                 cost_ledger=None, prompt_library=None):
+        self.openai_url = openai_url
+        self.api_key = api_key
+        self.model = model
+        self.greeting_cache = greeting_cache
+        self.audio_assets = audio_assets
+        self.recorder = recorder
+        self.transcript_store = transcript_store
+        self.context_strategy = context_strategy
+        self.reconnect_timeout = reconnect_timeout
+        self.connect = connect or self.connect_websocket
+        self.tools = tools
+        self.turn_detection = turn_detection
+        self.turn_tuning = turn_tuning
+        self.outbound_shaping = outbound_shaping
+        self.plugins = list(plugins or [])
+        self.prompt_report = prompt_report
+        self.cost_ledger = cost_ledger
+        self.prompt_library = prompt_library
+        self.rendering_greetings = set()
+
+    async def connect_websocket(self, api_key: Optional[str] = None):
+        url = f"{self.openai_url}?model={self.model}"
+        headers = {"Authorization": f"Bearer {api_key or self.api_key}"}
+        return await websockets.connect(url, additional_headers=headers)
+
+    def session_config(self, instructions: str, voice: str, tools: Optional[List[str]] = None) -> dict:
+        """OpenAI 会话配置，首次连接和断线重连时发送；tools 不为 None 时只声明其中列出的工具"""
+        session_config = {
+            "type": "session.update",
+            "session": {
+                "type": "realtime",
+                "model": self.model,
+                "instructions": instructions,
+                "input_audio_format": "pcm16",
+                "output_audio_format": "pcm16",
+                "voice": voice,
+                "turn_detection": {
+                    "type": "server_vad",
+                    "threshold": 0.5,
+                    "prefix_padding_ms": 300,
+                    "silence_duration_ms": 500
+                },
+                "input_audio_transcription": {
+                    "model": "whisper-1"
+                }
+            }
+        }
+        if self.turn_detection == "local":
+            # 由本地断句提交音频并请求回复
+            session_config["session"]["turn_detection"] = None
+        if self.tools:
+            session_config["session"]["tools"] = self.tools.definitions(tools)
+            session_config["session"]["tool_choice"] = "auto"
+        if self.context_strategy == "truncation":
+            # 交给服务端截断旧条目
+            session_config["session"]["truncation"] = truncation_config()
+        return session_config
+
+    async def render_greeting(self, instructions: str, voice: str, greeting: str, template: Optional[str] = None):
+        """
+        通过独立的 Realtime 会话合成问候语音频并写入缓存
+        每个问候只合成一次，之后的通话直接从缓存播放；template 见 greeting_key
+        """
+        key = greeting_key(instructions, voice, greeting, template)
+        if key in self.rendering_greetings:
+            return
+        self.rendering_greetings.add(key)
+        pcm_chunks = []
+
+        try:
+            openai_ws = await self.connect()
+            try:
+                await openai_ws.send(json.dumps({
+                    "type": "session.update",
+                    "session": {
+                        "type": "realtime",
+                        "model": self.model,
+                        "instructions": instructions,
+                        "output_audio_format": "pcm16",
+                        "voice": voice,
+                        "turn_detection": None
+                    }
+                }))
+                await openai_ws.send(json.dumps({
+                    "type": "response.create",
+                    "response": {
+                        "modalities": ["audio", "text"],
+                        "instructions": f"逐字朗读以下问候语，不要添加任何内容：{greeting}"
+                    }
+                }))
+
+                async for message in openai_ws:
+                    data = json.loads(message)
+                    if data.get("type") == "response.audio.delta":
+                        pcm_chunks.append(base64.b64decode(data["delta"]))
+                    elif data.get("type") in ("response.done", "error"):
+                        break
+            finally:
+                await openai_ws.close()
+
+            # 整段一次性转码，避免分段重采样的边界失真
+            mulaw = AudioProcessor.pcm24k_to_mulaw(b"".join(pcm_chunks))
+            await asyncio.to_thread(self.greeting_cache.put, key, mulaw)
+
+        except Exception as e:
+            logger.error(f"❌ 问候音频合成失败: {e}")
+        finally:
+            self.rendering_greetings.discard(key)
+
+
+class CallBridge:
+    """
+    一通电话的桥接
+
+    transport 需要实现：
+        receive_text() -> Optional[str]  Twilio 断开时返回 None
+        send_text(text)
+        close()
+    会话状态保存在 self.session 字典中，由调用方登记到 active_sessions
+    screen: 外呼时先做答录机检测，确认是真人再连接 OpenAI（见 answering_machine.py）
+    tools: 本通电话可用的工具名（来电路由按号码配置，见 call_routing.py），None 表示全部
+    api_key: 本通电话使用的 OpenAI API Key（多租户时按租户配置，见 tenants.py），None 表示使用全局配置
+    template: 指令由哪个提示词模板渲染，用于按模板统计缓存命中率；None 表示调用方直接给出的指令
+    budget: 本通电话适用的费用预算（CallBudget），None 表示按 CALL_BUDGET_USD
+    tenant: 所属租户 ID，工具结果缓存按租户隔离；None 表示单租户部署
+    """
+
+    def __init__(self, call_sid: str, transport, services: BridgeServices, instructions: str,
+                 voice: str, greeting: Optional[str] = None, screen: bool = False,
+                 tools: Optional[List[str]] = None, api_key: Optional[str] = None,
+                 template: Optional[str] = None, budget=None, tenant: Optional[str] = None):
+        self.call_sid = call_sid
+        self.transport = transport
+        self.services = services
+        self.api_key = api_key
+        prompt = services.prompt_library.get(template) if services.prompt_library else None
+        self.session = {
+            "bridge": self,
+            "openai_ws": None,
+            "openai_ready": asyncio.Event(),
+            "session_config": services.session_config(instructions, voice, tools),
+            "conversation": ConversationLog(),
+            "context": ContextWindowManager() if services.context_strategy == "summary" else None,
+            "pending_audio": deque(maxlen=RECONNECT_AUDIO_FRAMES),
+            "reconnects": 0,
+            "closing": False,
+            "stream_sid": None,
+            "stream_ready": asyncio.Event(),
+            "stream_started_at": None,
+            "instructions": instructions,
+            # 预合成语音（问候语、垫话、留言）使用的指令：有模板时只用静态前缀，缓存可跨通话命中
+            "speech_instructions": prompt.prefix if prompt else instructions,
+            "speech_template": prompt.name if prompt else None,
+            "voice": voice,
+            "greeting": greeting,
+            "twilio_ws": transport,
+            "asset_playback": None,
+            "model_audio_until": 0.0,
+            "recording": services.recorder.open(call_sid) if services.recorder else None
+        }
+
+        self.dispatcher = EventDispatcher()
+        self.register_handlers()
+        allowed = set(tools) if tools is not None else None
+        self.tool_calls = ToolCallSession(self, services.tools, allowed, tenant) if services.tools else None
+        self.tool_filler = ToolFiller(self, self.tool_calls) if self.tool_calls else None
+        self.turn_detector = TurnDetector() if services.turn_detection == "local" else None
+        self.turn_tuner = TurnTuner(self) if services.turn_tuning and not self.turn_detector else None
+        self.screener = CallScreener(self) if screen else None
+        self.shaper = OutboundShaper() if services.outbound_shaping else None
+        self.prompt_cache = PromptCacheMeter(self, template, services.prompt_report)
+        self.cost_tracker = CallCostTracker(self, services.cost_ledger, budget) if services.cost_ledger else None
+        for plugin in services.plugins:
+            plugin(self)
+
+    def speech_key(self, text: str) -> str:
+        """本通电话预合成语音的缓存键"""
+        session = self.session
+        return greeting_key(session["speech_instructions"], session["voice"], text, session["speech_template"])
+
+    def render_speech(self, text: str):
+        """在后台合成并缓存本通电话的一段固定语音，供之后的通话使用"""
+        session = self.session
+        asyncio.create_task(self.services.render_greeting(session["speech_instructions"], session["voice"], text,
+                                                          session["speech_template"]))
+
+    async def send_twilio(self, message: dict):
+        await self.transport.send_text(json.dumps(message))
+
+    async def run(self):
+        """
+        连接 OpenAI 并双向转发，直到任一端结束
+        Twilio 读取和问候语播放在 OpenAI 握手之前启动：缓存的问候音频在媒体流启动时即开始推送，
+        握手期间的来电音频和发给模型的事件先进入 pending_audio，连接就绪后按顺序补发
+        """
+        call_sid = self.call_sid
+        session = self.session
+        twilio_forwarder = None
+        greeting_task = None
+        try:
+            # 立即开始读取 Twilio；外呼需要答录机检测时先只做检测，答录机接听时不建立 OpenAI 会话
+            twilio_forwarder = asyncio.create_task(self.forward_twilio_to_openai())
+            if self.screener and not await self.screener.screen(twilio_forwarder):
+                return
+            if session.get("greeting"):
+                greeting_task = asyncio.create_task(self.play_greeting())
+
+            session["openai_ws"] = await self.connect_openai()
+            if session["closing"]:
+                # 握手期间 Twilio 已断开
+                return
+            # 补发检测期间缓冲的来电音频，缓冲清空后立即标记就绪
+            while session["pending_audio"]:
+                await session["openai_ws"].send(session["pending_audio"].popleft())
+            session["openai_ready"].set()
+            logger.info(f"[{call_sid}] ✅ OpenAI WebSocket 已连接")
+            logger.info(f"[{call_sid}] ⚙️ 已发送会话配置")
+
+            # 创建两个并发任务处理双向音频流
+            await asyncio.gather(twilio_forwarder, self.forward_openai_to_twilio(), return_exceptions=True)
+
+        except Exception as e:
+            logger.error(f"[{call_sid}] ❌ 错误: {e}")
+        finally:
+            session["closing"] = True
+            if twilio_forwarder and not twilio_forwarder.done():
+                twilio_forwarder.cancel()
+            if greeting_task:
+                greeting_task.cancel()
+            if self.tool_calls:
+                self.tool_calls.cancel()
+                self.tool_filler.cancel()
+            if session["openai_ws"]:
+                await session["openai_ws"].close()
+            if session["recording"]:
+                session["recording"].close()
+            if session["reconnects"]:
+                logger.info(f"[{call_sid}] 🔄 本次通话 OpenAI 重连 {session['reconnects']} 次")
+            if self.turn_detector:
+                logger.info(f"[{call_sid}] 🎙️ 本地断句: {self.turn_detector.stats()}")
+            if self.turn_tuner:
+                self.turn_tuner.finish()
+            if self.shaper:
+                logger.info(f"[{call_sid}] 🔉 输出音频整形: {self.shaper.stats()}")
+            self.prompt_cache.finish()
+            if self.cost_tracker:
+                self.cost_tracker.finish()
+            for key, summary in self.dispatcher.timing_summary().items():
+                logger.info(f"[{call_sid}] ⏱️ {key}: {summary}")
+
+    # ==================== OpenAI 连接 ====================
+
+    async def connect_openai(self):
+        """建立 OpenAI Realtime 连接并发送会话配置"""
+        connect = self.services.connect
+        openai_ws = await (connect(self.api_key) if self.api_key else connect())
+        await openai_ws.send(json.dumps(self.session["session_config"]))
+        return openai_ws
+
+    async def reconnect_openai(self) -> bool:
+        """
+        OpenAI 连接意外断开时重连：重新发送会话配置，重放对话记录，
+        再补发断线期间缓冲的来电音频，在 reconnect_timeout 内完成。
+        正在等待的基于工具结果的回复随旧连接一起丢失，重放后重新请求
+        """
+        call_sid = self.call_sid
+        session = self.session
+        session["openai_ready"].clear()
+        started = time.monotonic()
+        deadline = started + self.services.reconnect_timeout
+        delay = 0.1
+
+        while not session["closing"]:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                openai_ws = await asyncio.wait_for(self.connect_openai(), timeout=remaining)
+                for message in session["conversation"].replay_messages():
+                    await openai_ws.send(message)
+                # response.create 可能在断线前刚发出就随旧连接丢失；断线期间发出的仍在 pending_audio 中
+                if self.tool_calls and self.tool_calls.awaiting_response \
+                        and RESPONSE_CREATE not in session["pending_audio"]:
+                    await openai_ws.send(RESPONSE_CREATE)
+                # 补发断线期间的来电音频，缓冲清空后立即标记就绪，之后的音频直接发送
+                while session["pending_audio"]:
+                    await openai_ws.send(session["pending_audio"].popleft())
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                logger.warning(f"[{call_sid}] ⚠️ OpenAI 重连失败: {e}")
+                await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+                delay = min(delay * 2, 1.0)
+                continue
+
+            session["openai_ws"] = openai_ws
+            if session["context"]:
+                session["context"].reset()
+            session["openai_ready"].set()
+            session["reconnects"] += 1
+            elapsed_ms = (time.monotonic() - started) * 1000
+            logger.info(f"[{call_sid}] 🔄 OpenAI 已重连，重放 {len(session['conversation'])} 条对话 ({elapsed_ms:.0f} ms)")
+            return True
+        return False
+
+    # ==================== 音频转发 ====================
+
+    async def forward_twilio_to_openai(self):
+        """转发音频：Twilio → OpenAI"""
+        call_sid = self.call_sid
+        session = self.session
+        logger.info(f"[{call_sid}] 开始转发 Twilio → OpenAI")
+
+        try:
+            while True:
+                # 从 Twilio WebSocket 接收消息
+                message = await self.transport.receive_text()
+                if message is None:
+                    logger.info(f"[{call_sid}] Twilio WebSocket 断开连接")
+                    break
+
+                data = json.loads(message)
+
+                # 保存 stream SID
+                if data.get("event") == "start":
+                    stream_sid = data["start"]["streamSid"]
+                    session["stream_sid"] = stream_sid
+                    session["stream_started_at"] = time.monotonic()
+                    session["stream_ready"].set()
+                    logger.info(f"[{call_sid}] 媒体流已启动: {stream_sid}")
+
+                # 处理音频数据
+                elif data.get("event") == "media":
+                    payload = data["media"]["payload"]
+                    # Twilio 发送的是 base64 编码的 μ-law 音频
+                    mulaw_data = base64.b64decode(payload)
+                    if session["recording"]:
+                        session["recording"].write_inbound(mulaw_data)
+                    if self.screener:
+                        self.screener.process(mulaw_data)
+                    # 转换为 PCM 24kHz
+                    pcm_data = AudioProcessor.mulaw_to_pcm24k(mulaw_data)
+
+                    if pcm_data:
+                        # 发送给 OpenAI (base64 编码)
+                        pcm_base64 = base64.b64encode(pcm_data).decode("utf-8")
+                        await self.send_openai(json.dumps({
+                            "type": "input_audio_buffer.append",
+                            "audio": pcm_base64
+                        }))
+
+                    if self.turn_detector:
+                        turn_event = self.turn_detector.process(mulaw_data)
+                        if turn_event:
+                            await self.on_local_turn(turn_event)
+
+                # 呼叫结束
+                elif data.get("event") == "stop":
+                    logger.info(f"[{call_sid}] Twilio 媒体流已停止")
+                    break
+
+        except Exception as e:
+            logger.error(f"[{call_sid}] Twilio→OpenAI 转发错误: {e}")
+        finally:
+            # 通话结束：关闭 OpenAI 连接，让另一个转发任务随之退出
+            session["closing"] = True
+            if session.get("openai_ws"):
+                await session["openai_ws"].close()
+
+    async def send_openai(self, message: str):
+        """发送来电音频及其相关事件；重连期间先缓冲，恢复后按顺序补发"""
+        session = self.session
+        if session["openai_ready"].is_set():
+            try:
+                await session["openai_ws"].send(message)
+            except ConnectionClosed:
+                session["pending_audio"].append(message)
+        else:
+            session["pending_audio"].append(message)
+
+    async def send_item(self, event: dict, record: Callable[[], None]):
+        """
+        发送重连后需要重放的对话条目（问候语、函数调用结果），record 把它写入对话日志
+        连接就绪后才发送，发送成功后才写入日志：写入之后断线由重连时的重放补发，
+        写入之前断线则在重连后重新发送，两条路径既不会遗漏也不会重复
+        """
+        session = self.session
+        message = json.dumps(event, ensure_ascii=False)
+        while not session["closing"]:
+            await session["openai_ready"].wait()
+            openai_ws = session["openai_ws"]
+            try:
+                await openai_ws.send(message)
+            except ConnectionClosed:
+                # 等转发任务发现断线并开始重连（openai_ready 被清除）或连接已被替换
+                while session["openai_ws"] is openai_ws and session["openai_ready"].is_set() \
+                        and not session["closing"]:
+                    await asyncio.sleep(0.05)
+                continue
+            record()
+            return
+
+    async def on_local_turn(self, turn_event: str):
+        """本地断句的结果：说完时提交音频并请求回复，开口打断时停止模型语音"""
+        session = self.session
+        if turn_event == "turn_ended":
+            session["speech_stopped_at"] = time.monotonic()
+            session["response_latency_ms"] = None
+            await self.send_openai(json.dumps({"type": "input_audio_buffer.commit"}))
+            await self.send_openai(json.dumps({"type": "response.create"}))
+            return
+
+        model_speaking = session["model_audio_until"] > time.monotonic()
+        if turn_event == "turn_resumed" and session.get("response_latency_ms") is None:
+            # 误断且回复还没开始播放：取消这次回复，等用户真正说完
+            await self.send_openai(json.dumps({"type": "response.cancel"}))
+        elif model_speaking:
+            # 用户插话：停止生成并清掉 Twilio 端已缓冲的模型语音
+            logger.info(f"[{self.call_sid}] ✋ 用户插话，停止当前回复")
+            await self.send_openai(json.dumps({"type": "response.cancel"}))
+            session["model_audio_until"] = time.monotonic()
+            if session.get("stream_sid"):
+                await self.send_twilio({"event": "clear", "streamSid": session["stream_sid"]})
+
+    async def forward_openai_to_twilio(self):
+        """转发音频：OpenAI → Twilio，连接意外断开时透明重连"""
+        call_sid = self.call_sid
+        session = self.session
+        logger.info(f"[{call_sid}] 开始转发 OpenAI → Twilio")
+
+        try:
+            while True:
+                try:
+                    async for message in session["openai_ws"]:
+                        await self.dispatcher.dispatch(message)
+                except ConnectionClosed:
+                    pass
+
+                if session["closing"]:
+                    logger.info(f"[{call_sid}] OpenAI WebSocket 连接已关闭")
+                    break
+
+                logger.warning(f"[{call_sid}] ⚠️ OpenAI 连接意外断开，正在重连")
+                if not await self.reconnect_openai():
+                    logger.error(f"[{call_sid}] ❌ OpenAI 重连失败，结束通话")
+                    await self.transport.close()
+                    break
+        except Exception as e:
+            logger.error(f"[{call_sid}] OpenAI→Twilio 转发错误: {e}")
+
+    # ==================== OpenAI 事件处理 ====================
+
+    def register_handlers(self):
+        """在分发器上注册内置的事件处理函数"""
+        dispatcher = self.dispatcher
+        # 上下文管理最先处理，与之前在所有事件之前调用保持一致
+        if self.session["context"]:
+            for event_type in ContextWindowManager.EVENT_TYPES:
+                dispatcher.subscribe(event_type, self.on_context_event)
+        dispatcher.on_audio_delta(self.on_audio_delta)
+        dispatcher.subscribe("session.created", self.on_session_created)
+        dispatcher.subscribe("session.updated", self.on_session_updated)
+        dispatcher.subscribe("input_audio_buffer.speech_stopped", self.on_speech_stopped)
+        dispatcher.subscribe("response.created", self.on_response_created)
+        dispatcher.subscribe("response.audio_transcript.done", self.on_assistant_transcript)
+        dispatcher.subscribe("conversation.item.input_audio_transcription.completed", self.on_user_transcript)
+        dispatcher.subscribe("error", self.on_error)
+
+    async def handle_openai_event(self, data: dict):
+        """处理一条已解析的 OpenAI Realtime 事件"""
+        await self.dispatcher.dispatch_event(data)
+
+    async def on_context_event(self, data: dict):
+        # 上下文超出预算时删除旧条目并插入摘要
+        for event in self.session["context"].on_event(data):
+            await self.session["openai_ws"].send(json.dumps(event))
+
+    def on_session_created(self, data: dict):
+        logger.info(f"[{self.call_sid}] OpenAI 会话已创建")
+
+    def on_session_updated(self, data: dict):
+        logger.info(f"[{self.call_sid}] OpenAI 会话已更新")
+
+    def on_speech_stopped(self, data: dict):
+        # 用户说完，开始计算本轮响应延迟
+        self.session["speech_stopped_at"] = time.monotonic()
+        self.session["response_latency_ms"] = None
+
+    def on_response_created(self, data: dict):
+        self.session["first_audible_ms"] = None
+        if self.shaper:
+            self.shaper.start_response()
+
+    async def on_audio_delta(self, audio_base64: str):
+        """OpenAI 返回的音频增量（快速路径，只拿到 base64 音频）"""
+        session = self.session
+
+        if session.get("speech_stopped_at") and session.get("response_latency_ms") is None:
+            session["response_latency_ms"] = (time.monotonic() - session["speech_stopped_at"]) * 1000
+
+        if not audio_base64:
+            return
+        # 解码 PCM 音频并转换为 μ-law 8kHz
+        mulaw_data = AudioProcessor.pcm24k_to_mulaw(base64.b64decode(audio_base64), self.shaper)
+        if not mulaw_data:
+            # 回复开头的静音已被整块去掉
+            return
+
+        # 正在播放素材时：垫话让位给模型，保持音乐混入背景
+        playback = session.get("asset_playback")
+        if playback:
+            if playback.mode == "mix":
+                mulaw_data = playback.mix_into(mulaw_data)
+            else:
+                await self.stop_asset_playback()
+
+        now = time.monotonic()
+        play_at = max(now, session["model_audio_until"])
+        session["model_audio_until"] = play_at + len(mulaw_data) / 8000
+        if self.shaper and self.shaper.first_audible_ms is not None:
+            # 首个可听见样本在 Twilio 端的播出时刻，相对用户说完（没有则相对回复开始）
+            reference = session.get("speech_stopped_at") or self.shaper.started_at
+            first_audible_ms = (play_at - reference) * 1000 + self.shaper.first_audible_ms
+            session["first_audible_ms"] = first_audible_ms
+            self.shaper.observe_first_audible(first_audible_ms)
+        if session["recording"]:
+            session["recording"].write_outbound(mulaw_data)
+
+        # 发送给 Twilio (base64 编码)
+        stream_sid = session.get("stream_sid")
+        if stream_sid:
+            await self.send_twilio(media_message(stream_sid, mulaw_data))
+
+    def on_assistant_transcript(self, data: dict):
+        transcript = data.get("transcript", "")
+        logger.info(f"[{self.call_sid}] AI 回复: {transcript}")
+        self.session["conversation"].add_assistant(transcript)
+        if self.services.transcript_store:
+            extra = {}
+            if self.session.get("first_audible_ms") is not None:
+                extra["first_audible_ms"] = round(self.session["first_audible_ms"])
+            self.services.transcript_store.record(self.call_sid, "assistant", transcript,
+                                                  latency_ms=self.session.get("response_latency_ms"), **extra)
+        self.session["speech_stopped_at"] = None
+
+    def on_user_transcript(self, data: dict):
+        transcript = data.get("transcript", "")
+        logger.info(f"[{self.call_sid}] 用户说: {transcript}")
+        self.session["conversation"].add_user(transcript)
+        if self.services.transcript_store:
+            self.services.transcript_store.record(self.call_sid, "user", transcript)
+
+    def on_error(self, data: dict):
+        logger.error(f"[{self.call_sid}] OpenAI 错误: {data.get('error', {})}")
+
+    # ==================== 问候语与素材播放 ====================
+
+    async def play_greeting(self):
+        """
+        媒体流一启动就播放问候语，不等待 OpenAI 握手
+        命中缓存时直接从 mmap 推送给 Twilio，并把已说内容告知 OpenAI 会话；
+        未命中时让模型现场说出问候语，同时在后台合成缓存供后续通话使用。
+        发给模型的事件在握手完成前先缓冲（send_openai / send_item），连接就绪后补发
+        """
+        session = self.session
+        services = self.services
+        greeting = session["greeting"]
+        audio = None
+        if services.greeting_cache:
+            audio = services.greeting_cache.get(self.speech_key(greeting))
+
+        await session["stream_ready"].wait()
+        stream_sid = session["stream_sid"]
+
+        if audio is None:
+            if services.greeting_cache:
+                self.render_speech(greeting)
+            await self.send_openai(json.dumps({
+                "type": "response.create",
+                "response": {"instructions": f"逐字朗读以下问候语，不要添加任何内容：{greeting}"}
+            }))
+            return
+
+        if session["recording"]:
+            session["recording"].write_outbound(audio)
+
+        first_frame = True
+        for frame in iter_frames(audio):
+            await self.send_twilio(media_message(stream_sid, frame))
+            if first_frame:
+                first_frame = False
+                elapsed_ms = (time.monotonic() - session["stream_started_at"]) * 1000
+                logger.info(f"[{self.call_sid}] 🔊 问候语首帧已发送 ({elapsed_ms:.1f} ms)")
+
+        # 告知模型问候语已经说过，避免重复
+        await self.send_item({
+            "type": "conversation.item.create",
+            "item": {
+                "type": "message",
+                "role": "assistant",
+                "content": [{"type": "text", "text": greeting}]
+            }
+        }, lambda: session["conversation"].add_assistant(greeting))
+
+    async def asset_sender(self, playback):
+        """
+        按实时节奏推送素材帧，Twilio 端最多预先缓冲 ASSET_PLAYOUT_LEAD 秒，
+        这样停止播放时只需清掉很短的缓冲；模型说话期间暂停推送
+        """
+        session = self.session
+        await session["stream_ready"].wait()
+        stream_sid = session["stream_sid"]
+        asset_until = time.monotonic()
+
+        try:
+            while session.get("asset_playback") is playback:
+                now = time.monotonic()
+                if session["model_audio_until"] > now:
+                    # mix 模式下素材随模型音频一起发出
+                    asset_until = session["model_audio_until"]
+                else:
+                    asset_until = max(asset_until, now)
+                    while asset_until < now + ASSET_PLAYOUT_LEAD:
+                        frame = playback.next_frame()
+                        if frame is None:
+                            return
+                        await self.send_twilio(media_message(stream_sid, frame))
+                        if session["recording"]:
+                            session["recording"].write_outbound(frame)
+                        asset_until += FRAME_SECONDS
+                await asyncio.sleep(ASSET_PLAYOUT_LEAD / 2)
+        finally:
+            if session.get("asset_playback") is playback:
+                session["asset_playback"] = None
+
+    def start_asset_playback(self, name: str, loop: bool = False, mode: str = "interleave") -> bool:
+        """开始播放素材，替换正在播放的素材"""
+        audio_assets = self.services.audio_assets
+        playback = audio_assets.playback(name, loop=loop, mode=mode) if audio_assets else None
+        if not playback:
+            return False
+        self.start_playback(playback)
+        return True
+
+    def start_playback(self, playback):
+        """播放一个已创建的 AssetPlayback，替换正在播放的素材"""
+        self.session["asset_playback"] = playback
+        asyncio.create_task(self.asset_sender(playback))
+        logger.info(f"[{self.call_sid}] 🎵 开始播放素材: {playback.asset.name} "
+                    f"({playback.mode}{', 循环' if playback.loop else ''})")
+
+    async def stop_asset_playback(self, clear: bool = True):
+        """停止素材播放，并清掉 Twilio 端已缓冲的素材音频"""
+        session = self.session
+        if not session.get("asset_playback"):
+            return
+        session["asset_playback"] = None
+        if clear and session.get("stream_sid"):
+            await self.send_twilio({"event": "clear", "streamSid": session["stream_sid"]})
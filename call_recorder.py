@@ -0,0 +1,370 @@
+"""
+流式通话录音
+把来电方（左声道）和 AI（右声道）两路 μ-law 音频录成立体声 WAV。
+音频循环只往每通电话的内存缓冲追加数据，磁盘写入全部由后台写线程完成：
+按时间线对齐两路音频、合并成大块顺序写入，并在每次写入后更新 WAV 头，
+即使进程崩溃，文件头也与已落盘的数据一致。
+"""
+
+import os
+import time
+import struct
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+RECORDING_ENABLED = os.getenv("RECORDING_ENABLED", "false").lower() == "true"
+RECORDINGS_DIR = os.getenv("RECORDINGS_DIR", "recordings")
+RECORDING_FSYNC = os.getenv("RECORDING_FSYNC", "interval")  # always / interval / close
+RECORDING_FSYNC_INTERVAL = float(os.getenv("RECORDING_FSYNC_INTERVAL", "5"))
+RECORDING_MAX_FILE_BYTES = int(os.getenv("RECORDING_MAX_FILE_MB", "100")) * 1024 * 1024
+
+SAMPLE_RATE = 8000
+MULAW_SILENCE = 0xFF
+
+# 每通电话每路最多缓冲的音频（字节），超出时丢弃数据而不是阻塞音频循环（见 _Leg）
+MAX_BUFFER_BYTES = SAMPLE_RATE * 30
+# 攒够这么多立体声数据再写盘，保证大块顺序写
+MIN_WRITE_BYTES = 64 * 1024
+# 数据在内存中最多停留的时间（秒）
+MAX_WRITE_DELAY = 2.0
+
+# WAV 头偏移：RIFF 大小、fact 采样数、data 大小
+WAV_HEADER_BYTES = 58
+RIFF_SIZE_OFFSET = 4
+FACT_SAMPLES_OFFSET = 46
+DATA_SIZE_OFFSET = 54
+
+
+def wav_header(data_bytes: int = 0) -> bytes:
+    """立体声 8kHz μ-law WAV 头（格式码 7，含 fact 块）"""
+    channels = 2
+    return (
+        b"RIFF" + struct.pack("<I", WAV_HEADER_BYTES - 8 + data_bytes) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHHH", 18, 7, channels, SAMPLE_RATE,
+                                SAMPLE_RATE * channels, channels, 8, 0)
+        + b"fact" + struct.pack("<II", 4, data_bytes // channels)
+        + b"data" + struct.pack("<I", data_bytes)
+    )
+
+
+def interleave(left: bytes, right: bytes) -> bytearray:
+    """把两路等长的单声道 μ-law 交织成立体声"""
+    if len(left) != len(right):
+        raise ValueError(f"legs differ in length: {len(left)} != {len(right)}")
+    stereo = bytearray(len(left) * 2)
+    stereo[0::2] = left
+    stereo[1::2] = right
+    return stereo
+
+
+class _Leg:
+    """
+    一路音频的缓冲，base 是缓冲首字节在通话时间线上的采样位置，end 是已排布音频的结束位置
+    缓冲超过 MAX_BUFFER_BYTES 时：drop_oldest 为 True 丢弃最旧的数据（来电方，写线程停滞时），
+    否则丢弃放不下的新数据（AI 方，成批到达的音频尚未播放，不能从头部丢）
+    """
+
+    def __init__(self, drop_oldest: bool = False):
+        self.buffer = bytearray()
+        self.base = 0
+        self.end = 0
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+
+    def write_at(self, position: int, audio: bytes):
+        buffer_end = self.base + len(self.buffer)
+        position = max(position, buffer_end)
+        data = bytes([MULAW_SILENCE]) * (position - buffer_end) + audio
+        self.end = max(self.end, position + len(audio))
+        if not self.drop_oldest:
+            room = max(MAX_BUFFER_BYTES - len(self.buffer), 0)
+            if len(data) > room:
+                self.dropped += len(data) - room
+                data = data[:room]
+        self.buffer.extend(data)
+        overflow = len(self.buffer) - MAX_BUFFER_BYTES
+        if overflow > 0:
+            del self.buffer[:overflow]
+            self.base += overflow
+            self.dropped += overflow
+
+    def take(self, start: int, until: int) -> bytes:
+        """取出时间线 [start, until) 的音频，恰好 until - start 字节：缺失的部分（已丢弃或尚未到达）用静音补齐"""
+        count = until - start
+        if count <= 0:
+            return b""
+        if self.base < start:
+            # 早于 start 的数据已经写过盘
+            del self.buffer[:start - self.base]
+            self.base = start
+        lead = min(self.base - start, count)
+        taken = min(count - lead, len(self.buffer))
+        chunk = bytes([MULAW_SILENCE]) * lead + bytes(self.buffer[:taken])
+        del self.buffer[:taken]
+        self.base += taken
+        if not self.buffer:
+            # base 只前进不后退
+            self.base = max(self.base, until)
+        return chunk + bytes([MULAW_SILENCE]) * (count - len(chunk))
+
+
+class CallRecording:
+    """
+    单通电话的录音
+    write_inbound / write_outbound 在音频循环中调用，只做内存追加
+    """
+
+    def __init__(self, recorder: "CallRecorder", call_sid: str):
+        self.recorder = recorder
+        self.call_sid = call_sid
+        self.started = time.monotonic()
+        self.inbound = _Leg(drop_oldest=True)
+        self.outbound = _Leg()
+        self.inbound_started = False
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # 以下字段只由写线程访问
+        self.flushed = 0  # 已写盘的时间线位置（采样）
+        self.part = 0
+        self.file = None
+        self.path: Optional[str] = None
+        self.data_bytes = 0
+        self.last_write = time.monotonic()
+        self.last_fsync = time.monotonic()
+
+    def _now_position(self) -> int:
+        return int((time.monotonic() - self.started) * SAMPLE_RATE)
+
+    def write_inbound(self, mulaw: bytes):
+        """来电方音频按实时节奏到达：第一帧放在实际到达的时刻，之后顺序追加"""
+        with self.lock:
+            if not self.inbound_started:
+                self.inbound_started = True
+                self.inbound.write_at(max(self._now_position() - len(mulaw), self.flushed), mulaw)
+            else:
+                self.inbound.write_at(self.inbound.end, mulaw)
+
+    def write_outbound(self, mulaw: bytes):
+        """AI 音频成批到达，从当前时刻或上一段播放结束处开始排布"""
+        with self.lock:
+            position = max(self.outbound.end, self._now_position(), self.flushed)
+            self.outbound.write_at(position, mulaw)
+
+    def close(self):
+        self.closed = True
+        self.recorder.wake()
+
+    def drain(self, final: bool = False) -> Optional[bytearray]:
+        """取出可以写盘的立体声数据（由写线程调用）"""
+        with self.lock:
+            until = self.inbound.end if not final else max(self.inbound.end, self.outbound.end)
+            until = min(until, self._now_position()) if not final else until
+            if until <= self.flushed:
+                return None
+            pending = (until - self.flushed) * 2
+            if not final and pending < MIN_WRITE_BYTES and time.monotonic() - self.last_write < MAX_WRITE_DELAY:
+                return None
+            left = self.inbound.take(self.flushed, until)
+            right = self.outbound.take(self.flushed, until)
+            self.flushed = until
+        return interleave(left, right)
+
+    @property
+    def dropped_bytes(self) -> int:
+        return self.inbound.dropped + self.outbound.dropped
+
+
+class CallRecorder:
+    """
+    进程级录音服务：一个后台写线程负责所有通话的落盘、fsync 和分卷
+    """
+
+    def __init__(
+        self,
+        directory: str = RECORDINGS_DIR,
+        fsync: str = RECORDING_FSYNC,
+        fsync_interval: float = RECORDING_FSYNC_INTERVAL,
+        max_file_bytes: int = RECORDING_MAX_FILE_BYTES,
+        flush_interval: float = 0.5,
+    ):
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_file_bytes = max_file_bytes
+        self.flush_interval = flush_interval
+        self.recordings: Dict[str, CallRecording] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.bytes_written = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="call-recorder", daemon=True)
+        self._thread.start()
+
+    def open(self, call_sid: str) -> CallRecording:
+        recording = CallRecording(self, call_sid)
+        with self._lock:
+            self.recordings[call_sid] = recording
+        logger.info(f"[{call_sid}] 🎙️ 开始录音")
+        return recording
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        """写完所有缓冲后停止写线程"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=10)
+
+    # ==================== 写线程 ====================
+
+    def _run(self):
+        while True:
+            stopping = self._stop.is_set()
+            with self._lock:
+                recordings = list(self.recordings.values())
+
+            for recording in recordings:
+                final = recording.closed or stopping
+                try:
+                    self._flush(recording, final)
+                except Exception as e:
+                    # 一通电话出错只结束它自己的录音，写线程继续服务其他通话
+                    logger.error(f"[{recording.call_sid}] ❌ 录音写入失败: {e!r}")
+                    final = True
+                if final:
+                    self._finalize(recording)
+                    with self._lock:
+                        self.recordings.pop(recording.call_sid, None)
+
+            if stopping:
+                break
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+    def _open_part(self, recording: CallRecording):
+        suffix = f"-{recording.part}" if recording.part else ""
+        recording.path = os.path.join(self.directory, f"{recording.call_sid}{suffix}.wav")
+        recording.file = open(recording.path, "wb", buffering=0)
+        recording.file.write(wav_header())
+        recording.data_bytes = 0
+
+    def _flush(self, recording: CallRecording, final: bool):
+        stereo = recording.drain(final)
+        if not stereo:
+            return
+
+        offset = 0
+        while offset < len(stereo):
+            if recording.file is None:
+                self._open_part(recording)
+            room = self.max_file_bytes - recording.data_bytes
+            chunk = memoryview(stereo)[offset:offset + room]
+            fd = recording.file.fileno()
+            os.pwrite(fd, chunk, WAV_HEADER_BYTES + recording.data_bytes)
+            recording.data_bytes += len(chunk)
+            offset += len(chunk)
+            self.bytes_written += len(chunk)
+            self._update_header(recording)
+
+            if recording.data_bytes >= self.max_file_bytes:
+                # 分卷：当前文件写满后切换到下一个文件
+                self._close_part(recording)
+                recording.part += 1
+
+        recording.last_write = time.monotonic()
+        if recording.file and (
+            self.fsync == "always"
+            or (self.fsync == "interval" and time.monotonic() - recording.last_fsync >= self.fsync_interval)
+        ):
+            os.fsync(recording.file.fileno())
+            recording.last_fsync = time.monotonic()
+
+    def _update_header(self, recording: CallRecording):
+        """每次写入后更新头部长度字段，崩溃后文件依然可以播放"""
+        fd = recording.file.fileno()
+        size = recording.data_bytes
+        os.pwrite(fd, struct.pack("<I", WAV_HEADER_BYTES - 8 + size), RIFF_SIZE_OFFSET)
+        os.pwrite(fd, struct.pack("<I", size // 2), FACT_SAMPLES_OFFSET)
+        os.pwrite(fd, struct.pack("<I", size), DATA_SIZE_OFFSET)
+
+    def _close_part(self, recording: CallRecording):
+        if recording.file is None:
+            return
+        if self.fsync != "never":
+            os.fsync(recording.file.fileno())
+        recording.file.close()
+        recording.file = None
+
+    def _finalize(self, recording: CallRecording):
+        try:
+            self._close_part(recording)
+        except Exception as e:
+            logger.error(f"[{recording.call_sid}] ❌ 录音关闭失败: {e}")
+        if recording.dropped_bytes:
+            logger.warning(f"[{recording.call_sid}] ⚠️ 录音缓冲溢出，丢弃 {recording.dropped_bytes} 字节")
+        logger.info(f"[{recording.call_sid}] 💾 录音已保存: {recording.path}")
+
+
+if __name__ == "__main__":
+    # 基准测试：500 路并发录音时音频循环每帧增加的耗时
+    import asyncio
+    import tempfile
+    import statistics
+
+    CALLS = 500
+    SECONDS = 10
+
+    async def simulate_call(recording: Optional[CallRecording], samples: list):
+        frame = bytes(160)
+        next_tick = time.monotonic()
+        for i in range(SECONDS * 50):
+            started = time.perf_counter()
+            if recording:
+                recording.write_inbound(frame)
+                if i % 10 == 0:
+                    recording.write_outbound(frame * 10)
+            samples.append((time.perf_counter() - started) * 1e6)
+            next_tick += 0.02
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+
+    async def measure_lag(lags: list, done: asyncio.Event):
+        while not done.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(0.01)
+            lags.append((time.monotonic() - started - 0.01) * 1000)
+
+    async def run(recorder: Optional[CallRecorder]):
+        samples, lags = [], []
+        done = asyncio.Event()
+        lag_task = asyncio.create_task(measure_lag(lags, done))
+        recordings = [recorder.open(f"CA{i:032d}") if recorder else None for i in range(CALLS)]
+        await asyncio.gather(*(simulate_call(r, samples) for r in recordings))
+        done.set()
+        await lag_task
+        for recording in recordings:
+            if recording:
+                recording.close()
+        samples.sort()
+        lags.sort()
+        return samples, lags
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        print("=" * 60)
+        print(f"📊 录音基准测试：{CALLS} 路并发，每路 {SECONDS} 秒")
+        print("=" * 60)
+        for label, recorder in (("不录音", None), ("录音", CallRecorder(directory, fsync="interval"))):
+            samples, lags = asyncio.run(run(recorder))
+            if recorder:
+                recorder.stop()
+            print(f"{label}: 每帧 p50 {statistics.median(samples):.2f} µs, p99 {samples[int(len(samples) * 0.99)]:.2f} µs; "
+                  f"事件循环延迟 p99 {lags[int(len(lags) * 0.99)]:.2f} ms")
+        total = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+        print(f"写入 {len(os.listdir(directory))} 个文件，共 {total / 1024 / 1024:.1f} MiB")
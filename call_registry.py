@@ -0,0 +1,96 @@
+"""
+多 worker 通话登记
+多个 worker 通过 SO_REUSEPORT 共享端口时，同一通话的 HTTP 请求可能落到任意 worker。
+持有媒体流的 worker 在共享目录中登记 CallSid → 本机控制端口，
+其他 worker 收到该通话的控制请求时据此转发，通话状态始终只保存在一个进程中。
+
+来电和外呼在拨号阶段占用的准入/租户名额同样登记占用方，
+媒体流落到另一个 worker 时，由接起的 worker 通知占用方释放。
+"""
+
+import os
+import re
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# 由 serve.py 为每个 worker 设置；单进程运行时为空，登记功能关闭
+CALL_REGISTRY_DIR = os.getenv("CALL_REGISTRY_DIR")
+WORKER_INTERNAL_PORT = int(os.getenv("WORKER_INTERNAL_PORT", "0"))
+
+_CALL_SID_RE = re.compile(r"[\w-]+")
+# 名额占用方的登记文件后缀
+RESERVATION_SUFFIX = ".reserved"
+
+
+class CallRegistry:
+    """以目录中的小文件保存 CallSid → worker 控制端口"""
+
+    def __init__(self, directory: str, port: int):
+        self.directory = directory
+        self.port = port
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, call_sid: str, suffix: str = "") -> Optional[str]:
+        if not _CALL_SID_RE.fullmatch(call_sid or ""):
+            return None
+        return os.path.join(self.directory, call_sid + suffix)
+
+    def _write(self, path: Optional[str]):
+        if not path:
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(self.port))
+        os.replace(tmp_path, path)
+
+    def _remove(self, path: Optional[str], owner: Optional[int] = None):
+        if not path:
+            return
+        try:
+            # 只删除自己（或指定 worker）登记的条目
+            if self._read(path) == (owner or self.port):
+                os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _read(path: Optional[str]) -> Optional[int]:
+        if not path:
+            return None
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def register(self, call_sid: str):
+        self._write(self._path(call_sid))
+
+    def unregister(self, call_sid: str):
+        self._remove(self._path(call_sid))
+
+    def lookup(self, call_sid: str) -> Optional[int]:
+        return self._read(self._path(call_sid))
+
+    def evict(self, call_sid: str, port: int):
+        """移除已退出的 worker 留下的登记（崩溃时来不及注销）"""
+        self._remove(self._path(call_sid), owner=port)
+
+    def reserve(self, call_sid: str):
+        """登记本 worker 为该通话占用了名额"""
+        self._write(self._path(call_sid, RESERVATION_SUFFIX))
+
+    def release_reservation(self, call_sid: str):
+        self._remove(self._path(call_sid, RESERVATION_SUFFIX))
+
+    def reservation_owner(self, call_sid: str) -> Optional[int]:
+        """占用该通话名额的 worker 的控制端口"""
+        return self._read(self._path(call_sid, RESERVATION_SUFFIX))
+
+
+def create_registry() -> Optional[CallRegistry]:
+    if CALL_REGISTRY_DIR and WORKER_INTERNAL_PORT:
+        return CallRegistry(CALL_REGISTRY_DIR, WORKER_INTERNAL_PORT)
+    return None
@@ -0,0 +1,323 @@
+"""
+来电路由
+按被叫号码、主叫号码前缀和时间段把来电分配到坐席配置（指令、语音、问候语、工具）。
+路由表是一个 JSON 文件，加载时编译成内存索引：
+- 被叫号码和主叫前缀都放进按数字逐位展开的前缀树，查找开销只与号码位数有关，与规则条数无关
+- 同一位置的多条规则按文件中的顺序检查时间段，第一条生效的规则胜出
+- 被叫号码匹配越长越优先，其次是主叫前缀越长越优先；都不匹配时使用 default 配置
+后台任务每 ROUTES_RELOAD_INTERVAL 秒检查一次文件修改时间，在线程中重新编译后整体替换，
+解析失败时保留旧路由表；编译大路由表不会卡住事件循环上的音频转发。
+每个配置的 TwiML 只生成一次，之后只替换其中的 CallSid。
+
+路由表格式：
+{
+    "timezone": "Asia/Shanghai",
+    "default": "support",
+    "profiles": {
+        "support": {"instructions": "...", "voice": "alloy", "greeting": "...", "tools": ["get_order_status"]},
+        "after_hours": {"instructions": "...", "greeting": "现在是非工作时间..."}
+    },
+    "routes": [
+        {"to": "+14155550100", "days": "mon-fri", "hours": "09:00-18:00", "profile": "support"},
+        {"to": "+14155550100", "profile": "after_hours"},
+        {"to": "+1415555", "from": "+86", "profile": "support_cn"}
+    ]
+}
+to / from 都按前缀匹配（完整号码是最长的前缀），只比较数字；hours 可以跨午夜（如 "22:00-06:00"）。
+"""
+
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROUTES_FILE = os.getenv("ROUTES_FILE", "routes.json")
+ROUTES_RELOAD_INTERVAL = float(os.getenv("ROUTES_RELOAD_INTERVAL", "2"))
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+# 生成 TwiML 时 CallSid 的占位符
+CALL_SID_PLACEHOLDER = "__CALL_SID__"
+
+
+def digits(number: Optional[str]) -> str:
+    """号码只保留数字，+86 138... 与 86138... 视为相同"""
+    return "".join(ch for ch in number or "" if ch.isdigit())
+
+
+def parse_days(spec) -> Optional[frozenset]:
+    """"mon-fri"、"sat,sun" 或列表 → 星期几（0=周一）的集合"""
+    if not spec:
+        return None
+    parts = spec if isinstance(spec, list) else spec.split(",")
+    days = set()
+    for part in parts:
+        part = part.strip().lower()
+        if "-" in part:
+            start, end = (DAYS.index(day[:3]) for day in part.split("-", 1))
+            days.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+        else:
+            days.add(DAYS.index(part[:3]))
+    return frozenset(days)
+
+
+def parse_hours(spec: Optional[str]) -> Optional[Tuple[int, int]]:
+    """"09:00-18:00" → (540, 1080)，单位为当天的分钟数"""
+    if not spec:
+        return None
+    start, end = spec.split("-", 1)
+
+    def minutes(value: str) -> int:
+        hour, minute = value.strip().split(":")
+        return int(hour) * 60 + int(minute)
+
+    return minutes(start), minutes(end)
+
+
+class Route:
+    __slots__ = ("profile", "days", "hours", "order")
+
+    def __init__(self, profile: str, days: Optional[frozenset], hours: Optional[Tuple[int, int]], order: int):
+        self.profile = profile
+        self.days = days
+        self.hours = hours
+        self.order = order
+
+    def active(self, weekday: int, minute: int) -> bool:
+        if self.days is not None and weekday not in self.days:
+            return False
+        if self.hours is not None:
+            start, end = self.hours
+            if start <= end:
+                return start <= minute < end
+            return minute >= start or minute < end  # 跨午夜
+        return True
+
+
+class TrieNode:
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children: Dict[str, "TrieNode"] = {}
+        self.value = None
+
+    def insert(self, key: str) -> "TrieNode":
+        node = self
+        for ch in key:
+            node = node.children.setdefault(ch, TrieNode())
+        return node
+
+    def path(self, key: str) -> List["TrieNode"]:
+        """沿 key 逐位向下，返回途经的带值节点，最长匹配在前"""
+        matched = [self] if self.value is not None else []
+        node = self
+        for ch in key:
+            node = node.children.get(ch)
+            if node is None:
+                break
+            if node.value is not None:
+                matched.append(node)
+        matched.reverse()
+        return matched
+
+
+class RoutingTable:
+    """编译后的路由表（只读），重新加载时整体替换"""
+
+    def __init__(self, config: dict):
+        self.profiles: Dict[str, dict] = config.get("profiles", {})
+        self.default: Optional[str] = config.get("default")
+        self.timezone = None
+        if config.get("timezone"):
+            from zoneinfo import ZoneInfo
+            self.timezone = ZoneInfo(config["timezone"])
+
+        # 被叫前缀树的每个节点挂一棵主叫前缀树，主叫节点上是按文件顺序排列的规则
+        self.index = TrieNode()
+        self.rules = 0
+        for order, rule in enumerate(config.get("routes", [])):
+            profile = rule["profile"]
+            if profile not in self.profiles:
+                raise ValueError(f"route {order}: unknown profile {profile!r}")
+            to_node = self.index.insert(digits(rule.get("to")))
+            if to_node.value is None:
+                to_node.value = TrieNode()
+            from_node = to_node.value.insert(digits(rule.get("from")))
+            if from_node.value is None:
+                from_node.value = []
+            from_node.value.append(Route(profile, parse_days(rule.get("days")), parse_hours(rule.get("hours")), order))
+            self.rules += 1
+        if self.default and self.default not in self.profiles:
+            raise ValueError(f"unknown default profile {self.default!r}")
+
+    def route(self, to: str, from_: str, now: Optional[datetime] = None) -> Optional[str]:
+        """返回配置名；没有规则生效且未配置 default 时返回 None"""
+        now = now or datetime.now(self.timezone)
+        weekday, minute = now.weekday(), now.hour * 60 + now.minute
+        caller = digits(from_)
+        for to_node in self.index.path(digits(to)):
+            for from_node in to_node.value.path(caller):
+                for route in from_node.value:
+                    if route.active(weekday, minute):
+                        return route.profile
+        return self.default
+
+
+class CallRouter:
+    """
+    从 ROUTES_FILE 加载路由表，start() 后文件修改时自动重新加载
+    路由文件不存在时所有来电使用默认配置
+    """
+
+    def __init__(self, path: str = ROUTES_FILE, reload_interval: float = ROUTES_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.table = RoutingTable({})
+        self.mtime: Optional[float] = None
+        self._twiml: Dict[str, Tuple[str, str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.reload()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            await asyncio.to_thread(self.reload)
+
+    def reload(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            if self.mtime is not None:
+                logger.warning(f"⚠️ 路由文件 {self.path} 已删除，改用默认配置")
+                self.table, self.mtime, self._twiml = RoutingTable({}), None, {}
+            return False
+        if mtime == self.mtime:
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                table = RoutingTable(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            # 保留旧路由表，修好文件后下次检查时再加载
+            logger.error(f"❌ 路由文件 {self.path} 加载失败，继续使用旧路由表: {e}")
+            self.mtime = mtime
+            return False
+        # 整体替换：进行中的查找仍使用旧表
+        self.table, self.mtime, self._twiml = table, mtime, {}
+        logger.info(f"🧭 已加载路由表: {len(table.profiles)} 个配置，{table.rules} 条规则")
+        return True
+
+    def route(self, to: str, from_: str, now: Optional[datetime] = None) -> Tuple[Optional[str], Optional[dict]]:
+        """返回 (配置名, 配置)；没有匹配的配置时为 (None, None)"""
+        table = self.table
+        name = table.route(to, from_, now)
+        return name, table.profiles.get(name) if name else None
+
+    def profile(self, name: Optional[str]) -> Optional[dict]:
+        return self.table.profiles.get(name) if name else None
+
+    def twiml(self, name: str, call_sid: str, build: Callable[[str], str]) -> str:
+        """
+        每个配置的 TwiML 只生成一次：build(call_sid) 以占位符生成完整 TwiML，
+        缓存占位符前后两段，之后每通来电只做一次拼接
+        """
+        parts = self._twiml.get(name)
+        if parts is None:
+            head, _, tail = build(CALL_SID_PLACEHOLDER).partition(CALL_SID_PLACEHOLDER)
+            parts = self._twiml[name] = (head, tail)
+        return parts[0] + call_sid + parts[1]
+
+
+if __name__ == "__main__":
+    # 大路由表的查找开销：前缀树 vs 逐条扫描规则
+    import time
+    import random
+    import statistics
+    import tempfile
+
+    rng = random.Random(3)
+    NUMBERS = 5000
+    CALLER_PREFIXES = 1000
+
+    profiles = {f"agent_{index}": {"instructions": f"坐席 {index}"} for index in range(50)}
+    profiles["after_hours"] = {"instructions": "非工作时间"}
+    numbers = [f"+1415{rng.randrange(10 ** 7):07d}" for _ in range(NUMBERS)]
+    prefixes = [f"+{rng.randrange(1, 999)}{rng.randrange(1000):03d}" for _ in range(CALLER_PREFIXES)]
+    routes = []
+    for number in numbers:
+        routes.append({"to": number, "days": "mon-fri", "hours": "09:00-18:00", "profile": rng.choice(list(profiles))})
+        routes.append({"to": number, "profile": "after_hours"})
+    for prefix in prefixes:
+        routes.append({"from": prefix, "profile": rng.choice(list(profiles))})
+    config = {"timezone": "Asia/Shanghai", "default": "agent_0", "profiles": profiles, "routes": routes}
+
+    path = os.path.join(tempfile.mkdtemp(prefix="routes-"), "routes.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    started = time.perf_counter()
+    router = CallRouter(path)
+    print(f"{len(routes)} 条规则，编译耗时 {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    compiled = [(digits(rule.get("to")), digits(rule.get("from")),
+                 Route(rule["profile"], parse_days(rule.get("days")), parse_hours(rule.get("hours")), order))
+                for order, rule in enumerate(routes)]
+
+    def linear_route(to: str, from_: str, now: datetime) -> str:
+        """逐条扫描（规则已预先解析）：取被叫、主叫前缀匹配最长且时间段生效的规则"""
+        weekday, minute = now.weekday(), now.hour * 60 + now.minute
+        to, from_ = digits(to), digits(from_)
+        best, best_key = None, None
+        for to_prefix, from_prefix, route in compiled:
+            if not to.startswith(to_prefix) or not from_.startswith(from_prefix):
+                continue
+            key = (-len(to_prefix), -len(from_prefix), route.order)
+            if route.active(weekday, minute) and (best_key is None or key < best_key):
+                best, best_key = route.profile, key
+        return best or config["default"]
+
+    workday = datetime(2024, 5, 6, 10, 30)
+    night = datetime(2024, 5, 6, 23, 0)
+    calls = [(rng.choice(numbers), rng.choice(prefixes) + f"{rng.randrange(10 ** 6):06d}", rng.choice([workday, night]))
+             for _ in range(200)]
+    calls += [("+8610" + f"{rng.randrange(10 ** 8):08d}", "+100", workday) for _ in range(50)]
+
+    for to, from_, now in calls[:100]:
+        assert router.route(to, from_, now)[0] == linear_route(to, from_, now), (to, from_, now)
+
+    def bench(fn, rounds: int) -> float:
+        samples = []
+        for _ in range(rounds):
+            for to, from_, now in calls:
+                started = time.perf_counter()
+                fn(to, from_, now)
+                samples.append((time.perf_counter() - started) * 1e6)
+        return statistics.median(samples)
+
+    print(f"单次路由（µs，中位数）: 前缀树 {bench(lambda *args: router.route(*args), 20):.1f}，"
+          f"逐条扫描 {bench(linear_route, 1):.0f}（{len(routes)} 条规则）")
+
+    build_calls = []
+
+    def build(call_sid: str) -> str:
+        build_calls.append(call_sid)
+        return f'<Response><Connect><Stream url="wss://example/media-stream?call_sid={call_sid}&amp;profile=x"/></Connect></Response>'
+
+    started = time.perf_counter()
+    for index in range(10000):
+        router.twiml("agent_1", f"CA{index:032d}", build)
+    print(f"TwiML（缓存）: {(time.perf_counter() - started) * 1e6 / 10000:.2f} µs/次，生成 {len(build_calls)} 次")
@@ -0,0 +1,289 @@
+"""
+长通话上下文窗口管理
+根据 conversation.item.* 事件跟踪会话中的条目，用 response.done 中的 usage 估算每个条目占用的 token，
+上下文超过预算时用 conversation.item.delete 删除最早的条目，并在开头插入滚动摘要，
+让长通话的首包延迟和费用保持平稳。也可以改用服务端截断（truncation）。
+"""
+
+import os
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_STRATEGY = os.getenv("CONTEXT_STRATEGY", "summary")  # summary / truncation / none
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "16000"))
+CONTEXT_TARGET_RATIO = float(os.getenv("CONTEXT_TARGET_RATIO", "0.6"))  # 裁剪后保留的比例
+CONTEXT_KEEP_RECENT = int(os.getenv("CONTEXT_KEEP_RECENT", "6"))  # 至少保留的最近条目数
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "2000"))
+
+SUMMARY_PREFIX = "此前对话摘要："
+# 摘要中每条发言保留的字符数
+SUMMARY_TURN_CHARS = 80
+
+
+def truncation_config(budget: int = CONTEXT_TOKEN_BUDGET, ratio: float = CONTEXT_TARGET_RATIO) -> dict:
+    """服务端截断配置，写入 session.update 的 session.truncation"""
+    return {
+        "type": "retention_ratio",
+        "retention_ratio": ratio,
+        "token_limits": {"post_instructions": budget}
+    }
+
+
+def item_text(item: dict) -> str:
+    """提取条目中的文本或转录"""
+    if item.get("type") == "function_call":
+        return f"{item.get('name', '')}({item.get('arguments', '')})"
+    if item.get("type") == "function_call_output":
+        return item.get("output") or ""
+    parts = []
+    for part in item.get("content") or []:
+        text = part.get("text") or part.get("transcript")
+        if text:
+            parts.append(text)
+    return " ".join(parts)
+
+
+class ContextWindowManager:
+    """
+    单通电话的上下文窗口
+
+    on_event() 接收 EVENT_TYPES 中的 OpenAI 事件，需要裁剪时返回待发送的
+    conversation.item.delete / conversation.item.create 事件列表
+    """
+
+    EVENT_TYPES = (
+        "conversation.item.created",
+        "conversation.item.added",
+        "conversation.item.deleted",
+        "conversation.item.input_audio_transcription.completed",
+        "response.audio_transcript.done",
+        "response.output_audio_transcript.done",
+        "response.done",
+    )
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, target_ratio: float = CONTEXT_TARGET_RATIO,
+                 keep_recent: int = CONTEXT_KEEP_RECENT, summary_max_chars: int = SUMMARY_MAX_CHARS):
+        self.budget = budget
+        self.target_ratio = target_ratio
+        self.keep_recent = keep_recent
+        self.summary_max_chars = summary_max_chars
+        self.reset()
+
+    def reset(self):
+        """重连后新会话从空上下文开始"""
+        self.items: OrderedDict = OrderedDict()  # item_id → {"type", "role", "text", "tokens"}
+        self.context_tokens = 0  # 最近一次响应后的上下文总 token 数
+        self.summary_id: Optional[str] = None
+        self.summary_text = ""
+        self.trims = 0
+        self._pending_deletes = set()
+
+    def on_event(self, data: dict) -> List[dict]:
+        event_type = data.get("type")
+        if event_type in ("conversation.item.created", "conversation.item.added"):
+            self._add(data.get("item") or {})
+        elif event_type == "conversation.item.deleted":
+            self._remove(data.get("item_id"))
+        elif event_type == "conversation.item.input_audio_transcription.completed":
+            self._set_text(data.get("item_id"), data.get("transcript"))
+        elif event_type in ("response.audio_transcript.done", "response.output_audio_transcript.done"):
+            self._set_text(data.get("item_id"), data.get("transcript"))
+        elif event_type == "response.done":
+            self._account(data.get("response") or {})
+            if self.context_tokens > self.budget:
+                return self._trim()
+        return []
+
+    def _add(self, item: dict):
+        item_id = item.get("id")
+        if not item_id or item_id in self.items:
+            return
+        self.items[item_id] = {
+            "type": item.get("type"),
+            "role": item.get("role"),
+            "call_id": item.get("call_id"),
+            "text": item_text(item),
+            "tokens": 0,
+        }
+        if item_id == self.summary_id:
+            # 摘要插在会话开头
+            self.items.move_to_end(item_id, last=False)
+
+    def _remove(self, item_id: Optional[str]):
+        entry = self.items.pop(item_id, None)
+        self._pending_deletes.discard(item_id)
+        if entry:
+            self.context_tokens = max(0, self.context_tokens - entry["tokens"])
+
+    def _set_text(self, item_id: Optional[str], text: Optional[str]):
+        entry = self.items.get(item_id)
+        if entry and text:
+            entry["text"] = text
+
+    def _account(self, response: dict):
+        """把本轮 usage 分摊到新条目：输入增量给新加入的条目，输出给本轮生成的条目"""
+        usage = response.get("usage")
+        if not usage:
+            return
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        output_ids = [item.get("id") for item in response.get("output") or [] if item.get("id") in self.items]
+
+        new_ids = [item_id for item_id, entry in self.items.items()
+                   if entry["tokens"] == 0 and item_id not in output_ids]
+        new_input = max(0, input_tokens - self.context_tokens)
+        for item_id in new_ids:
+            self.items[item_id]["tokens"] = max(1, new_input // len(new_ids))
+        for item_id in output_ids:
+            self.items[item_id]["tokens"] = max(1, output_tokens // len(output_ids))
+
+        self.context_tokens = input_tokens + output_tokens
+
+    def _trim(self) -> List[dict]:
+        """删除最早的条目直到降到目标值，被删内容并入滚动摘要"""
+        target = int(self.budget * self.target_ratio)
+        candidates = [item_id for item_id in self.items if item_id not in self._pending_deletes]
+        removable = candidates[:max(0, len(candidates) - self.keep_recent)]
+
+        selected, freed = [], 0
+        for item_id in removable:
+            entry = self.items[item_id]
+            # 函数调用的输出跟随调用一起删除，不单独留下
+            if self.context_tokens - freed <= target and entry["type"] != "function_call_output":
+                break
+            selected.append(item_id)
+            freed += entry["tokens"]
+        if not selected:
+            return []
+
+        lines = [self.summary_text] if self.summary_text else []
+        for item_id in selected:
+            entry = self.items[item_id]
+            if item_id == self.summary_id or not entry["text"]:
+                continue
+            speaker = {"user": "用户", "assistant": "助手"}.get(entry["role"], "工具")
+            lines.append(f"{speaker}: {entry['text'][:SUMMARY_TURN_CHARS]}")
+        # 摘要超长时保留最近的部分
+        self.summary_text = "\n".join(lines)[-self.summary_max_chars:]
+
+        events = [{"type": "conversation.item.delete", "item_id": item_id} for item_id in selected]
+        if self.summary_id not in selected and self.summary_id in self.items:
+            events.append({"type": "conversation.item.delete", "item_id": self.summary_id})
+            selected.append(self.summary_id)
+        self._pending_deletes.update(selected)
+
+        self.trims += 1
+        self.summary_id = f"summary_{self.trims}"
+        events.append({
+            "type": "conversation.item.create",
+            "previous_item_id": "root",
+            "item": {
+                "id": self.summary_id,
+                "type": "message",
+                "role": "system",
+                "content": [{"type": "input_text", "text": f"{SUMMARY_PREFIX}\n{self.summary_text}"}]
+            }
+        })
+        logger.info(f"✂️ 上下文 {self.context_tokens} tokens 超出预算 {self.budget}，"
+                    f"删除 {len(selected)} 个条目（约 {freed} tokens）并更新摘要")
+        return events
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self.items),
+            "context_tokens": self.context_tokens,
+            "budget": self.budget,
+            "trims": self.trims,
+        }
+
+
+if __name__ == "__main__":
+    # 长通话模拟：服务端按上下文长度计费，首包延迟随输入 token 线性增长
+    import json
+    import random
+
+    BASE_LATENCY_MS = 300
+    LATENCY_PER_1K_TOKENS_MS = 25
+    INSTRUCTION_TOKENS = 600
+    random.seed(7)
+
+    class SimulatedConversation:
+        """按协议语义处理 item.create / item.delete 的简化服务端"""
+
+        def __init__(self):
+            self.items = OrderedDict()  # item_id → tokens
+            self.counter = 0
+
+        def _new_id(self):
+            self.counter += 1
+            return f"item_{self.counter}"
+
+        def handle(self, event: dict) -> List[dict]:
+            if event["type"] == "conversation.item.delete":
+                self.items.pop(event["item_id"], None)
+                return [{"type": "conversation.item.deleted", "item_id": event["item_id"]}]
+            item = dict(event["item"])
+            item_id = item.get("id") or self._new_id()
+            item["id"] = item_id
+            tokens = len(item_text(item)) // 2 + 5
+            if event.get("previous_item_id") == "root":
+                self.items[item_id] = tokens
+                self.items.move_to_end(item_id, last=False)
+            else:
+                self.items[item_id] = tokens
+            return [{"type": "conversation.item.created", "item": item}]
+
+        def turn(self):
+            """一轮对话：用户语音 + 助手语音回复"""
+            user_id, assistant_id = self._new_id(), self._new_id()
+            user_tokens = random.randint(80, 200)  # 语音输入按时长计 token
+            self.items[user_id] = user_tokens
+            input_tokens = INSTRUCTION_TOKENS + sum(self.items.values())
+            latency_ms = BASE_LATENCY_MS + input_tokens / 1000 * LATENCY_PER_1K_TOKENS_MS
+            output_tokens = random.randint(150, 400)
+            self.items[assistant_id] = output_tokens
+            events = [
+                {"type": "conversation.item.created",
+                 "item": {"id": user_id, "type": "message", "role": "user", "content": [{"type": "input_audio"}]}},
+                {"type": "conversation.item.input_audio_transcription.completed",
+                 "item_id": user_id, "transcript": "我想查询一下上个月的账单明细，还有积分的使用情况"},
+                {"type": "conversation.item.created",
+                 "item": {"id": assistant_id, "type": "message", "role": "assistant", "content": [{"type": "audio"}]}},
+                {"type": "response.audio_transcript.done",
+                 "item_id": assistant_id, "transcript": "好的，您上个月共消费三笔，合计一百二十元，积分余额为八百分。"},
+                {"type": "response.done",
+                 "response": {"output": [{"id": assistant_id}],
+                              "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}}},
+            ]
+            return latency_ms, input_tokens, events
+
+    def simulate(turns: int, manager: Optional[ContextWindowManager]):
+        server = SimulatedConversation()
+        results = []
+        for _ in range(turns):
+            latency_ms, input_tokens, events = server.turn()
+            results.append((latency_ms, input_tokens))
+            queue = list(events)
+            while queue and manager:
+                for reply in manager.on_event(queue.pop(0)):
+                    json.dumps(reply)
+                    queue.extend(server.handle(reply))
+        return results
+
+    turns = 300
+    unmanaged = simulate(turns, None)
+    manager = ContextWindowManager(budget=8000)
+    managed = simulate(turns, manager)
+
+    print("=" * 72)
+    print(f"📊 长通话上下文模拟（{turns} 轮，预算 {manager.budget} tokens）")
+    print("=" * 72)
+    print(f"{'轮次':>6} | {'不管理: 延迟 ms':>16} {'输入 tokens':>12} | {'管理: 延迟 ms':>14} {'输入 tokens':>12}")
+    for turn in (1, 10, 30, 60, 100, 200, 300):
+        a, b = unmanaged[turn - 1], managed[turn - 1]
+        print(f"{turn:>6} | {a[0]:>16.0f} {a[1]:>12} | {b[0]:>14.0f} {b[1]:>12}")
+    print(f"累计输入 tokens: 不管理 {sum(r[1] for r in unmanaged)}, 管理 {sum(r[1] for r in managed)}")
+    print(f"管理器状态: {manager.stats()}")
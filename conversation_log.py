@@ -0,0 +1,255 @@
+"""
+本地对话日志
+为每通电话保存精简的对话条目（双方转录和函数调用结果），
+OpenAI WebSocket 断线重连后用 conversation.item.create 重放，
+让新会话接上原来的上下文。
+"""
+
+import json
+from collections import deque
+from typing import List
+
+# 重放的条目数和总字符数上限，保证恢复时间有界
+MAX_REPLAY_ITEMS = 50
+MAX_REPLAY_CHARS = 8000
+
+
+class ConversationLog:
+    """按时间顺序保存可重放的对话条目"""
+
+    def __init__(self, max_items: int = MAX_REPLAY_ITEMS, max_chars: int = MAX_REPLAY_CHARS):
+        self.max_chars = max_chars
+        self.items: deque = deque(maxlen=max_items)
+
+    def add_user(self, text: str):
+        if text:
+            self.items.append({"role": "user", "text": text})
+
+    def add_assistant(self, text: str):
+        if text:
+            self.items.append({"role": "assistant", "text": text})
+
+    def add_function_call(self, call_id: str, name: str, arguments: str, output: str):
+        self.items.append({
+            "role": "function",
+            "call_id": call_id,
+            "name": name,
+            "arguments": arguments,
+            "output": output,
+        })
+
+    def _recent_items(self) -> List[dict]:
+        """从最新的条目往回取，直到达到字符上限"""
+        selected, total = [], 0
+        for item in reversed(self.items):
+            size = len(item.get("text") or "") + len(item.get("arguments") or "") + len(item.get("output") or "")
+            if selected and total + size > self.max_chars:
+                break
+            selected.append(item)
+            total += size
+        selected.reverse()
+        return selected
+
+    def replay_events(self) -> List[dict]:
+        """生成重放用的 conversation.item.create 事件列表"""
+        events = []
+        for item in self._recent_items():
+            if item["role"] == "user":
+                events.append({"type": "message", "role": "user",
+                               "content": [{"type": "input_text", "text": item["text"]}]})
+            elif item["role"] == "assistant":
+                events.append({"type": "message", "role": "assistant",
+                               "content": [{"type": "text", "text": item["text"]}]})
+            else:
+                events.append({"type": "function_call", "call_id": item["call_id"],
+                               "name": item["name"], "arguments": item["arguments"]})
+                events.append({"type": "function_call_output", "call_id": item["call_id"],
+                               "output": item["output"]})
+        return [{"type": "conversation.item.create", "item": event} for event in events]
+
+    def replay_messages(self) -> List[str]:
+        return [json.dumps(event, ensure_ascii=False) for event in self.replay_events()]
+
+    def __len__(self):
+        return len(self.items)
+
+
+if __name__ == "__main__":
+    # 故障注入：模拟的 Realtime 服务在随机位置断开连接（正常关闭或直接中断 TCP），
+    # 验证 CallBridge.reconnect_openai 的重连、对话日志重放，以及函数调用结果不丢失、不重复
+    import os
+    import sys
+    import time
+    import random
+    import asyncio
+    import logging
+    import tempfile
+
+    import websockets
+
+    os.environ.setdefault("TRANSCRIPT_SINK", "none")
+    os.environ.setdefault("GREETING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "conversation-log-greetings"))
+
+    from call_bridge import BridgeServices, CallBridge
+    from tool_calls import ToolRegistry
+
+    logging.basicConfig(level=logging.ERROR)
+
+    DROP_PROBABILITY = 0.15
+    CALLS = 30
+    registry = ToolRegistry()
+
+    @registry.tool("lookup", "查询", {"type": "object", "properties": {"key": {"type": "string"}}}, cache_ttl=0)
+    async def lookup(key: str):
+        await asyncio.sleep(0.03)
+        return {"key": key, "value": key.upper()}
+
+    def script(rng: random.Random) -> list:
+        """一通电话的事件脚本：用户/模型转录和函数调用交替出现"""
+        steps = []
+        for turn in range(8):
+            steps.append(("user", f"用户第 {turn} 句"))
+            if rng.random() < 0.5:
+                steps.append(("tool", f"call_{turn}"))
+            steps.append(("assistant", f"模型第 {turn} 句"))
+        return steps
+
+    async def run_call(seed: int) -> dict:
+        rng = random.Random(seed)
+        steps = script(rng)
+        state = {"cursor": 0, "delivered": [], "issued": set(), "outputs": {}, "responses": set(), "connections": 0,
+                 "drops": 0, "replay_errors": 0, "duplicates": 0, "extra_responses": 0}
+        finished = asyncio.Event()
+
+        async def maybe_drop(ws) -> bool:
+            if rng.random() >= DROP_PROBABILITY:
+                return False
+            state["drops"] += 1
+            if rng.random() < 0.5:
+                await ws.close()
+            else:
+                # 让已发出的事件先到达客户端，再直接中断 TCP 连接
+                await asyncio.sleep(0.01)
+                ws.transport.abort()
+            return True
+
+        async def realtime(ws):
+            state["connections"] += 1
+            json.loads(await ws.recv())  # session.update
+            outputs = set()  # 本连接收到的函数结果（含重放）
+            replay = {"texts": [], "calls": set(), "done": state["connections"] == 1}
+
+            def finish_replay():
+                replay["done"] = True
+                if replay["texts"] != state["delivered"][-MAX_REPLAY_ITEMS:]:
+                    state["replay_errors"] += 1
+
+            async def receive(timeout: float):
+                """处理客户端发来的一个事件；response.create 记到当前等待结果的函数调用上"""
+                try:
+                    event = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+                except asyncio.TimeoutError:
+                    if not replay["done"]:
+                        finish_replay()
+                    return False
+                item = event.get("item") or {}
+                # 重放阶段：连续的消息和成对的 function_call/function_call_output；
+                # 单独的 function_call_output 是重连后才完成的函数结果
+                if not replay["done"] and not (
+                        item.get("type") in ("message", "function_call")
+                        or item.get("type") == "function_call_output" and item["call_id"] in replay["calls"]):
+                    finish_replay()
+                if item.get("type") == "message" and not replay["done"]:
+                    replay["texts"].append(item["content"][0]["text"])
+                elif item.get("type") == "function_call":
+                    replay["calls"].add(item["call_id"])
+                elif item.get("type") == "function_call_output":
+                    if item["call_id"] in outputs:
+                        state["duplicates"] += 1
+                    outputs.add(item["call_id"])
+                    state["outputs"][item["call_id"]] = item["output"]
+                if event["type"] == "response.create":
+                    kind, value = steps[state["cursor"]] if state["cursor"] < len(steps) else (None, None)
+                    if kind != "tool" or value not in state["outputs"] or value in state["responses"]:
+                        # 模型已经回复过，重复请求会让模型再说一遍
+                        state["extra_responses"] += 1
+                        return
+                    state["responses"].add(value)
+                    await ws.send(json.dumps({"type": "response.done",
+                                              "response": {"id": f"resp_{value}_reply", "output": []}}))
+
+            try:
+                while not replay["done"]:
+                    await receive(0.1)
+
+                while state["cursor"] < len(steps):
+                    kind, value = steps[state["cursor"]]
+                    if await maybe_drop(ws):
+                        return
+                    if kind == "user":
+                        await ws.send(json.dumps({"type": "conversation.item.input_audio_transcription.completed",
+                                                  "transcript": value}))
+                        state["delivered"].append(value)
+                    elif kind == "assistant":
+                        await ws.send(json.dumps({"type": "response.audio_transcript.done", "transcript": value}))
+                        state["delivered"].append(value)
+                    else:
+                        if value not in state["issued"]:
+                            state["issued"].add(value)
+                            await ws.send(json.dumps({
+                                "type": "response.function_call_arguments.done", "response_id": f"resp_{value}",
+                                "call_id": value, "name": "lookup", "arguments": json.dumps({"key": value})}))
+                            await ws.send(json.dumps({"type": "response.done",
+                                                      "response": {"id": f"resp_{value}", "output": []}}))
+                            if await maybe_drop(ws):
+                                return
+                        # 等待函数结果（断线前发出的由重放补发）以及随后的 response.create
+                        while value not in state["responses"]:
+                            await receive(2.0)
+                    state["cursor"] += 1
+                finished.set()
+                await ws.wait_closed()
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+        class CallerTransport:
+            """模拟 Twilio：媒体流启动后等待脚本结束再挂断"""
+
+            def __init__(self):
+                self.started = False
+
+            async def receive_text(self):
+                if not self.started:
+                    self.started = True
+                    return json.dumps({"event": "start", "start": {"streamSid": "MZ" + "0" * 32}})
+                await finished.wait()
+                return None
+
+            async def send_text(self, text: str):
+                pass
+
+            async def close(self, code: int = 1000):
+                finished.set()
+
+        async with websockets.serve(realtime, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            services = BridgeServices(f"ws://127.0.0.1:{port}", "test", "test", tools=registry)
+            bridge = CallBridge(f"CA-chaos-{seed}", CallerTransport(), services, "test", "alloy")
+            started = time.monotonic()
+            await asyncio.wait_for(bridge.run(), timeout=30)
+            state["elapsed_ms"] = (time.monotonic() - started) * 1000
+            state["reconnects"] = bridge.session["reconnects"]
+        state["complete"] = state["cursor"] == len(steps)
+        state["missing_outputs"] = sum(1 for kind, value in steps if kind == "tool" and value not in state["outputs"])
+        return state
+
+    results = [asyncio.run(run_call(seed)) for seed in range(CALLS)]
+    totals = {key: sum(result[key] for result in results)
+              for key in ("drops", "reconnects", "replay_errors", "duplicates", "extra_responses", "missing_outputs")}
+    incomplete = sum(1 for result in results if not result["complete"])
+    print(f"{CALLS} 通电话，断开 {totals['drops']} 次，重连 {totals['reconnects']} 次")
+    print(f"重放内容不一致 {totals['replay_errors']} 次，函数结果重复 {totals['duplicates']} 次，"
+          f"丢失 {totals['missing_outputs']} 个，重复请求回复 {totals['extra_responses']} 次，未完成的通话 {incomplete} 通")
+    failed = incomplete or totals["replay_errors"] or totals["duplicates"] or totals["missing_outputs"] \
+        or totals["extra_responses"] or totals["reconnects"] < totals["drops"]
+    sys.exit(1 if failed else 0)
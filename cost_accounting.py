@@ -0,0 +1,373 @@
+"""
+Token 与费用统计
+每次 response.done 的 usage 都包含本次回复计费的输入 / 输出 token（按文本、音频和缓存命中细分）。
+CallCostTracker 把它们累计到会话中（session["usage"]），按 REALTIME_PRICE_* 单价折算成费用，
+同时计入 CostLedger 的总计、按租户的总计和当日花费；通话结束时写入日志和转录存储（role=usage）。
+
+预算（默认不限）：
+- 每通电话 CALL_BUDGET_USD，租户可用 call_budget_usd 覆盖
+- 每个租户每天 daily_budget_usd（见 tenants.py），当日花费超出后不再接受该租户的新通话
+花费达到预算的 BUDGET_WRAP_UP_RATIO 时请模型礼貌地收尾，达到预算时等当前语音播完后挂断。
+预算是软上限：费用只能在 response.done 之后得知，已经开始的回复无法中途计费。为了少超出，
+剩余预算不够再来一轮（按上一轮的费用估计）时提前收尾、收尾回复结束后挂断，收尾回复的 max_output_tokens 按剩余预算限制；
+每轮的输入会重新计费整段对话历史，所以挂断前最后一轮仍可能略超预算。
+统计和预算都按进程计算，多 worker 部署时每个 worker 各自累计。
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import date
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+COST_TRACKING = os.getenv("COST_TRACKING", "true").lower() == "true"
+# 单价：美元 / 百万 token（默认 gpt-realtime 的标价）
+REALTIME_PRICE_TEXT_INPUT = float(os.getenv("REALTIME_PRICE_TEXT_INPUT", "4.0"))
+REALTIME_PRICE_TEXT_CACHED = float(os.getenv("REALTIME_PRICE_TEXT_CACHED", "0.4"))
+REALTIME_PRICE_TEXT_OUTPUT = float(os.getenv("REALTIME_PRICE_TEXT_OUTPUT", "16.0"))
+REALTIME_PRICE_AUDIO_INPUT = float(os.getenv("REALTIME_PRICE_AUDIO_INPUT", "32.0"))
+REALTIME_PRICE_AUDIO_CACHED = float(os.getenv("REALTIME_PRICE_AUDIO_CACHED", "0.4"))
+REALTIME_PRICE_AUDIO_OUTPUT = float(os.getenv("REALTIME_PRICE_AUDIO_OUTPUT", "64.0"))
+
+CALL_BUDGET_USD = float(os.getenv("CALL_BUDGET_USD", "0"))  # 0 表示不限
+BUDGET_WRAP_UP_RATIO = float(os.getenv("BUDGET_WRAP_UP_RATIO", "0.8"))
+BUDGET_WRAP_UP_INSTRUCTIONS = os.getenv(
+    "BUDGET_WRAP_UP_INSTRUCTIONS",
+    "本通电话需要尽快结束。请用一两句话礼貌地总结已经处理的事项并与对方道别，不要再提出新的问题。"
+)
+
+# 决定挂断后，等模型语音在 Twilio 端播完再多留的时间（秒）
+HANGUP_GRACE = 1.0
+# 收尾回复的输出 token 下限，避免剩余预算很少时道别说到一半被截断
+WRAP_UP_MIN_OUTPUT_TOKENS = 150
+
+USAGE_FIELDS = ("text_input", "text_cached", "audio_input", "audio_cached", "text_output", "audio_output")
+
+
+class Pricing:
+    """按 token 类别计价（美元 / 百万 token）"""
+
+    def __init__(self, text_input: float = REALTIME_PRICE_TEXT_INPUT, text_cached: float = REALTIME_PRICE_TEXT_CACHED,
+                 text_output: float = REALTIME_PRICE_TEXT_OUTPUT, audio_input: float = REALTIME_PRICE_AUDIO_INPUT,
+                 audio_cached: float = REALTIME_PRICE_AUDIO_CACHED, audio_output: float = REALTIME_PRICE_AUDIO_OUTPUT):
+        # 与 USAGE_FIELDS 顺序一致；text_input / audio_input 不含缓存命中的部分
+        self.rates = (text_input, text_cached, audio_input, audio_cached, text_output, audio_output)
+
+    def cost(self, counts) -> float:
+        return sum(count * rate for count, rate in zip(counts, self.rates)) / 1e6
+
+    def output_tokens_for(self, usd: float) -> int:
+        """这笔钱最多能买多少输出 token（按最贵的音频输出计）"""
+        return int(usd * 1e6 / max(self.rates[4], self.rates[5]))
+
+
+def parse_usage(usage: dict) -> tuple:
+    """response.done 的 usage → 与 USAGE_FIELDS 对应的 token 数，输入中缓存命中的部分单独计"""
+    inputs = usage.get("input_token_details") or {}
+    outputs = usage.get("output_token_details") or {}
+    cached = inputs.get("cached_tokens_details") or {}
+    text_cached = cached.get("text_tokens", 0)
+    audio_cached = cached.get("audio_tokens", 0)
+    if not cached and inputs.get("cached_tokens"):
+        # 没有细分时，缓存命中全部算作文本（会话开头的指令和工具声明）
+        text_cached = min(inputs["cached_tokens"], inputs.get("text_tokens", 0))
+        audio_cached = inputs["cached_tokens"] - text_cached
+    return (
+        max(0, inputs.get("text_tokens", 0) - text_cached),
+        text_cached,
+        max(0, inputs.get("audio_tokens", 0) - audio_cached),
+        audio_cached,
+        outputs.get("text_tokens", 0),
+        outputs.get("audio_tokens", 0),
+    )
+
+
+class TokenUsage:
+    """累计的 token 数和费用"""
+
+    __slots__ = ("counts", "cost_usd", "responses")
+
+    def __init__(self):
+        self.counts = [0] * len(USAGE_FIELDS)
+        self.cost_usd = 0.0
+        self.responses = 0
+
+    def add(self, counts, cost_usd: float):
+        for index, count in enumerate(counts):
+            self.counts[index] += count
+        self.cost_usd += cost_usd
+        self.responses += 1
+
+    def as_dict(self) -> dict:
+        result = dict(zip(USAGE_FIELDS, self.counts))
+        result["responses"] = self.responses
+        result["cost_usd"] = round(self.cost_usd, 6)
+        return result
+
+
+class CallBudget:
+    """一通电话适用的预算；key 为租户 ID（没有租户时为 None），金额为 0 表示不限"""
+
+    __slots__ = ("key", "call_usd", "daily_usd")
+
+    def __init__(self, key: Optional[str] = None, call_usd: float = CALL_BUDGET_USD, daily_usd: float = 0.0):
+        self.key = key
+        self.call_usd = call_usd
+        self.daily_usd = daily_usd
+
+
+class BudgetPolicy:
+    """
+    预算判断，只做计算不做 I/O
+    decide() 在花费达到 wrap_up_ratio、或剩余预算不够按 last_cost 再来一轮时返回一次 "wrap_up"；
+    已经收尾后剩余预算仍不够再来一轮，或花费达到预算时返回一次 "end"，其余返回 None
+    """
+
+    def __init__(self, budget: CallBudget, wrap_up_ratio: float = BUDGET_WRAP_UP_RATIO):
+        self.budget = budget
+        self.wrap_up_ratio = wrap_up_ratio
+        self.state: Optional[str] = None
+        self.reason: Optional[str] = None
+
+    def usage_ratio(self, call_spent: float, daily_spent: float) -> float:
+        ratios = [0.0]
+        if self.budget.call_usd > 0:
+            ratios.append(call_spent / self.budget.call_usd)
+        if self.budget.daily_usd > 0:
+            ratios.append(daily_spent / self.budget.daily_usd)
+        return max(ratios)
+
+    def remaining(self, call_spent: float, daily_spent: float) -> Optional[float]:
+        """距最近一个预算还剩多少美元，不限时为 None"""
+        remaining = []
+        if self.budget.call_usd > 0:
+            remaining.append(self.budget.call_usd - call_spent)
+        if self.budget.daily_usd > 0:
+            remaining.append(self.budget.daily_usd - daily_spent)
+        return max(0.0, min(remaining)) if remaining else None
+
+    def decide(self, call_spent: float, daily_spent: float, last_cost: float = 0.0) -> Optional[str]:
+        if self.state == "end":
+            return None
+        ratio = self.usage_ratio(call_spent, daily_spent)
+        call_ratio = call_spent / self.budget.call_usd if self.budget.call_usd > 0 else 0.0
+        self.reason = "call_budget" if ratio == call_ratio else "daily_budget"
+        # 下一轮的输入包含整段历史，费用不会比上一轮低：剩余预算不够时先收尾，收尾之后再结束
+        out_of_budget = self.usage_ratio(call_spent + last_cost, daily_spent + last_cost) >= 1.0
+        if ratio >= 1.0 or (out_of_budget and self.state == "wrap_up"):
+            self.state = "end"
+            return "end"
+        if (ratio >= self.wrap_up_ratio or out_of_budget) and self.state is None:
+            self.state = "wrap_up"
+            return "wrap_up"
+        return None
+
+
+class CostLedger:
+    """所有通话的累计用量：总计、按租户总计、按租户的当日花费（用于每日预算）"""
+
+    def __init__(self, pricing: Optional[Pricing] = None):
+        self.pricing = pricing or Pricing()
+        self.total = TokenUsage()
+        self.by_key: Dict[str, TokenUsage] = {}
+        self.calls = 0
+        self.budget_actions: Dict[str, int] = {}
+        self.day = date.today()
+        self.daily: Dict[Optional[str], float] = {}
+
+    def add(self, key: Optional[str], counts, cost_usd: float):
+        self.total.add(counts, cost_usd)
+        if key is not None:
+            usage = self.by_key.get(key)
+            if usage is None:
+                usage = self.by_key[key] = TokenUsage()
+            usage.add(counts, cost_usd)
+        self._roll_day()
+        self.daily[key] = self.daily.get(key, 0.0) + cost_usd
+
+    def _roll_day(self):
+        today = date.today()
+        if today != self.day:
+            self.day, self.daily = today, {}
+
+    def spent_today(self, key: Optional[str]) -> float:
+        self._roll_day()
+        return self.daily.get(key, 0.0)
+
+    def over_daily_budget(self, key: Optional[str], daily_usd: float) -> bool:
+        return daily_usd > 0 and self.spent_today(key) >= daily_usd
+
+    def record_action(self, action: str):
+        self.budget_actions[action] = self.budget_actions.get(action, 0) + 1
+
+    def summary(self) -> dict:
+        self._roll_day()
+        return {
+            "calls": self.calls,
+            "total": self.total.as_dict(),
+            "cost_per_call_usd": round(self.total.cost_usd / self.calls, 6) if self.calls else None,
+            "budget_actions": dict(self.budget_actions),
+            "today": {"date": self.day.isoformat(),
+                      "spent_usd": {key or "(default)": round(spent, 6) for key, spent in self.daily.items()}},
+            "tenants": {key: usage.as_dict() for key, usage in self.by_key.items()},
+        }
+
+
+class CallCostTracker:
+    """单通电话的用量统计和预算执行：订阅 response.done，超出预算时收尾或挂断"""
+
+    def __init__(self, bridge, ledger: CostLedger, budget: Optional[CallBudget] = None,
+                 wrap_up_instructions: str = BUDGET_WRAP_UP_INSTRUCTIONS):
+        self.bridge = bridge
+        self.ledger = ledger
+        self.budget = budget or CallBudget()
+        self.policy = BudgetPolicy(self.budget)
+        self.wrap_up_instructions = wrap_up_instructions
+        self.usage = TokenUsage()
+        self.hangup_task: Optional[asyncio.Task] = None
+        ledger.calls += 1
+        bridge.session["usage"] = self.usage.as_dict()
+        bridge.dispatcher.subscribe("response.done", self.on_response_done)
+
+    async def on_response_done(self, data: dict):
+        usage = (data.get("response") or {}).get("usage")
+        if not usage:
+            return
+        counts = parse_usage(usage)
+        cost = self.ledger.pricing.cost(counts)
+        self.usage.add(counts, cost)
+        self.ledger.add(self.budget.key, counts, cost)
+        self.bridge.session["usage"] = self.usage.as_dict()
+
+        action = self.policy.decide(self.usage.cost_usd, self.ledger.spent_today(self.budget.key), cost)
+        if action:
+            await self.enforce(action)
+
+    async def enforce(self, action: str):
+        bridge = self.bridge
+        reason = self.policy.reason
+        logger.warning(f"[{bridge.call_sid}] 💰 费用 ${self.usage.cost_usd:.4f} 触发预算（{reason}）: "
+                       f"{'请模型收尾' if action == 'wrap_up' else '挂断'}")
+        self.ledger.record_action(action)
+        if bridge.services.transcript_store:
+            bridge.services.transcript_store.record(bridge.call_sid, "budget", action, reason=reason,
+                                                    cost_usd=round(self.usage.cost_usd, 6))
+        if action == "wrap_up":
+            response = {"instructions": self.wrap_up_instructions}
+            remaining = self.policy.remaining(self.usage.cost_usd, self.ledger.spent_today(self.budget.key))
+            if remaining is not None:
+                response["max_output_tokens"] = max(WRAP_UP_MIN_OUTPUT_TOKENS,
+                                                    self.ledger.pricing.output_tokens_for(remaining))
+            await bridge.send_openai(json.dumps({"type": "response.create", "response": response}))
+        elif self.hangup_task is None:
+            self.hangup_task = asyncio.create_task(self.hang_up())
+
+    async def hang_up(self):
+        """等已发给 Twilio 的模型语音播完再挂断"""
+        bridge = self.bridge
+        session = bridge.session
+        await asyncio.sleep(max(0.0, session["model_audio_until"] - time.monotonic()) + HANGUP_GRACE)
+        if session["closing"]:
+            return
+        session["closing"] = True
+        await bridge.transport.close()
+        if session.get("openai_ws"):
+            await session["openai_ws"].close()
+
+    def finish(self):
+        bridge = self.bridge
+        if self.hangup_task and not self.hangup_task.done():
+            self.hangup_task.cancel()
+        stats = self.usage.as_dict()
+        logger.info(f"[{bridge.call_sid}] 💰 本通电话用量: {stats}")
+        if bridge.services.transcript_store and self.usage.responses:
+            bridge.services.transcript_store.record(bridge.call_sid, "usage", f"{stats['cost_usd']:.6f}",
+                                                    tenant=self.budget.key, **stats)
+
+
+if __name__ == "__main__":
+    # 合成通话的费用分布，以及每通 0.30 美元预算下的收尾 / 挂断情况
+    import random
+    import statistics
+
+    rng = random.Random(13)
+    pricing = Pricing()
+    INSTRUCTION_TOKENS = 1500
+
+    def synth_call(turns: int):
+        """每轮回复的 usage：输入是会话开头 + 之前所有轮次，上一轮的输入按 128 token 的块命中缓存"""
+        history_audio = 0
+        previous_input = 0
+        for turn in range(turns):
+            user_audio = rng.randint(30, 200)  # 约 0.6~4 秒来电者语音
+            reply_audio = rng.randint(100, 400)
+            history_audio += user_audio
+            cached = previous_input // 128 * 128 if previous_input >= 1024 else 0
+            text_cached = min(cached, INSTRUCTION_TOKENS)
+            previous_input = INSTRUCTION_TOKENS + history_audio
+            yield {
+                "input_tokens": previous_input,
+                "output_tokens": reply_audio + 20,
+                "input_token_details": {
+                    "text_tokens": INSTRUCTION_TOKENS, "audio_tokens": history_audio, "cached_tokens": cached,
+                    "cached_tokens_details": {"text_tokens": text_cached, "audio_tokens": cached - text_cached},
+                },
+                "output_token_details": {"text_tokens": 20, "audio_tokens": reply_audio},
+            }
+            history_audio += reply_audio
+
+    calls = [list(synth_call(rng.randint(3, 40))) for _ in range(200)]
+    costs = sorted(sum(pricing.cost(parse_usage(usage)) for usage in call) for call in calls)
+    print(f"{len(calls)} 通合成通话的费用（美元）: 中位数 {statistics.median(costs):.3f}，"
+          f"P90 {costs[int(len(costs) * 0.9)]:.3f}，最高 {costs[-1]:.3f}")
+
+    budget = CallBudget(call_usd=0.30)
+    for label, lookahead in (("达到预算才挂断", False), ("剩余不够一轮即挂断", True)):
+        outcomes = {"ok": 0, "wrap_up": 0, "end": 0}
+        capped = []
+        abrupt = 0  # 没有收尾就挂断的通话
+        for call in calls:
+            policy = BudgetPolicy(budget)
+            spent = 0.0
+            wrapped_up = False
+            for usage in call:
+                cost = pricing.cost(parse_usage(usage))
+                spent += cost
+                action = policy.decide(spent, 0.0, cost if lookahead else 0.0)
+                wrapped_up = wrapped_up or action == "wrap_up"
+                if action == "end":
+                    abrupt += not wrapped_up
+                    break
+            outcomes[policy.state or "ok"] += 1
+            capped.append(spent)
+        over = [spent for spent in capped if spent > budget.call_usd]
+        print(f"每通预算 $0.30（{label}）: {outcomes}，未收尾即挂断 {abrupt} 通，最高花费 ${max(capped):.3f}，"
+              f"超出预算 {len(over)} 通，平均花费 ${statistics.mean(capped):.3f}")
+
+    class FakeBridge:
+        call_sid = "CA_demo"
+        session = {"model_audio_until": 0.0, "closing": False}
+
+        class services:
+            transcript_store = None
+
+        class dispatcher:
+            @staticmethod
+            def subscribe(event_type, handler):
+                pass
+
+    ledger = CostLedger(pricing)
+    tracker = CallCostTracker(FakeBridge, ledger)
+    events = [{"type": "response.done", "response": {"usage": usage}} for call in calls for usage in call]
+
+    async def bench() -> float:
+        started = time.perf_counter()
+        for event in events:
+            await tracker.on_response_done(event)
+        return (time.perf_counter() - started) * 1e6 / len(events)
+
+    print(f"每个 response.done 的统计开销: {asyncio.run(bench()):.2f} µs")
@@ -0,0 +1,223 @@
+"""
+OpenAI Realtime 事件分发
+按事件类型查表调用已注册的处理函数，取代转发循环里的 if/elif 链：
+- 先只读出 type 字段，没有订阅者的事件直接丢弃，不做完整 JSON 解析
+- response.audio.delta 走专用快速路径，直接从原始消息中切出 delta，不解析整条 JSON
+- 插件通过 subscribe() 订阅事件，不需要修改转发循环
+- 可选记录每个处理函数的耗时直方图
+"""
+
+import os
+import re
+import json
+import time
+import inspect
+import logging
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 是否记录每个处理函数的耗时（通话结束时输出到日志）
+EVENT_TIMING = os.getenv("EVENT_TIMING", "false").lower() == "true"
+
+AUDIO_DELTA = "response.audio.delta"
+
+# OpenAI 发来的事件 type 总是第一个字段
+_TYPE_RE = re.compile(r'\{\s*"type"\s*:\s*"([^"\\]+)"')
+_DELTA_KEY = '"delta"'
+
+
+def peek_event_type(message: str) -> Optional[str]:
+    """不解析整条消息，直接读出开头的 type 字段；格式不符时返回 None"""
+    match = _TYPE_RE.match(message)
+    return match.group(1) if match else None
+
+
+def audio_delta(message: str) -> Optional[str]:
+    """从 response.audio.delta 原始消息中切出 base64 音频；base64 不含引号和转义，可以直接按引号定位"""
+    key = message.find(_DELTA_KEY)
+    if key < 0:
+        return None
+    colon = message.find(":", key + len(_DELTA_KEY))
+    start = colon + 1
+    while start < len(message) and message[start] == " ":
+        start += 1
+    if colon < 0 or start >= len(message) or message[start] != '"':
+        return None
+    end = message.find('"', start + 1)
+    if end < 0:
+        return None
+    return message[start + 1:end]
+
+
+class TimingHistogram:
+    """处理耗时直方图，按 2 的幂（µs）分桶"""
+
+    BUCKETS = 24  # 最大桶约 8 秒
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        micros = seconds * 1e6
+        self.buckets[min(int(micros).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += micros
+        self.max = max(self.max, micros)
+
+    def percentile(self, ratio: float) -> float:
+        """返回分位数所在桶的上界（µs）"""
+        target = self.count * ratio
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count:
+                return float(1 << index)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            "max_us": round(self.max, 1),
+        }
+
+
+class EventDispatcher:
+    """
+    事件类型 → 处理函数列表
+    处理函数接收解析后的事件字典，可以是普通函数或协程函数；
+    音频增量处理函数（on_audio_delta）直接接收 base64 字符串。
+    """
+
+    def __init__(self, timing: bool = EVENT_TIMING):
+        self._handlers: Dict[str, List[Callable]] = {}
+        self._audio_handler: Optional[Callable] = None
+        self.timings: Optional[Dict[str, TimingHistogram]] = {} if timing else None
+        self.skipped = 0
+
+    def subscribe(self, event_type: str, handler: Callable):
+        self._handlers.setdefault(event_type, []).append(handler)
+
+    def unsubscribe(self, event_type: str, handler: Callable):
+        handlers = self._handlers.get(event_type)
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+            if not handlers:
+                del self._handlers[event_type]
+
+    def on_audio_delta(self, handler: Callable):
+        """注册音频增量的快速路径处理函数（只能有一个）"""
+        self._audio_handler = handler
+
+    def handles(self, event_type: str) -> bool:
+        return event_type in self._handlers or (event_type == AUDIO_DELTA and self._audio_handler is not None)
+
+    async def dispatch(self, message: str):
+        """分发一条原始消息"""
+        event_type = peek_event_type(message)
+
+        if event_type == AUDIO_DELTA and self._audio_handler is not None:
+            delta = audio_delta(message)
+            if delta is not None:
+                await self._call(AUDIO_DELTA, self._audio_handler, delta)
+                if AUDIO_DELTA not in self._handlers:
+                    return
+                await self._dispatch_data(json.loads(message), skip_audio=True)
+                return
+
+        if event_type is not None and not self.handles(event_type):
+            self.skipped += 1
+            return
+
+        await self._dispatch_data(json.loads(message))
+
+    async def dispatch_event(self, data: dict):
+        """分发一条已解析的事件"""
+        await self._dispatch_data(data)
+
+    async def _dispatch_data(self, data: dict, skip_audio: bool = False):
+        event_type = data.get("type")
+        if event_type == AUDIO_DELTA and self._audio_handler is not None and not skip_audio:
+            delta = data.get("delta")
+            if delta:
+                await self._call(AUDIO_DELTA, self._audio_handler, delta)
+        for handler in self._handlers.get(event_type, ()):
+            await self._call(event_type, handler, data)
+
+    async def _call(self, event_type: str, handler: Callable, arg):
+        if self.timings is None:
+            result = handler(arg)
+            if inspect.isawaitable(result):
+                await result
+            return
+
+        started = time.perf_counter()
+        result = handler(arg)
+        if inspect.isawaitable(result):
+            await result
+        key = f"{event_type} → {getattr(handler, '__qualname__', repr(handler))}"
+        histogram = self.timings.get(key)
+        if histogram is None:
+            histogram = self.timings[key] = TimingHistogram()
+        histogram.observe(time.perf_counter() - started)
+
+    def timing_summary(self) -> Dict[str, dict]:
+        if not self.timings:
+            return {}
+        return {key: histogram.summary() for key, histogram in self.timings.items()}
+
+
+if __name__ == "__main__":
+    # 对比完整 JSON 解析与快速路径的单条事件开销
+    import base64
+    import asyncio
+    import statistics
+
+    chunk = base64.b64encode(bytes(4800)).decode("utf-8")  # 100ms 的 24kHz PCM
+    delta_message = json.dumps({
+        "type": AUDIO_DELTA, "event_id": "event_1", "response_id": "resp_1",
+        "item_id": "item_1", "output_index": 0, "content_index": 0, "delta": chunk
+    })
+    ignored_message = json.dumps({
+        "type": "response.audio_transcript.delta", "event_id": "event_2", "response_id": "resp_1",
+        "item_id": "item_1", "output_index": 0, "content_index": 0, "delta": "你好" * 20
+    })
+
+    def bench(fn, message, rounds=20000):
+        samples = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            fn(message)
+            samples.append((time.perf_counter() - started) * 1e6)
+        samples.sort()
+        return statistics.median(samples), samples[int(len(samples) * 0.99)]
+
+    print("单条事件开销（µs，p50 / p99）")
+    for label, fn, message in [
+        ("音频增量 json.loads", json.loads, delta_message),
+        ("音频增量 快速路径", audio_delta, delta_message),
+        ("未订阅事件 json.loads", json.loads, ignored_message),
+        ("未订阅事件 只读 type", peek_event_type, ignored_message),
+    ]:
+        p50, p99 = bench(fn, message)
+        print(f"  {label:<24} {p50:6.2f} / {p99:6.2f}")
+
+    async def dispatch_bench():
+        received = []
+        dispatcher = EventDispatcher(timing=True)
+        dispatcher.on_audio_delta(received.append)
+        for _ in range(10000):
+            await dispatcher.dispatch(delta_message)
+            await dispatcher.dispatch(ignored_message)
+        assert received[0] == chunk
+        for key, summary in dispatcher.timing_summary().items():
+            print(f"  {key}: {summary}")
+        print(f"  跳过未订阅事件 {dispatcher.skipped} 条")
+
+    asyncio.run(dispatch_bench())
@@ -0,0 +1,260 @@
+"""
+问候语音频缓存
+按 (指令哈希, 语音, 问候文本) 缓存预先合成的 μ-law 8kHz 音频（使用提示词模板时按模板名和静态前缀，
+不受每通电话的变量影响），
+文件存放在磁盘上并以 mmap 方式共享给所有通话，
+在 Twilio 媒体流启动的瞬间即可播放，避免等待 Realtime 会话首个音频包时的静音。
+"""
+
+import os
+import mmap
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from audio_assets import iter_frames, media_message
+
+logger = logging.getLogger(__name__)
+
+GREETING_CACHE_DIR = os.getenv("GREETING_CACHE_DIR", ".cache/greetings")
+GREETING_CACHE_MAX_BYTES = int(os.getenv("GREETING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def greeting_key(instructions: str, voice: str, text: str, template: Optional[str] = None) -> str:
+    """
+    缓存键：指令哈希 + 语音 + 问候文本
+    使用提示词模板时 instructions 传模板的 prefix、template 传模板名，同一模板的所有通话共用一份音频
+    """
+    if template:
+        instructions = f"{template}\0{instructions}"
+    instructions_hash = hashlib.sha256(instructions.encode()).hexdigest()[:16]
+    text_hash = hashlib.sha256(text.encode()).hexdigest()[:16]
+    return f"{instructions_hash}-{voice}-{text_hash}"
+
+
+class GreetingCache:
+    """
+    磁盘 + mmap 的问候音频缓存
+
+    - 文件按 LRU 淘汰，总大小不超过 max_bytes
+    - 同一文件只映射一次，所有通话共享同一块页缓存
+    - 写入采用临时文件 + os.replace，保证读到的文件总是完整的
+    """
+
+    def __init__(self, directory: str = GREETING_CACHE_DIR, max_bytes: int = GREETING_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()  # key → 文件大小，按最近使用排序
+        self._maps = {}  # key → mmap
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.ulaw")
+
+    def _load_index(self):
+        """启动时按修改时间恢复 LRU 顺序"""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".ulaw"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, name[:-len(".ulaw")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, key: str) -> Optional[mmap.mmap]:
+        """命中时返回只读 mmap，未命中返回 None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            audio = self._maps.get(key)
+            if audio is None:
+                try:
+                    with open(self._path(key), "rb") as f:
+                        audio = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # 文件被外部删除或为空
+                    self.total_bytes -= self._entries.pop(key)
+                    return None
+                self._maps[key] = audio
+
+        # 更新修改时间，重启后 LRU 顺序依然有效
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return audio
+
+    def put(self, key: str, audio: bytes):
+        """写入一条缓存并按需淘汰最久未使用的条目"""
+        if not audio or len(audio) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+            self._maps.pop(key, None)
+            self._entries[key] = len(audio)
+            self.total_bytes += len(audio)
+            self._evict()
+        logger.info(f"💾 问候音频已缓存: {key} ({len(audio)} 字节)")
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            # 正在播放的通话仍持有 mmap 引用，删除文件不影响其读取
+            self._maps.pop(key, None)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            logger.info(f"🗑️ 淘汰问候音频: {key}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+if __name__ == "__main__":
+    # 基准测试：缓存命中时从媒体流启动到第一帧可发送的耗时
+    import json
+    import tempfile
+    import statistics
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = GreetingCache(directory, max_bytes=256 * 1024)
+        greeting = bytes(range(256)) * 94  # 约 3 秒的 μ-law 音频
+        key = greeting_key("你是一个友好的客服助手。", "alloy", "您好，这里是智能客服。")
+        cache.put(key, greeting)
+
+        # 冷启动：首次映射文件
+        started = time.perf_counter()
+        audio = cache.get(key)
+        first = next(iter_frames(audio))
+        json.dumps(media_message("MZ" + "0" * 32, first))
+        cold_ms = (time.perf_counter() - started) * 1000
+
+        # 热路径：映射已存在
+        samples = []
+        for _ in range(10000):
+            started = time.perf_counter()
+            audio = cache.get(key)
+            first = next(iter_frames(audio))
+            json.dumps(media_message("MZ" + "0" * 32, first))
+            samples.append((time.perf_counter() - started) * 1e6)
+        samples.sort()
+
+        # 整段问候的切帧和编码开销
+        started = time.perf_counter()
+        frames = sum(1 for frame in iter_frames(audio) if json.dumps(media_message("MZ", frame)))
+        full_ms = (time.perf_counter() - started) * 1000
+
+        # LRU 淘汰：写满后最早的条目被移除
+        for i in range(1, 12):
+            cache.put(greeting_key("p", "alloy", str(i)), os.urandom(len(greeting)))
+
+        print("=" * 60)
+        print("📊 问候缓存基准测试")
+        print("=" * 60)
+        print(f"冷启动首帧耗时: {cold_ms:.3f} ms")
+        print(f"热路径首帧耗时: p50 {statistics.median(samples):.1f} µs, p99 {samples[int(len(samples) * 0.99)]:.1f} µs")
+        print(f"整段问候 {frames} 帧编码耗时: {full_ms:.2f} ms")
+        print(f"LRU 淘汰后: {cache.stats()}")
+
+        # 端到端：完整的 CallBridge，从 Twilio 媒体流连上（start 事件已在途）到第一帧问候音频发出，
+        # 模拟不同的 OpenAI 握手耗时，首帧不应随握手耗时增加
+        import asyncio
+
+        os.environ.setdefault("TRANSCRIPT_SINK", "none")
+        from call_bridge import BridgeServices, CallBridge
+
+        logging.basicConfig(level=logging.WARNING)
+        instructions, voice, text = "你是一个友好的客服助手。", "alloy", "您好，这里是智能客服。"
+        cache.put(greeting_key(instructions, voice, text), greeting)
+
+        class FakeRealtime:
+            """握手完成后的 OpenAI 连接：收到“问候语已说过”的记录后挂断，关闭前一直没有消息"""
+
+            def __init__(self, transport):
+                self.transport = transport
+                self.closed = asyncio.Event()
+
+            async def send(self, message):
+                if json.loads(message)["type"] == "conversation.item.create":
+                    self.transport.hangup.set()
+
+            async def close(self):
+                self.closed.set()
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                await self.closed.wait()
+                raise StopAsyncIteration
+
+        class StreamTransport:
+            """模拟 Twilio：连上即发送 start 事件，记录第一帧问候音频的发出时间"""
+
+            def __init__(self):
+                self.events = [json.dumps({"event": "start", "start": {"streamSid": "MZ" + "0" * 32}})]
+                self.first_frame_at = None
+                self.hangup = asyncio.Event()
+
+            async def receive_text(self):
+                if self.events:
+                    return self.events.pop(0)
+                await self.hangup.wait()
+                return None
+
+            async def send_text(self, text):
+                if self.first_frame_at is None and json.loads(text).get("event") == "media":
+                    self.first_frame_at = time.monotonic()
+
+            async def close(self, code=1000):
+                self.hangup.set()
+
+        async def end_to_end(handshake_ms: float):
+            transport = StreamTransport()
+
+            async def connect(api_key=None):
+                await asyncio.sleep(handshake_ms / 1000)
+                return FakeRealtime(transport)
+
+            services = BridgeServices("ws://unused", "test", "test", greeting_cache=cache, connect=connect)
+            bridge = CallBridge("CA-bench", transport, services, instructions, voice, text)
+            # 问候语已说过的记录在握手完成后补发给模型，之后挂断；超时说明记录丢失
+            started = time.monotonic()
+            await asyncio.wait_for(bridge.run(), timeout=5)
+            return (transport.first_frame_at - started) * 1000
+
+        print("端到端首帧耗时（媒体流连上 → 第一帧发出）:")
+        for handshake_ms in (0, 100, 300):
+            samples = sorted(asyncio.run(end_to_end(handshake_ms)) for _ in range(20))
+            print(f"  OpenAI 握手 {handshake_ms:>3} ms: p50 {statistics.median(samples):.2f} ms, "
+                  f"max {samples[-1]:.2f} ms")
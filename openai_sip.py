@@ -0,0 +1,155 @@
+"""
+OpenAI Realtime SIP 直连模式
+电话通过 SIP 中继直接接入 OpenAI，由 OpenAI 终结媒体流；
+本服务只处理 realtime.call.incoming webhook、调用 accept/reject/hangup 接口，
+并通过仅含控制事件的 WebSocket（?call_id=）驱动会话，不经手任何音频数据。
+"""
+
+import re
+import hmac
+import time
+import base64
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# webhook 时间戳允许的最大偏差（秒）
+WEBHOOK_TOLERANCE = 300
+
+
+def _decode_secret(secret: str) -> bytes:
+    """webhook 密钥格式为 whsec_<base64>"""
+    if secret.startswith("whsec_"):
+        return base64.b64decode(secret[len("whsec_"):])
+    return secret.encode()
+
+
+def sign_webhook(body: bytes, secret: str, webhook_id: str, timestamp: int) -> str:
+    """按 Standard Webhooks 规范计算签名头（v1,<base64>）"""
+    signed = f"{webhook_id}.{timestamp}.".encode() + body
+    digest = hmac.new(_decode_secret(secret), signed, hashlib.sha256).digest()
+    return "v1," + base64.b64encode(digest).decode()
+
+
+def verify_webhook(body: bytes, headers: Mapping[str, str], secret: str,
+                   tolerance: int = WEBHOOK_TOLERANCE) -> bool:
+    """校验 OpenAI webhook 的 webhook-signature 头"""
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature", "")
+    if not webhook_id or not timestamp or not timestamp.isdigit():
+        return False
+    if abs(time.time() - int(timestamp)) > tolerance:
+        return False
+
+    expected = sign_webhook(body, secret, webhook_id, int(timestamp))
+    # 签名头可能包含多个以空格分隔的签名（密钥轮换期间）
+    return any(hmac.compare_digest(expected, candidate) for candidate in signatures.split())
+
+
+def sip_header(event_data: dict, name: str) -> Optional[str]:
+    """从 realtime.call.incoming 事件中读取 SIP 头"""
+    for header in event_data.get("sip_headers", []):
+        if header.get("name", "").lower() == name.lower():
+            return header.get("value")
+    return None
+
+
+def sip_user(header: Optional[str]) -> Optional[str]:
+    """
+    From/To 头中 SIP URI 的用户部分（通常是号码）
+    如 "<sip:+8613800000000@example.com>;tag=1" → "+8613800000000"
+    """
+    match = re.search(r"sips?:([^@;>]+)@", header or "")
+    return match.group(1) if match else None
+
+
+def build_accept_config(model: str, instructions: str, voice: str) -> dict:
+    """accept 接口的会话配置（与 session.update 的 session 字段相同）"""
+    return {
+        "type": "realtime",
+        "model": model,
+        "instructions": instructions,
+        "audio": {
+            "input": {
+                "transcription": {"model": "whisper-1"},
+                "turn_detection": {
+                    "type": "server_vad",
+                    "threshold": 0.5,
+                    "prefix_padding_ms": 300,
+                    "silence_duration_ms": 500
+                }
+            },
+            "output": {"voice": voice}
+        }
+    }
+
+
+class WebhookDeduplicator:
+    """
+    按 webhook-id 去重，OpenAI 在超时重试时会重复投递同一事件
+    只有处理成功（已 accept/reject）的事件才记为已处理，处理失败时 OpenAI 的重试仍会被受理；
+    处理中的事件也视为重复，避免重试与首次投递同时 accept
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self._seen: OrderedDict = OrderedDict()
+        self._processing = set()
+
+    def seen(self, webhook_id: Optional[str]) -> bool:
+        return bool(webhook_id) and (webhook_id in self._seen or webhook_id in self._processing)
+
+    def start(self, webhook_id: Optional[str]):
+        if webhook_id:
+            self._processing.add(webhook_id)
+
+    def finish(self, webhook_id: Optional[str], succeeded: bool):
+        if not webhook_id:
+            return
+        self._processing.discard(webhook_id)
+        if succeeded:
+            self._seen[webhook_id] = None
+            if len(self._seen) > self.capacity:
+                self._seen.popitem(last=False)
+
+
+class RealtimeCallControl:
+    """
+    SIP 呼叫控制接口：accept / reject / refer / hangup
+    复用同一个 httpx.AsyncClient，保持到 OpenAI 的连接常驻
+    """
+
+    def __init__(self, api_key: str, api_base: str = "https://api.openai.com/v1", timeout: float = 10.0):
+        # 只有启用 SIP 直连时才用到，延迟导入以加快启动
+        import httpx
+
+        self.api_base = api_base.rstrip("/")
+        self._client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=timeout
+        )
+
+    async def _post(self, call_id: str, action: str, payload: Optional[dict] = None):
+        url = f"{self.api_base}/realtime/calls/{call_id}/{action}"
+        response = await self._client.post(url, json=payload)
+        response.raise_for_status()
+        return response
+
+    async def accept(self, call_id: str, session_config: dict):
+        return await self._post(call_id, "accept", session_config)
+
+    async def reject(self, call_id: str, sip_code: int = 486):
+        return await self._post(call_id, "reject", {"sip_code": sip_code})
+
+    async def refer(self, call_id: str, target_uri: str):
+        return await self._post(call_id, "refer", {"target_uri": target_uri})
+
+    async def hangup(self, call_id: str):
+        return await self._post(call_id, "hangup")
+
+    async def aclose(self):
+        await self._client.aclose()
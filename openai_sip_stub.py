@@ -0,0 +1,162 @@
+"""
+OpenAI Realtime SIP 本地模拟服务 - 不需要真实的 SIP 中继和 OpenAI 账号
+模拟 /realtime/calls/{call_id}/accept 等控制接口和 ?call_id= 控制通道，
+并可向本地代理发送带签名的 realtime.call.incoming webhook。
+
+用法：
+    # 终端 1：让代理指向模拟服务后启动
+    OPENAI_API_BASE=http://localhost:8001/v1 \\
+    OPENAI_REALTIME_URL=ws://localhost:8001/v1/realtime \\
+    OPENAI_WEBHOOK_SECRET=whsec_dGVzdHNlY3JldA== \\
+    python twilio_openai_agent_fastapi.py
+
+    # 终端 2：启动模拟服务并模拟一通来电
+    python openai_sip_stub.py call http://localhost:5000/openai-webhook
+
+    # 或只启动模拟服务，由其他工具发送 webhook
+    python openai_sip_stub.py serve
+"""
+
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
+
+from openai_sip import sign_webhook
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STUB_PORT = 8001
+STUB_WEBHOOK_SECRET = "whsec_dGVzdHNlY3JldA=="
+
+app = FastAPI(title="OpenAI Realtime SIP Stub")
+
+# call_id → 呼叫状态
+calls = {}
+
+
+@app.post("/v1/realtime/calls/{call_id}/accept")
+async def accept(call_id: str, request: Request):
+    config = await request.json()
+    calls.setdefault(call_id, {}).update(status="accepted", config=config, accepted_at=time.monotonic())
+    logger.info(f"[{call_id}] ✅ accept: voice={config.get('audio', {}).get('output', {}).get('voice')}")
+    return {}
+
+
+@app.post("/v1/realtime/calls/{call_id}/{action}")
+async def control(call_id: str, action: str, request: Request):
+    if call_id not in calls:
+        raise HTTPException(status_code=404, detail="call not found")
+    body = await request.body()
+    calls[call_id]["status"] = action
+    logger.info(f"[{call_id}] 📞 {action}: {body.decode() or '-'}")
+    return {}
+
+
+@app.websocket("/v1/realtime")
+async def control_channel(websocket: WebSocket):
+    """控制通道：只收发 JSON 事件，不含音频"""
+    call_id = websocket.query_params.get("call_id")
+    if call_id not in calls or calls[call_id]["status"] != "accepted":
+        await websocket.close(code=4004)
+        return
+
+    await websocket.accept()
+    await websocket.send_json({"type": "session.created", "session": calls[call_id]["config"]})
+
+    try:
+        while True:
+            event = await websocket.receive_json()
+            logger.info(f"[{call_id}] ⬅️ {event.get('type')}")
+
+            if event.get("type") == "response.create":
+                # 模拟一轮问候和一轮用户回答
+                await websocket.send_json({
+                    "type": "response.output_audio_transcript.done",
+                    "transcript": "您好，这里是模拟的 AI 客服。"
+                })
+                await websocket.send_json({
+                    "type": "conversation.item.input_audio_transcription.completed",
+                    "transcript": "你好，我想查询订单。"
+                })
+                await asyncio.sleep(1)
+                calls[call_id]["status"] = "completed"
+                await websocket.close()
+                return
+    except WebSocketDisconnect:
+        pass
+
+
+async def fire_incoming_call(webhook_url: str, secret: str = STUB_WEBHOOK_SECRET):
+    """向代理发送一条带签名的 realtime.call.incoming webhook"""
+    import httpx
+
+    call_id = f"rtc_{uuid.uuid4().hex[:16]}"
+    calls[call_id] = {"status": "ringing"}
+    event = {
+        "object": "event",
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "realtime.call.incoming",
+        "created_at": int(time.time()),
+        "data": {
+            "call_id": call_id,
+            "sip_headers": [
+                {"name": "From", "value": "sip:+142555512112@sip.example.com"},
+                {"name": "To", "value": "sip:+18005551212@sip.example.com"},
+                {"name": "Call-ID", "value": str(uuid.uuid4())}
+            ]
+        }
+    }
+    body = json.dumps(event).encode()
+    webhook_id = f"wh_{uuid.uuid4().hex}"
+    timestamp = int(time.time())
+    headers = {
+        "content-type": "application/json",
+        "webhook-id": webhook_id,
+        "webhook-timestamp": str(timestamp),
+        "webhook-signature": sign_webhook(body, secret, webhook_id, timestamp),
+    }
+
+    async with httpx.AsyncClient() as client:
+        started = time.monotonic()
+        response = await client.post(webhook_url, content=body, headers=headers)
+        print(f"📤 webhook → {response.status_code} ({(time.monotonic() - started) * 1000:.0f} ms)")
+    return call_id
+
+
+async def run_stub_with_call(webhook_url: str):
+    """在同一进程中启动模拟服务并发起一通来电"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=STUB_PORT, log_level="warning"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    call_id = await fire_incoming_call(webhook_url)
+    for _ in range(100):
+        if calls[call_id]["status"] == "completed":
+            break
+        await asyncio.sleep(0.1)
+    print(f"📋 {call_id}: {calls[call_id]['status']}")
+
+    server.should_exit = True
+    await serve_task
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("serve", "call"):
+        print("用法: python openai_sip_stub.py serve | call <webhook_url>")
+        sys.exit(1)
+
+    if sys.argv[1] == "serve":
+        import uvicorn
+        uvicorn.run(app, host="127.0.0.1", port=STUB_PORT)
+    else:
+        url = sys.argv[2] if len(sys.argv) > 2 else "http://localhost:5000/openai-webhook"
+        asyncio.run(run_stub_with_call(url))
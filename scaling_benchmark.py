@@ -0,0 +1,199 @@
+"""
+单机通话容量基准测试
+用 serve.py 分别以 1..N 个 worker 启动服务，OpenAI 端替换为本地回声服务，
+多个压测进程模拟 Twilio 按 20ms 节奏推送音频帧，逐级增加并发通话数，
+直到回传帧的 p99 延迟超过阈值或丢帧，得到每种 worker 数下的可承载通话数。
+
+压测进程与服务在同一台机器上，会占用部分 CPU，结果偏保守。
+
+用法：python scaling_benchmark.py [最大 worker 数] [每级时长（秒）]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import tempfile
+import subprocess
+import multiprocessing
+from urllib.request import urlopen
+
+import websockets
+
+SERVER_PORT = 18500
+MOCK_OPENAI_PORT = 18600
+FRAME_INTERVAL = 0.02
+FRAME = base64.b64encode(bytes(range(160))).decode("utf-8")
+
+# 合格标准：回传帧 p99 延迟和丢帧率
+MAX_P99_MS = 50.0
+MAX_LOSS = 0.01
+CALL_LEVELS = [10, 25, 50, 100, 150, 200, 300, 400, 600, 800, 1200]
+
+
+# ==================== 回声 OpenAI 服务 ====================
+
+async def echo_handler(ws):
+    async for message in ws:
+        data = json.loads(message)
+        if data.get("type") == "input_audio_buffer.append":
+            await ws.send(json.dumps({"type": "response.audio.delta", "delta": data["audio"]}))
+
+
+def run_mock_openai(port: int):
+    async def main():
+        async with websockets.serve(echo_handler, "127.0.0.1", port, reuse_port=True):
+            await asyncio.Future()
+    asyncio.run(main())
+
+
+# ==================== 模拟 Twilio 通话 ====================
+
+async def simulated_call(call_sid: str, duration: float, results: list):
+    url = f"ws://127.0.0.1:{SERVER_PORT}/media-stream?call_sid={call_sid}&instructions=bench&voice=alloy"
+    sent_at = []
+    latencies = []
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({"event": "start", "start": {"streamSid": f"MZ{call_sid}"}}))
+
+        async def receiver():
+            async for message in ws:
+                if json.loads(message).get("event") == "media" and sent_at:
+                    latencies.append((time.perf_counter() - sent_at.pop(0)) * 1000)
+
+        receive_task = asyncio.create_task(receiver())
+        media = json.dumps({"event": "media", "media": {"payload": FRAME}})
+        started = time.perf_counter()
+        frames = int(duration / FRAME_INTERVAL)
+        for i in range(frames):
+            # 按绝对时间发送，避免累计漂移
+            await asyncio.sleep(max(0.0, started + i * FRAME_INTERVAL - time.perf_counter()))
+            sent_at.append(time.perf_counter())
+            await ws.send(media)
+        await asyncio.sleep(0.5)
+        await ws.send(json.dumps({"event": "stop"}))
+        receive_task.cancel()
+    results.append((frames, latencies))
+
+
+def run_load(args):
+    worker_index, calls, duration = args
+
+    async def main():
+        results = []
+        await asyncio.gather(*(
+            simulated_call(f"CA{worker_index:02d}{i:05d}", duration, results) for i in range(calls)
+        ), return_exceptions=True)
+        return results
+
+    results = asyncio.run(main())
+    sent = sum(frames for frames, _ in results)
+    latencies = [latency for _, call_latencies in results for latency in call_latencies]
+    return sent, latencies
+
+
+def measure_level(pool, load_processes: int, calls: int, duration: float):
+    shares = [calls // load_processes + (1 if i < calls % load_processes else 0) for i in range(load_processes)]
+    outcomes = pool.map(run_load, [(i, share, duration) for i, share in enumerate(shares) if share])
+    sent = sum(outcome[0] for outcome in outcomes)
+    latencies = sorted(latency for outcome in outcomes for latency in outcome[1])
+    if not latencies:
+        return float("inf"), 1.0
+    p99 = latencies[int(len(latencies) * 0.99)]
+    loss = 1 - len(latencies) / sent if sent else 1.0
+    return p99, loss
+
+
+# ==================== 启动服务 ====================
+
+def wait_ready(timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urlopen(f"http://127.0.0.1:{SERVER_PORT}/", timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+def start_server(workers: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "TWILIO_ACCOUNT_SID": "ACbenchmark",
+        "TWILIO_AUTH_TOKEN": "benchmark",
+        "TWILIO_PHONE_NUMBER": "+10000000000",
+        "OPENAI_API_KEY": "benchmark",
+        "PUBLIC_URL": f"http://127.0.0.1:{SERVER_PORT}",
+        "OPENAI_REALTIME_URL": f"ws://127.0.0.1:{MOCK_OPENAI_PORT}",
+        "TRANSCRIPT_SINK": "none",
+        "CONTEXT_STRATEGY": "none",
+        "MAX_ACTIVE_CALLS": "100000",
+        "MAX_LOOP_LAG_MS": "100000",
+        "MAX_CPU_PERCENT": "100000",
+        "DRAIN_ON_SIGTERM": "false",
+        "GREETING_CACHE_DIR": os.path.join(tempfile.gettempdir(), "scaling-benchmark-greetings"),
+    })
+    return subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py"), "--workers", str(workers), "--port", str(SERVER_PORT),
+         "--host", "127.0.0.1", "--cpu-affinity", "auto", "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def main():
+    cores = os.cpu_count() or 1
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else cores
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    load_processes = max(1, cores // 2)
+
+    mocks = [multiprocessing.Process(target=run_mock_openai, args=(MOCK_OPENAI_PORT,), daemon=True)
+             for _ in range(max(1, cores // 2))]
+    for mock in mocks:
+        mock.start()
+
+    worker_counts = sorted({1, *[n for n in (2, 4, 8, 16, 32, 64) if n <= max_workers], max_workers})
+    summary = []
+    with multiprocessing.Pool(load_processes) as pool:
+        for workers in worker_counts:
+            server = start_server(workers)
+            try:
+                wait_ready()
+                capacity, capacity_p99 = 0, None
+                for calls in CALL_LEVELS:
+                    p99, loss = measure_level(pool, load_processes, calls, duration)
+                    passed = p99 <= MAX_P99_MS and loss <= MAX_LOSS
+                    print(f"  {workers} worker, {calls:>5} 路: p99 {p99:7.1f} ms, 丢帧 {loss * 100:5.2f}% "
+                          f"{'✅' if passed else '❌'}", flush=True)
+                    if not passed:
+                        break
+                    capacity, capacity_p99 = calls, p99
+                summary.append((workers, capacity, capacity_p99))
+            finally:
+                stop_server(server)
+            time.sleep(1)
+
+    for mock in mocks:
+        mock.terminate()
+
+    print("=" * 60)
+    print(f"📊 单机通话容量（{cores} 核，p99 ≤ {MAX_P99_MS:.0f} ms 且丢帧 ≤ {MAX_LOSS * 100:.0f}%）")
+    print("=" * 60)
+    for workers, capacity, p99 in summary:
+        p99_text = f"{p99:.1f} ms" if p99 is not None else "-"
+        print(f"{workers:>3} worker: {capacity:>5} 路并发 (p99 {p99_text})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+生产环境启动器
+启动 N 个 worker 进程，通过 SO_REUSEPORT 共享同一个端口，由内核把新连接分配给各 worker；
+每个 worker 使用 uvloop（已安装时），可绑定到指定 CPU。
+
+通话粘性：
+- /twiml 的上下文（指令、语音、问候语）全部写在媒体流 URL 中，任何 worker 都能接起媒体流
+- 接起媒体流的 worker 在通话登记目录中登记自己的本机控制端口，
+  其他 worker 收到该通话的控制请求（如 /calls/{call_sid}/audio）时转发过去
+- 来电和外呼在拨号阶段占用的准入/租户名额也登记占用方，媒体流落到其他 worker 时
+  由接起的 worker 通知占用方释放，名额不会一直占到过期
+
+用法：
+    python serve.py --workers 4
+    python serve.py --workers 4 --cpu-affinity auto
+    python serve.py --workers 2 --cpu-affinity 2,3
+
+收到 SIGTERM 时转发给所有 worker，各 worker 排空通话后退出。
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib.util
+import multiprocessing
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("serve")
+
+DEFAULT_APP = "twilio_openai_agent_fastapi:asgi_app"
+
+
+def reuseport_socket(host: str, port: int) -> socket.socket:
+    """绑定一个允许多个进程共享的监听套接字"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def parse_affinity(value: str, workers: int):
+    """返回每个 worker 绑定的 CPU 列表，None 表示不绑定"""
+    if value == "none":
+        return [None] * workers
+    if value == "auto":
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = [int(cpu) for cpu in value.split(",")]
+    return [cpus[i % len(cpus)] for i in range(workers)]
+
+
+def run_worker(worker_id: int, app: str, host: str, port: int, cpu, loop: str, registry_dir: str, log_level: str):
+    """worker 进程入口"""
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+
+    public_sock = reuseport_socket(host, port)
+    # 仅本机可访问的控制端口，用于 worker 之间转发通话请求
+    internal_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    internal_sock.bind(("127.0.0.1", 0))
+
+    # 应用模块导入时读取这些配置
+    os.environ["WORKER_ID"] = str(worker_id)
+    os.environ["WORKER_INTERNAL_PORT"] = str(internal_sock.getsockname()[1])
+    os.environ["CALL_REGISTRY_DIR"] = registry_dir
+
+    import uvicorn
+
+    config = uvicorn.Config(app, loop=loop, log_level=log_level, lifespan="on")
+    server = uvicorn.Server(config)
+    logger.info(f"👷 worker {worker_id} 启动 (pid {os.getpid()}, CPU {cpu if cpu is not None else '-'}, {loop})")
+    server.run(sockets=[public_sock, internal_sock])
+
+
+class Supervisor:
+    """管理 worker 进程：异常退出时重启，收到 SIGTERM 时转发并等待全部退出"""
+
+    def __init__(self, args):
+        self.args = args
+        self.context = multiprocessing.get_context("spawn")
+        self.cpus = parse_affinity(args.cpu_affinity, args.workers)
+        self.loop = args.loop
+        if self.loop == "auto":
+            self.loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+        self.registry_dir = tempfile.mkdtemp(prefix="agent-calls-")
+        self.processes = {}
+        self.stopping = False
+
+    def spawn(self, worker_id: int):
+        process = self.context.Process(
+            target=run_worker,
+            args=(worker_id, self.args.app, self.args.host, self.args.port, self.cpus[worker_id],
+                  self.loop, self.registry_dir, self.args.log_level),
+            name=f"worker-{worker_id}"
+        )
+        process.start()
+        self.processes[worker_id] = process
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f"🛑 收到信号 {signum}，通知 {len(self.processes)} 个 worker 排空后退出")
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        logger.info(f"🚀 在 {self.args.host}:{self.args.port} 启动 {self.args.workers} 个 worker ({self.loop})")
+        for worker_id in range(self.args.workers):
+            self.spawn(worker_id)
+
+        try:
+            while self.processes:
+                time.sleep(0.5)
+                for worker_id, process in list(self.processes.items()):
+                    if process.is_alive():
+                        continue
+                    del self.processes[worker_id]
+                    if not self.stopping:
+                        logger.warning(f"⚠️ worker {worker_id} 异常退出 (code {process.exitcode})，正在重启")
+                        self.spawn(worker_id)
+        finally:
+            shutil.rmtree(self.registry_dir, ignore_errors=True)
+        logger.info("🔚 所有 worker 已退出")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多进程启动 Twilio + OpenAI Realtime Agent")
+    parser.add_argument("--app", default=DEFAULT_APP, help="ASGI 应用（模块:变量）")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "5000")))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--cpu-affinity", default="none", help="none / auto / 逗号分隔的 CPU 编号")
+    parser.add_argument("--loop", default="auto", choices=["auto", "uvloop", "asyncio"])
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("当前平台不支持 SO_REUSEPORT，请使用单进程方式启动")
+
+    Supervisor(args).run()
+
+
+if __name__ == "__main__":
+    main()
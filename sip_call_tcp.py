@@ -10,23 +10,24 @@ load_dotenv()
 # SIP 用户配置
 SIP_USERNAME = os.getenv("SIP_USERNAME")
 SIP_PASSWORD = os.getenv("SIP_PASSWORD")
-SIP_PORT = 6070
-SIP_SERVER = "119.8.185.241"
+SIP_PORT = int(os.getenv("SIP_PORT", "6070"))
+SIP_SERVER = os.getenv("SIP_SERVER", "119.8.185.241")
 LOCAL_IP = "0.0.0.0"
 LOCAL_PORT = random.randint(20000, 40000)  # 本地随机端口
 
 # 生成 REGISTER 请求
-def build_register(username, server, local_ip, local_port, call_id, cseq, branch, auth_header=None):
+def build_register(username, server, local_ip, local_port, call_id, cseq, branch, auth_header=None,
+                   expires=3600, transport="TCP"):
     message = (
         f"REGISTER sip:{server} SIP/2.0\r\n"
-        f"Via: SIP/2.0/TCP {local_ip}:{local_port};branch={branch};rport\r\n"
+        f"Via: SIP/2.0/{transport} {local_ip}:{local_port};branch={branch};rport\r\n"
         f"Max-Forwards: 70\r\n"
         f"To: <sip:{username}@{server}>\r\n"
         f"From: <sip:{username}@{server}>;tag=123456\r\n"
         f"Call-ID: {call_id}@{local_ip}\r\n"
         f"CSeq: {cseq} REGISTER\r\n"
         f"Contact: <sip:{username}@{local_ip}:{local_port}>\r\n"
-        f"Expires: 3600\r\n"
+        f"Expires: {expires}\r\n"
     )
     if auth_header:
         message += f"{auth_header}\r\n"
@@ -136,10 +137,10 @@ def sip_register_with_auth(sock, call_id, cseq, branch):
         return None, None
 
 # 构造 ACK 请求
-def build_ack(request_uri, from_header, to_header, call_id, cseq, branch, local_ip, local_port):
+def build_ack(request_uri, from_header, to_header, call_id, cseq, branch, local_ip, local_port, transport="TCP"):
     message = (
         f"ACK {request_uri} SIP/2.0\r\n"
-        f"Via: SIP/2.0/TCP {local_ip}:{local_port};branch={branch};rport\r\n"
+        f"Via: SIP/2.0/{transport} {local_ip}:{local_port};branch={branch};rport\r\n"
         f"Max-Forwards: 70\r\n"
         f"To: {to_header}\r\n"
         f"From: {from_header}\r\n"
@@ -149,8 +150,40 @@ def build_ack(request_uri, from_header, to_header, call_id, cseq, branch, local_
     )
     return message
 
+# 构造 CANCEL 请求（取消尚未收到最终响应的 INVITE）
+# Request-URI、From、To（不带 to-tag）、Call-ID、branch 和 CSeq 序号都必须与被取消的 INVITE 相同
+def build_cancel(request_uri, from_header, to_header, call_id, cseq, branch, local_ip, local_port, transport="TCP"):
+    message = (
+        f"CANCEL {request_uri} SIP/2.0\r\n"
+        f"Via: SIP/2.0/{transport} {local_ip}:{local_port};branch={branch};rport\r\n"
+        f"Max-Forwards: 70\r\n"
+        f"To: {to_header}\r\n"
+        f"From: {from_header}\r\n"
+        f"Call-ID: {call_id}\r\n"
+        f"CSeq: {cseq} CANCEL\r\n"
+        "Content-Length: 0\r\n\r\n"
+    )
+    return message
+
+# 构造 OPTIONS 请求（用于保活和探测代理健康状态）
+def build_options(username, server, local_ip, local_port, call_id, cseq, branch, transport="TCP"):
+    message = (
+        f"OPTIONS sip:{server} SIP/2.0\r\n"
+        f"Via: SIP/2.0/{transport} {local_ip}:{local_port};branch={branch};rport\r\n"
+        f"Max-Forwards: 70\r\n"
+        f"To: <sip:{server}>\r\n"
+        f"From: <sip:{username}@{server}>;tag={random.randint(100000, 999999)}\r\n"
+        f"Call-ID: {call_id}\r\n"
+        f"CSeq: {cseq} OPTIONS\r\n"
+        f"Contact: <sip:{username}@{local_ip}:{local_port}>\r\n"
+        "Accept: application/sdp\r\n"
+        "Content-Length: 0\r\n\r\n"
+    )
+    return message
+
 # 构造 INVITE 请求
-def build_invite(username, server, local_ip, local_port, call_id, cseq, branch, to_number, from_tag, auth_header=None):
+def build_invite(username, server, local_ip, local_port, call_id, cseq, branch, to_number, from_tag, auth_header=None,
+                 transport="TCP"):
     uri = f"sip:{to_number}@{server}"
     from_uri = f"sip:{username}@{server}"
     to_uri = f"sip:{to_number}@{server}"
@@ -167,7 +200,7 @@ def build_invite(username, server, local_ip, local_port, call_id, cseq, branch,
     )
     message = (
         f"INVITE {uri} SIP/2.0\r\n"
-        f"Via: SIP/2.0/TCP {local_ip}:{local_port};branch={branch};rport\r\n"
+        f"Via: SIP/2.0/{transport} {local_ip}:{local_port};branch={branch};rport\r\n"
         f"Max-Forwards: 70\r\n"
         f"To: <{to_uri}>\r\n"
         f"From: <{from_uri}>;tag={from_tag}\r\n"
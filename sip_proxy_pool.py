@@ -0,0 +1,429 @@
+"""
+多 SIP 代理故障切换
+通过 SIP_PROXIES 配置一组代理，定时用 OPTIONS 探测往返时延和健康状态，
+外呼时按时延从低到高选择代理，代理无响应或返回 5xx 时自动切换到下一个，
+并按代理统计拨号时延。已收到 1xx 的呼叫超时只说明被叫未接，
+发送 CANCEL 后直接返回，不切换代理，也不把代理标记为故障。
+
+python sip_proxy_pool.py --mock 在本地启动几个模拟代理（注入时延、503、无响应、只振铃不接听），
+验证探测、故障切换和 CANCEL。
+"""
+
+import os
+import time
+import uuid
+import ssl
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from sip_call_tcp import SIP_SERVER, SIP_PORT, SIP_USERNAME, build_options
+from sip_registration import (
+    SIP_TRANSPORT,
+    SipRegistrationManager,
+    new_branch,
+    parse_status,
+    split_sip_messages,
+)
+
+logger = logging.getLogger(__name__)
+
+# 代理池配置，格式：host:port,host:port
+SIP_PROXIES = os.getenv("SIP_PROXIES", f"{SIP_SERVER}:{SIP_PORT}")
+SIP_PROBE_INTERVAL = int(os.getenv("SIP_PROBE_INTERVAL", "15"))
+SIP_PROBE_TIMEOUT = float(os.getenv("SIP_PROBE_TIMEOUT", "2"))
+SIP_DIAL_RESPONSE_TIMEOUT = float(os.getenv("SIP_DIAL_RESPONSE_TIMEOUT", "3"))
+
+# 时延平滑系数（EWMA）
+RTT_ALPHA = 0.3
+
+
+def parse_proxy_list(value: str) -> List[tuple]:
+    """解析 "host:port,host:port" 格式的代理列表"""
+    proxies = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.rpartition(":")
+        if not host:
+            host, port = port, str(SIP_PORT)
+        proxies.append((host, int(port)))
+    return proxies
+
+
+class SipProxy:
+    """单个代理的健康状态与统计"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.rtt_ms: Optional[float] = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_probe = 0.0
+        self.dials = 0
+        self.dial_failures = 0
+        self.dial_latency_ms_total = 0.0
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def record_rtt(self, rtt_ms: float):
+        self.rtt_ms = rtt_ms if self.rtt_ms is None else RTT_ALPHA * rtt_ms + (1 - RTT_ALPHA) * self.rtt_ms
+        self.healthy = True
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.healthy = False
+
+    def stats(self) -> dict:
+        return {
+            "proxy": self.address,
+            "healthy": self.healthy,
+            "rtt_ms": round(self.rtt_ms, 1) if self.rtt_ms is not None else None,
+            "dials": self.dials,
+            "dial_failures": self.dial_failures,
+            "avg_dial_latency_ms": round(self.dial_latency_ms_total / self.dials, 1) if self.dials else None,
+        }
+
+
+def probe_proxy(
+    proxy: SipProxy, timeout: float = SIP_PROBE_TIMEOUT, transport: str = SIP_TRANSPORT
+) -> Optional[float]:
+    """
+    按实际外呼使用的传输方式（tcp 或 tls）向代理发送一次 OPTIONS，返回往返时延（毫秒）
+    任意非 5xx 响应（包括 401/405）都说明代理存活；超时、TLS 握手失败或 5xx 返回 None
+    """
+    started = time.monotonic()
+    try:
+        sock = socket.create_connection((proxy.host, proxy.port), timeout=timeout)
+        if transport == "tls":
+            try:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=proxy.host)
+            except OSError:
+                sock.close()
+                raise
+        with sock:
+            sock.settimeout(timeout)
+            local_ip, local_port = sock.getsockname()[:2]
+            call_id = str(uuid.uuid4()).replace("-", "")[:16]
+            sock.sendall(build_options(
+                SIP_USERNAME, proxy.host, local_ip, local_port, call_id, 1, new_branch(), transport=transport.upper()
+            ).encode())
+
+            buffer = bytearray()
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return None
+                buffer.extend(chunk)
+                for message in split_sip_messages(buffer):
+                    status, _ = parse_status(message)
+                    if status is None or status < 200:
+                        continue
+                    if status >= 500:
+                        return None
+                    return (time.monotonic() - started) * 1000
+    except OSError:
+        return None
+    finally:
+        proxy.last_probe = time.time()
+
+
+class SipProxyPool:
+    """
+    SIP 代理池
+
+    后台线程定时探测所有代理；dial() 按时延顺序尝试，
+    每个代理复用各自的 SipRegistrationManager 长连接。
+    """
+
+    def __init__(
+        self,
+        proxies: Optional[List[tuple]] = None,
+        probe_interval: float = SIP_PROBE_INTERVAL,
+        probe_timeout: float = SIP_PROBE_TIMEOUT,
+        response_timeout: float = SIP_DIAL_RESPONSE_TIMEOUT,
+        **manager_kwargs,
+    ):
+        self.proxies = [SipProxy(host, port) for host, port in (proxies or parse_proxy_list(SIP_PROXIES))]
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.response_timeout = response_timeout
+        self.manager_kwargs = manager_kwargs
+        # 探测与外呼走同一种传输方式，否则 TLS 端口会被明文探测误判为故障
+        self.transport = manager_kwargs.get("transport", SIP_TRANSPORT)
+        self._managers: Dict[str, SipRegistrationManager] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.proxies), 1), thread_name_prefix="sip-probe")
+
+    # ==================== 探测 ====================
+
+    def probe_all(self):
+        """并发探测所有代理，更新时延与健康状态"""
+        results = self._executor.map(lambda p: (p, probe_proxy(p, self.probe_timeout, self.transport)), self.proxies)
+        for proxy, rtt_ms in results:
+            if rtt_ms is None:
+                proxy.record_failure()
+                logger.warning(f"⚠️ SIP proxy {proxy.address} probe failed")
+            else:
+                proxy.record_rtt(rtt_ms)
+
+    def start(self):
+        """首次同步探测后启动后台探测线程"""
+        self.probe_all()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._probe_loop, name="sip-proxy-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        for manager in self._managers.values():
+            manager.stop()
+        self._executor.shutdown(wait=False)
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval):
+            self.probe_all()
+
+    # ==================== 选择与拨号 ====================
+
+    def candidates(self) -> List[SipProxy]:
+        """健康代理按时延升序排在前面，不健康的代理作为最后的兜底"""
+        def key(proxy: SipProxy):
+            rtt = proxy.rtt_ms if proxy.rtt_ms is not None else float("inf")
+            return (not proxy.healthy, rtt, proxy.consecutive_failures)
+        return sorted(self.proxies, key=key)
+
+    def select(self) -> Optional[SipProxy]:
+        candidates = self.candidates()
+        return candidates[0] if candidates else None
+
+    def _manager(self, proxy: SipProxy) -> SipRegistrationManager:
+        with self._lock:
+            manager = self._managers.get(proxy.address)
+            if manager is None:
+                manager = SipRegistrationManager(server=proxy.host, port=proxy.port, **self.manager_kwargs)
+                manager.start()
+                self._managers[proxy.address] = manager
+            return manager
+
+    def dial(self, to_number: str, timeout: float = 30.0) -> dict:
+        """
+        按时延顺序尝试各代理发起呼叫
+
+        只有代理本身的问题才切换到下一个代理：连接/注册失败、没有任何响应、或返回 5xx。
+        已收到 1xx 后超时是被叫未接，invite() 已发送 CANCEL，直接返回结果，
+        既不重拨到其他代理（避免被叫重复振铃），也不把代理标记为故障。
+
+        Returns:
+            dict: invite() 的结果，附加实际使用的代理和尝试记录
+        """
+        attempts = []
+        for proxy in self.candidates():
+            manager = self._manager(proxy)
+            started = time.monotonic()
+            try:
+                if not manager.wait_registered(self.response_timeout):
+                    raise ConnectionError("not registered")
+                result = manager.invite(to_number, timeout=timeout, response_timeout=self.response_timeout)
+            except (OSError, RuntimeError) as e:
+                result = {"status": None, "reason": str(e), "setup_ms": (time.monotonic() - started) * 1000}
+
+            proxy.dials += 1
+            proxy.dial_latency_ms_total += result["setup_ms"]
+            attempts.append({"proxy": proxy.address, "status": result["status"], "setup_ms": result["setup_ms"]})
+
+            status = result["status"]
+            proxy_failed = status is None and not result.get("provisional")
+            if proxy_failed or (status is not None and status >= 500):
+                proxy.dial_failures += 1
+                proxy.record_failure()
+                logger.warning(f"⚠️ Dial via {proxy.address} failed ({status} {result['reason']}), failing over")
+                continue
+
+            if status is None:
+                logger.info(f"📵 Dial via {proxy.address}: no answer after ringing, cancelled")
+            else:
+                logger.info(f"📞 Dial via {proxy.address}: {status} in {result['setup_ms']:.0f} ms")
+            return {**result, "proxy": proxy.address, "attempts": attempts}
+
+        return {"status": None, "reason": "all proxies failed", "proxy": None, "attempts": attempts}
+
+    def stats(self) -> List[dict]:
+        """按代理汇总的时延和拨号统计"""
+        return [proxy.stats() for proxy in self.candidates()]
+
+
+def run_mock_checks() -> bool:
+    """
+    本地模拟代理验证：每个模拟代理可以注入时延、让 OPTIONS/INVITE 返回 503、完全不响应，
+    或对 INVITE 只振铃不接听（收到 CANCEL 后回 487）
+    """
+    from sip_registration import parse_header
+
+    class MockProxy:
+        def __init__(self, invite: str = "answer", options: Optional[int] = 200, delay: float = 0.0):
+            self.invite = invite  # answer / 503 / silent / ring
+            self.options = options  # None 表示不响应 OPTIONS
+            self.delay = delay
+            self.invites = 0
+            self.cancels = 0
+            self._pending: Dict[str, bytes] = {}
+            self._server = socket.create_server(("127.0.0.1", 0))
+            self.port = self._server.getsockname()[1]
+            threading.Thread(target=self._accept_loop, daemon=True).start()
+
+        def _accept_loop(self):
+            while True:
+                try:
+                    conn, _ = self._server.accept()
+                except OSError:
+                    return
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+        def _serve(self, conn: socket.socket):
+            buffer = bytearray()
+            with conn:
+                while True:
+                    try:
+                        chunk = conn.recv(65536)
+                    except OSError:
+                        return
+                    if not chunk:
+                        return
+                    buffer.extend(chunk)
+                    for message in split_sip_messages(buffer):
+                        self._handle(conn, message)
+
+        def _reply(self, conn: socket.socket, request: bytes, status: int, reason: str, to_tag: bool = False):
+            lines = [f"SIP/2.0 {status} {reason}"]
+            for name in ("Via", "From", "To", "Call-ID", "CSeq"):
+                value = parse_header(request, name)
+                if name == "To" and to_tag:
+                    value += ";tag=mock"
+                lines.append(f"{name}: {value}")
+            if request.startswith(b"REGISTER "):
+                lines.append("Expires: 3600")
+            lines.append("Content-Length: 0")
+            try:
+                conn.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+            except OSError:
+                pass
+
+        def _handle(self, conn: socket.socket, message: bytes):
+            method = message.split(b" ", 1)[0]
+            if method == b"REGISTER":
+                self._reply(conn, message, 200, "OK")
+            elif method == b"OPTIONS" and self.options:
+                time.sleep(self.delay)
+                self._reply(conn, message, self.options, "OK" if self.options < 300 else "Service Unavailable")
+            elif method == b"INVITE":
+                self.invites += 1
+                if self.invite == "silent":
+                    return
+                time.sleep(self.delay)
+                if self.invite == "503":
+                    self._reply(conn, message, 503, "Service Unavailable", to_tag=True)
+                    return
+                self._reply(conn, message, 100, "Trying")
+                if self.invite == "ring":
+                    self._pending[parse_header(message, "Call-ID")] = message
+                    self._reply(conn, message, 180, "Ringing", to_tag=True)
+                else:
+                    self._reply(conn, message, 200, "OK", to_tag=True)
+            elif method == b"CANCEL":
+                self.cancels += 1
+                self._reply(conn, message, 200, "OK")
+                invite = self._pending.pop(parse_header(message, "Call-ID"), None)
+                if invite:
+                    self._reply(conn, invite, 487, "Request Terminated", to_tag=True)
+
+        def close(self):
+            self._server.close()
+
+    results = []
+
+    def check(label: str, ok: bool):
+        results.append(ok)
+        print(f"{'✅' if ok else '❌'} {label}")
+
+    def make_pool(*mocks: MockProxy) -> SipProxyPool:
+        pool = SipProxyPool([("127.0.0.1", mock.port) for mock in mocks], probe_interval=3600,
+                            probe_timeout=0.5, response_timeout=0.5, transport="tcp", keepalive_interval=3600)
+        pool.start()
+        return pool
+
+    # 1. 探测：按时延排序，OPTIONS 503 或无响应的代理标记为故障；TLS 探测不能被明文端口冒充
+    fast, slow, broken, silent = (MockProxy(delay=0.01), MockProxy(delay=0.1),
+                                  MockProxy(options=503), MockProxy(options=None))
+    pool = make_pool(slow, broken, fast, silent)
+    order = [proxy.port for proxy in pool.candidates()]
+    check("probe orders healthy proxies by RTT", order[:2] == [fast.port, slow.port])
+    check("probe marks 503/silent proxies unhealthy",
+          [proxy.healthy for proxy in pool.candidates()] == [True, True, False, False])
+    plaintext = SipProxy("127.0.0.1", fast.port)
+    check("tcp probe of plaintext proxy succeeds", probe_proxy(plaintext, 0.5, "tcp") is not None)
+    check("tls probe of plaintext proxy fails", probe_proxy(plaintext, 0.5, "tls") is None)
+    pool.stop()
+
+    # 2. INVITE 返回 503 → 切换到下一个代理
+    first, second = MockProxy(invite="503", delay=0.01), MockProxy(delay=0.1)
+    pool = make_pool(first, second)
+    result = pool.dial("10086")
+    check("5xx fails over to next proxy", result["status"] == 200 and result["proxy"].endswith(str(second.port)))
+    check("5xx marks proxy unhealthy", not pool.proxies[0].healthy)
+    pool.stop()
+
+    # 3. INVITE 没有任何响应 → 切换到下一个代理
+    first, second = MockProxy(invite="silent", delay=0.01), MockProxy(delay=0.1)
+    pool = make_pool(first, second)
+    result = pool.dial("10086")
+    check("no response fails over to next proxy",
+          result["status"] == 200 and [a["status"] for a in result["attempts"]] == [None, 200])
+    pool.stop()
+
+    # 4. 振铃后无人接听 → CANCEL，不切换代理、不标记故障
+    first, second = MockProxy(invite="ring", delay=0.01), MockProxy(delay=0.1)
+    pool = make_pool(first, second)
+    result = pool.dial("10086", timeout=1.0)
+    time.sleep(0.1)
+    check("unanswered INVITE is cancelled", result["status"] is None and first.cancels == 1)
+    check("unanswered INVITE does not fail over", second.invites == 0 and len(result["attempts"]) == 1)
+    check("unanswered INVITE keeps proxy healthy", pool.proxies[0].healthy)
+    pool.stop()
+
+    return all(results)
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "--mock":
+        sys.exit(0 if run_mock_checks() else 1)
+
+    if len(sys.argv) < 2:
+        print("❌ No destination number specified, usage: python sip_proxy_pool.py <number> | --mock")
+        sys.exit(1)
+    pool = SipProxyPool()
+    pool.start()
+    try:
+        for proxy in pool.stats():
+            print(f"🌐 {proxy['proxy']}: healthy={proxy['healthy']} rtt={proxy['rtt_ms']} ms")
+        result = pool.dial(sys.argv[1])
+        print(f"📞 Result: {result['status']} {result['reason']} via {result['proxy']}")
+        for proxy in pool.stats():
+            print(f"📊 {proxy}")
+    finally:
+        pool.stop()
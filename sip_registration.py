@@ -0,0 +1,547 @@
+"""
+持久化 SIP 注册管理器
+保持与 SIP 服务器的 TCP/TLS 长连接，在注册过期前自动刷新，
+定时发送保活（CRLF ping 或 OPTIONS），断线后按指数退避重连。
+所有外呼 INVITE 复用同一条已注册的连接，省去每次呼叫的建连和两次 REGISTER 往返。
+"""
+
+import os
+import re
+import ssl
+import time
+import queue
+import random
+import socket
+import logging
+import threading
+import uuid
+from typing import Dict, Optional
+
+from sip_call_tcp import (
+    SIP_USERNAME,
+    SIP_PASSWORD,
+    SIP_SERVER,
+    SIP_PORT,
+    build_register,
+    build_invite,
+    build_ack,
+    build_cancel,
+    build_options,
+    parse_authenticate_header,
+    generate_authorization,
+)
+
+logger = logging.getLogger(__name__)
+
+# 注册配置
+SIP_TRANSPORT = os.getenv("SIP_TRANSPORT", "tcp").lower()  # tcp 或 tls
+SIP_REGISTER_EXPIRES = int(os.getenv("SIP_REGISTER_EXPIRES", "3600"))
+SIP_REFRESH_MARGIN = int(os.getenv("SIP_REFRESH_MARGIN", "300"))  # 过期前多少秒刷新（不超过授予有效期的一半）
+SIP_KEEPALIVE_INTERVAL = int(os.getenv("SIP_KEEPALIVE_INTERVAL", "30"))
+SIP_KEEPALIVE_MODE = os.getenv("SIP_KEEPALIVE_MODE", "crlf").lower()  # crlf 或 options
+SIP_MAX_BACKOFF = int(os.getenv("SIP_MAX_BACKOFF", "60"))
+
+# RFC 3261 及扩展中的方法：认识但不处理的回 405，不认识的回 501
+SIP_METHODS = ("INVITE", "ACK", "BYE", "CANCEL", "OPTIONS", "REGISTER", "PRACK", "SUBSCRIBE", "NOTIFY",
+               "PUBLISH", "INFO", "REFER", "MESSAGE", "UPDATE")
+# 作为被叫方接受的方法（405 响应的 Allow 头）
+ALLOWED_METHODS = ("ACK", "BYE", "OPTIONS")
+
+
+def new_branch() -> str:
+    return f"z9hG4bK{random.randint(100000, 999999)}"
+
+
+def parse_status(message: bytes):
+    """解析 SIP 响应的状态码和原因短语，请求消息返回 (None, None)"""
+    first_line = message.split(b"\r\n", 1)[0].decode(errors="ignore")
+    match = re.match(r"SIP/2\.0 (\d{3}) ?(.*)", first_line)
+    if not match:
+        return None, None
+    return int(match.group(1)), match.group(2)
+
+
+def parse_header(message: bytes, name: str) -> Optional[str]:
+    """读取指定头部的值（大小写不敏感）"""
+    text = message.decode(errors="ignore")
+    match = re.search(rf"^{name}:\s*(.*?)\r?$", text, re.IGNORECASE | re.MULTILINE)
+    return match.group(1).strip() if match else None
+
+
+def split_sip_messages(buffer: bytearray):
+    """
+    从 TCP 字节流中切分完整的 SIP 消息
+    按 Content-Length 定界，保活用的空行（CRLF pong）直接丢弃
+    """
+    messages = []
+    while True:
+        # 丢弃保活用的 CRLF
+        while buffer[:2] == b"\r\n":
+            del buffer[:2]
+
+        header_end = buffer.find(b"\r\n\r\n")
+        if header_end < 0:
+            break
+
+        headers = bytes(buffer[:header_end])
+        match = re.search(rb"^(?:Content-Length|l):\s*(\d+)", headers, re.IGNORECASE | re.MULTILINE)
+        body_length = int(match.group(1)) if match else 0
+        total = header_end + 4 + body_length
+        if len(buffer) < total:
+            break
+
+        messages.append(bytes(buffer[:total]))
+        del buffer[:total]
+    return messages
+
+
+class SipRegistrationManager:
+    """
+    长连接 SIP 注册管理器
+
+    后台线程负责连接、注册、刷新、保活和重连；
+    读线程按 Call-ID 把收到的消息分发给各自的事务队列，
+    因此多个 INVITE 可以在同一条连接上并发进行。
+    """
+
+    def __init__(
+        self,
+        server: str = SIP_SERVER,
+        port: int = SIP_PORT,
+        username: Optional[str] = SIP_USERNAME,
+        password: Optional[str] = SIP_PASSWORD,
+        transport: str = SIP_TRANSPORT,
+        expires: int = SIP_REGISTER_EXPIRES,
+        refresh_margin: int = SIP_REFRESH_MARGIN,
+        keepalive_interval: int = SIP_KEEPALIVE_INTERVAL,
+        keepalive_mode: str = SIP_KEEPALIVE_MODE,
+        max_backoff: int = SIP_MAX_BACKOFF,
+        request_timeout: float = 5.0,
+    ):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.transport = transport
+        self.expires = expires
+        self.refresh_margin = refresh_margin
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_mode = keepalive_mode
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+
+        self._sock: Optional[socket.socket] = None
+        self._send_lock = threading.Lock()
+        self._transactions: Dict[str, queue.Queue] = {}
+        self._transactions_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._registered = threading.Event()
+        self._disconnected = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.local_ip = "0.0.0.0"
+        self.local_port = 0
+        self._register_call_id = str(uuid.uuid4()).replace("-", "")[:16]
+        self._cseq = random.randint(100, 999)
+        self._auth: Optional[tuple] = None  # 缓存 (realm, nonce)，刷新时直接带认证
+        self.registered_until = 0.0
+        self.granted_expires = expires  # 服务器最近一次授予的有效期（秒）
+        self.reconnects = 0
+
+    # ==================== 生命周期 ====================
+
+    def start(self, wait: float = 0):
+        """启动后台维护线程，可选择等待首次注册完成"""
+        if self._thread and self._thread.is_alive():
+            return self.is_registered
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sip-registration", daemon=True)
+        self._thread.start()
+        if wait:
+            return self._registered.wait(wait)
+        return False
+
+    def stop(self):
+        """停止维护线程并关闭连接"""
+        self._stop.set()
+        self._close()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    @property
+    def is_registered(self) -> bool:
+        return self._registered.is_set() and time.monotonic() < self.registered_until
+
+    def wait_registered(self, timeout: Optional[float] = None) -> bool:
+        return self._registered.wait(timeout)
+
+    # ==================== 连接管理 ====================
+
+    def _connect(self):
+        raw = socket.create_connection((self.server, self.port), timeout=self.request_timeout)
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        raw.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.transport == "tls":
+            context = ssl.create_default_context()
+            raw = context.wrap_socket(raw, server_hostname=self.server)
+        raw.settimeout(None)
+        self.local_ip, self.local_port = raw.getsockname()[:2]
+        self._sock = raw
+        self._disconnected.clear()
+        threading.Thread(target=self._reader_loop, args=(raw,), name="sip-reader", daemon=True).start()
+        logger.info(f"🔌 SIP connection established: {self.server}:{self.port} ({self.transport})")
+
+    def _close(self):
+        sock, self._sock = self._sock, None
+        self._registered.clear()
+        if sock:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _run(self):
+        """连接 → 注册 → 刷新/保活循环；任何异常都按退避重连"""
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                self._connect()
+                self._register()
+                backoff = 1.0
+                self._maintain()
+            except (OSError, RuntimeError) as e:
+                if not self._stop.is_set():
+                    logger.warning(f"⚠️ SIP connection lost: {e}")
+            finally:
+                self._close()
+
+            if self._stop.is_set():
+                break
+            self.reconnects += 1
+            delay = min(backoff, self.max_backoff) * random.uniform(0.5, 1.0)
+            logger.info(f"🔄 Reconnecting to SIP server in {delay:.1f}s")
+            self._stop.wait(delay)
+            backoff *= 2
+
+    def _maintain(self):
+        """在连接存活期间定时保活，并在过期前刷新注册"""
+        next_keepalive = time.monotonic() + self.keepalive_interval
+        while not self._stop.is_set():
+            if self._disconnected.wait(1.0):
+                raise RuntimeError("connection closed by server")
+
+            now = time.monotonic()
+            # 服务器授予的有效期可能比余量还短，余量不超过一半，否则每秒都会重新注册
+            margin = min(self.refresh_margin, self.granted_expires / 2)
+            if now >= self.registered_until - margin:
+                self._register()
+            if now >= next_keepalive:
+                self._keepalive()
+                next_keepalive = now + self.keepalive_interval
+
+    def _reader_loop(self, sock: socket.socket):
+        """读线程：切分消息并按 Call-ID 分发"""
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                buffer.extend(chunk)
+                for message in split_sip_messages(buffer):
+                    self._dispatch(message)
+        except OSError:
+            pass
+        finally:
+            if sock is self._sock:
+                self._disconnected.set()
+
+    def _dispatch(self, message: bytes):
+        call_id = parse_header(message, "Call-ID") or parse_header(message, "i")
+        status, _ = parse_status(message)
+
+        # 服务器主动发来的请求：OPTIONS/BYE 回 200 OK，其他方法本客户端不处理
+        if status is None:
+            method = message.split(b" ", 1)[0].decode(errors="replace")
+            if method in ("OPTIONS", "BYE"):
+                self._reply(message, 200, "OK")
+            elif method in SIP_METHODS:
+                if method != "ACK":
+                    self._reply(message, 405, "Method Not Allowed", f"Allow: {', '.join(ALLOWED_METHODS)}")
+            else:
+                self._reply(message, 501, "Not Implemented")
+
+        with self._transactions_lock:
+            target = self._transactions.get(call_id)
+        if target:
+            target.put(message)
+        else:
+            logger.debug(f"SIP message without transaction: {message[:80]!r}")
+
+    def _reply(self, request: bytes, status: int, reason: str, *extra_headers: str):
+        lines = [f"SIP/2.0 {status} {reason}"]
+        for name in ("Via", "From", "To", "Call-ID", "CSeq"):
+            value = parse_header(request, name)
+            if value:
+                lines.append(f"{name}: {value}")
+        lines.extend(extra_headers)
+        lines.append("Content-Length: 0")
+        try:
+            self.send("\r\n".join(lines) + "\r\n\r\n")
+        except OSError:
+            pass
+
+    # ==================== 发送与事务 ====================
+
+    def send(self, message: str):
+        """在共享连接上发送一条消息（线程安全）"""
+        sock = self._sock
+        if sock is None:
+            raise ConnectionError("SIP connection is not established")
+        with self._send_lock:
+            sock.sendall(message.encode())
+
+    def open_transaction(self, call_id: str) -> queue.Queue:
+        q = queue.Queue()
+        with self._transactions_lock:
+            self._transactions[call_id] = q
+        return q
+
+    def close_transaction(self, call_id: str):
+        with self._transactions_lock:
+            self._transactions.pop(call_id, None)
+
+    def request(self, message: str, call_id: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """发送请求并等待第一个最终响应（跳过 1xx）"""
+        q = self.open_transaction(call_id)
+        try:
+            self.send(message)
+            deadline = time.monotonic() + (timeout or self.request_timeout)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    response = q.get(timeout=remaining)
+                except queue.Empty:
+                    return None
+                status, _ = parse_status(response)
+                if status and status >= 200:
+                    return response
+        finally:
+            self.close_transaction(call_id)
+
+    # ==================== 注册与保活 ====================
+
+    def _register(self):
+        call_id = f"{self._register_call_id}@{self.local_ip}"
+        uri = f"sip:{self.server}"
+
+        def send_register(auth_header=None):
+            self._cseq += 1
+            msg = build_register(
+                self.username, self.server, self.local_ip, self.local_port,
+                self._register_call_id, self._cseq, new_branch(),
+                auth_header=auth_header, expires=self.expires, transport=self.transport.upper()
+            )
+            return self.request(msg, call_id)
+
+        # 刷新时复用缓存的 nonce，可以省掉一次 401 往返
+        auth_header = None
+        if self._auth:
+            auth_header = generate_authorization(self.username, self.password, *self._auth, uri)
+        response = send_register(auth_header)
+
+        if response and parse_status(response)[0] == 401:
+            realm, nonce = parse_authenticate_header(response)
+            if not realm or not nonce:
+                raise RuntimeError("failed to parse realm and nonce")
+            self._auth = (realm, nonce)
+            auth_header = generate_authorization(self.username, self.password, realm, nonce, uri)
+            response = send_register(auth_header)
+
+        if not response:
+            raise TimeoutError("no response received for REGISTER")
+        status, reason = parse_status(response)
+        if status != 200:
+            raise RuntimeError(f"REGISTER failed: {status} {reason}")
+
+        # 以服务器实际授予的有效期为准
+        granted = parse_header(response, "Expires")
+        contact = parse_header(response, "Contact") or ""
+        match = re.search(r"expires=(\d+)", contact)
+        expires = int(match.group(1)) if match else int(granted) if granted and granted.isdigit() else self.expires
+        self.registered_until = time.monotonic() + expires
+        self.granted_expires = expires
+        self._registered.set()
+        logger.info(f"✅ SIP registered, expires in {expires}s")
+
+    def _keepalive(self):
+        if self.keepalive_mode == "options":
+            call_id = str(uuid.uuid4()).replace("-", "")[:16]
+            msg = build_options(
+                self.username, self.server, self.local_ip, self.local_port,
+                call_id, 1, new_branch(), transport=self.transport.upper()
+            )
+            if self.request(msg, call_id) is None:
+                raise TimeoutError("OPTIONS keepalive timed out")
+        else:
+            # RFC 5626 双 CRLF ping
+            self.send("\r\n\r\n")
+
+    # ==================== 外呼 ====================
+
+    def invite(self, to_number: str, timeout: float = 30.0, response_timeout: Optional[float] = None) -> dict:
+        """
+        在已注册的共享连接上发起一次呼叫，处理 407 代理认证
+
+        Args:
+            to_number: 被叫号码
+            timeout: 等待最终响应的总时长
+            response_timeout: 等待任意响应（包括 100 Trying）的时长，
+                超时视为代理无响应，便于上层尽快切换代理
+
+        Returns:
+            dict: call_id、最终状态码、原因短语、To 头、呼叫建立耗时，
+                以及超时前是否收到过临时响应（provisional）；
+                收到 1xx 后超时说明代理正常、只是被叫未接，此时会发送 CANCEL 结束这次呼叫
+        """
+        if not self.wait_registered(timeout):
+            raise ConnectionError("SIP registration not available")
+
+        started = time.monotonic()
+        call_id = str(uuid.uuid4()).replace("-", "")[:16]
+        from_tag = f"tag{random.randint(100000, 999999)}"
+        uri = f"sip:{to_number}@{self.server}"
+        from_header = f"<sip:{self.username}@{self.server}>;tag={from_tag}"
+        transport = self.transport.upper()
+        cseq = 1
+        branch = new_branch()
+        authenticated = False
+
+        q = self.open_transaction(call_id)
+        try:
+            self.send(build_invite(
+                self.username, self.server, self.local_ip, self.local_port,
+                call_id, cseq, branch, to_number, from_tag, transport=transport
+            ))
+            deadline = started + timeout
+            if response_timeout:
+                deadline = min(deadline, started + response_timeout)
+            provisional = False
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if provisional:
+                        response = self._cancel(q, uri, from_header, to_number, call_id, cseq, branch)
+                        if response is None:
+                            return {"call_id": call_id, "status": None, "reason": "timeout", "to_header": None,
+                                    "setup_ms": (time.monotonic() - started) * 1000, "provisional": True}
+                        # CANCEL 与 200 OK 交错：被叫已在最后一刻接听，按正常接通返回
+                        status, reason = parse_status(response)
+                        setup_ms = (time.monotonic() - started) * 1000
+                        return {"call_id": call_id, "status": status, "reason": reason,
+                                "to_header": parse_header(response, "To"), "setup_ms": setup_ms,
+                                "provisional": True}
+                    reason = "timeout" if not response_timeout else "no response"
+                    return {"call_id": call_id, "status": None, "reason": reason, "to_header": None,
+                            "setup_ms": (time.monotonic() - started) * 1000, "provisional": False}
+                try:
+                    response = q.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+
+                status, reason = parse_status(response)
+                if status is None or status < 200:
+                    if status:
+                        if not provisional:
+                            # 代理已响应，之后按总时长等待
+                            provisional = True
+                            deadline = started + timeout
+                        logger.info(f"[{call_id}] ⏳ {status} {reason}")
+                    continue
+
+                to_header = parse_header(response, "To")
+                # 非 2xx 最终响应的 ACK 与 INVITE 使用同一 branch
+                ack_branch = branch if status >= 300 else new_branch()
+                self.send(build_ack(uri, from_header, to_header, call_id, cseq, ack_branch,
+                                    self.local_ip, self.local_port, transport=transport))
+
+                if status in (401, 407) and not authenticated:
+                    header_type = "Proxy-Authenticate" if status == 407 else "WWW-Authenticate"
+                    realm, nonce = parse_authenticate_header(response, header_type)
+                    if not realm or not nonce:
+                        raise RuntimeError(f"failed to parse realm and nonce from {status} response")
+                    auth_type = "Proxy-Authorization" if status == 407 else "Authorization"
+                    auth = generate_authorization(self.username, self.password, realm, nonce, uri,
+                                                  method="INVITE", auth_type=auth_type)
+                    authenticated = True
+                    cseq += 1
+                    branch = new_branch()
+                    self.send(build_invite(
+                        self.username, self.server, self.local_ip, self.local_port,
+                        call_id, cseq, branch, to_number, from_tag, auth_header=auth, transport=transport
+                    ))
+                    continue
+
+                setup_ms = (time.monotonic() - started) * 1000
+                logger.info(f"[{call_id}] 📞 INVITE {to_number} → {status} {reason} ({setup_ms:.0f} ms)")
+                return {"call_id": call_id, "status": status, "reason": reason,
+                        "to_header": to_header, "setup_ms": setup_ms, "provisional": provisional}
+        finally:
+            self.close_transaction(call_id)
+
+    def _cancel(self, q: queue.Queue, uri: str, from_header: str, to_number: str, call_id: str,
+                cseq: int, branch: str) -> Optional[bytes]:
+        """
+        取消已收到临时响应但迟迟未接的 INVITE，并确认对端的 487
+
+        Returns:
+            bytes: CANCEL 前后恰好到达的 2xx 最终响应（呼叫已接通）；否则 None
+        """
+        transport = self.transport.upper()
+        to_header = f"<sip:{to_number}@{self.server}>"
+        logger.info(f"[{call_id}] 🚫 No answer, sending CANCEL")
+        self.send(build_cancel(uri, from_header, to_header, call_id, cseq, branch,
+                               self.local_ip, self.local_port, transport=transport))
+
+        deadline = time.monotonic() + self.request_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"[{call_id}] ⚠️ No final response to the cancelled INVITE")
+                return None
+            try:
+                response = q.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            status, _ = parse_status(response)
+            cseq_header = parse_header(response, "CSeq") or ""
+            if status is None or status < 200 or not cseq_header.endswith("INVITE"):
+                # 1xx 以及 CANCEL 自己的 200 OK
+                continue
+            ack_branch = branch if status >= 300 else new_branch()
+            self.send(build_ack(uri, from_header, parse_header(response, "To"), call_id, cseq, ack_branch,
+                                self.local_ip, self.local_port, transport=transport))
+            return response if status < 300 else None
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if len(sys.argv) < 2:
+        print("❌ No destination number specified, usage: python sip_registration.py <number> [<number> ...]")
+        sys.exit(1)
+
+    manager = SipRegistrationManager()
+    manager.start()
+    try:
+        # 所有号码复用同一条已注册的连接
+        for number in sys.argv[1:]:
+            result = manager.invite(number)
+            print(f"📞 {number}: {result['status']} {result['reason']} ({result['setup_ms']:.0f} ms)")
+    finally:
+        manager.stop()
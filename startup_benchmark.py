@@ -0,0 +1,161 @@
+"""
+冷启动基准测试
+1. 导入耗时分析：用 python -X importtime 导入应用模块，列出累计耗时最多的依赖
+2. 启动到就绪：按生产方式用 uvicorn 启动服务（不开 reload），轮询健康检查直到返回 200，多次取中位数
+3. 空闲内存：就绪后等待片刻，读取进程 RSS
+
+可设置阈值，超出时以非零状态退出，便于在 CI 中发现启动回退。
+
+用法：
+    python startup_benchmark.py
+    python startup_benchmark.py --app twilio_openai_agent_quart:asgi_app --runs 10
+    python startup_benchmark.py --max-ready-ms 1500 --max-rss-mb 120
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+from urllib.request import urlopen
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def benchmark_env(port: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TWILIO_ACCOUNT_SID": env.get("TWILIO_ACCOUNT_SID", "ACbenchmark"),
+        "TWILIO_AUTH_TOKEN": env.get("TWILIO_AUTH_TOKEN", "benchmark"),
+        "TWILIO_PHONE_NUMBER": env.get("TWILIO_PHONE_NUMBER", "+10000000000"),
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY", "benchmark"),
+        "PUBLIC_URL": f"http://127.0.0.1:{port}",
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        "TRANSCRIPT_SINK": "none",
+        "DRAIN_ON_SIGTERM": "false",
+        "GREETING_CACHE_DIR": os.path.join(tempfile.gettempdir(), "startup-benchmark-greetings"),
+    })
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ==================== 导入耗时分析 ====================
+
+def import_profile(module: str, top: int):
+    """返回 (总耗时 ms, [(累计 ms, 自身 ms, 模块名)])，按累计耗时降序"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BASE_DIR, env=benchmark_env(free_port()), capture_output=True, text=True
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative_us) / 1000, int(self_us) / 1000, name.rstrip()))
+
+    total = next((cumulative for cumulative, _, name in entries if name.strip() == module), 0.0)
+    # 只看应用模块直接导入的依赖（缩进两格），避免同一条依赖链重复出现
+    direct = [entry for entry in entries if entry[2].startswith("   ") and not entry[2].startswith("    ")]
+    direct.sort(reverse=True)
+    return total, direct[:top]
+
+
+# ==================== 启动到就绪 ====================
+
+def read_rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure_startup(app: str, idle_seconds: float, timeout: float = 30.0):
+    """返回 (启动到就绪 ms, 空闲 RSS MB)"""
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BASE_DIR, env=benchmark_env(port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"{app} exited with code {process.returncode}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{app} did not become ready in {timeout}s")
+            try:
+                with urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        break
+            except OSError:
+                time.sleep(0.005)
+        ready_ms = (time.perf_counter() - started) * 1000
+
+        time.sleep(idle_seconds)
+        return ready_ms, read_rss_mb(process.pid)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量应用冷启动耗时和空闲内存")
+    parser.add_argument("--app", default="twilio_openai_agent_fastapi:asgi_app", help="ASGI 应用（模块:变量）")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12, help="导入分析列出的依赖数")
+    parser.add_argument("--idle", type=float, default=1.0, help="就绪后等待多久再读取 RSS（秒）")
+    parser.add_argument("--max-ready-ms", type=float, help="启动到就绪中位数的上限")
+    parser.add_argument("--max-rss-mb", type=float, help="空闲 RSS 中位数的上限")
+    args = parser.parse_args()
+
+    module = args.app.split(":")[0]
+    total, imports = import_profile(module, args.top)
+    print("=" * 60)
+    print(f"📦 导入耗时分析: {module}（共 {total:.1f} ms）")
+    print("=" * 60)
+    print(f"{'累计 ms':>10} {'自身 ms':>10}  模块")
+    for cumulative, self_ms, name in imports:
+        print(f"{cumulative:>10.1f} {self_ms:>10.1f}  {name.strip()}")
+
+    ready, rss = [], []
+    for _ in range(args.runs):
+        ready_ms, rss_mb = measure_startup(args.app, args.idle)
+        ready.append(ready_ms)
+        rss.append(rss_mb)
+
+    ready_median = statistics.median(ready)
+    rss_median = statistics.median(rss)
+    print("=" * 60)
+    print(f"🚀 启动到就绪（{args.runs} 次）")
+    print("=" * 60)
+    print(f"中位数 {ready_median:.0f} ms，最快 {min(ready):.0f} ms，最慢 {max(ready):.0f} ms")
+    print(f"空闲 RSS 中位数 {rss_median:.1f} MB")
+
+    failed = False
+    if args.max_ready_ms is not None and ready_median > args.max_ready_ms:
+        print(f"❌ 启动耗时 {ready_median:.0f} ms 超过上限 {args.max_ready_ms:.0f} ms")
+        failed = True
+    if args.max_rss_mb is not None and rss_median > args.max_rss_mb:
+        print(f"❌ 空闲内存 {rss_median:.1f} MB 超过上限 {args.max_rss_mb:.1f} MB")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
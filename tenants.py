@@ -0,0 +1,368 @@
+"""
+多租户配置与配额
+每个租户有自己的 Twilio 账号和号码、OpenAI API Key、默认指令 / 语音 / 问候语，以及并发和每秒呼叫数配额。
+租户配置保存在 JSON 文件或 SQLite 数据库（TENANTS_SOURCE 以 .db / .sqlite 结尾）中，
+加载后按租户 ID 和号码建好字典索引，通话路径上的查找都是一次字典访问，不碰磁盘。
+后台任务每 TENANTS_RELOAD_INTERVAL 秒检查一次修改时间，在线程中重新加载后整体替换，加载失败时保留旧配置。
+TENANTS_SOURCE 未配置时不启用，所有通话使用全局配置。
+
+JSON 格式：
+{
+    "tenants": {
+        "acme": {
+            "twilio_account_sid": "AC...", "twilio_auth_token": "...", "numbers": ["+14155550100"],
+            "openai_api_key": "sk-...", "instructions": "...", "voice": "alloy", "greeting": "...",
+            "max_calls": 10, "calls_per_second": 1, "call_budget_usd": 0.5, "daily_budget_usd": 100
+        }
+    }
+}
+SQLite 表结构：tenants (id TEXT PRIMARY KEY, config TEXT NOT NULL)，config 是上面单个租户的 JSON。
+numbers 中第一个号码作为外呼主叫号码；max_calls / calls_per_second 为 0 表示不限。
+call_budget_usd / daily_budget_usd 是每通电话和每天的费用预算（见 cost_accounting.py），0 表示不限。
+配额按进程统计，多 worker 部署时每个 worker 各自限制（与 MAX_ACTIVE_CALLS 相同）。
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TENANTS_SOURCE = os.getenv("TENANTS_SOURCE", "")
+TENANTS_RELOAD_INTERVAL = float(os.getenv("TENANTS_RELOAD_INTERVAL", "5"))
+# 外呼从拨出到媒体流建立之间占用租户名额的最长时间（秒）
+TENANT_RESERVATION_TTL = float(os.getenv("TENANT_RESERVATION_TTL", "60"))
+
+
+def digits(number: Optional[str]) -> str:
+    return "".join(ch for ch in number or "" if ch.isdigit())
+
+
+class Tenant:
+    """单个租户的配置（只读），重新加载时整体替换"""
+
+    __slots__ = ("id", "twilio_account_sid", "twilio_auth_token", "numbers", "openai_api_key",
+                 "instructions", "voice", "greeting", "max_calls", "calls_per_second", "call_budget_usd",
+                 "daily_budget_usd")
+
+    def __init__(self, tenant_id: str, config: dict):
+        self.id = tenant_id
+        self.twilio_account_sid: Optional[str] = config.get("twilio_account_sid")
+        self.twilio_auth_token: Optional[str] = config.get("twilio_auth_token")
+        self.numbers: List[str] = list(config.get("numbers", []))
+        self.openai_api_key: Optional[str] = config.get("openai_api_key")
+        self.instructions: Optional[str] = config.get("instructions")
+        self.voice: Optional[str] = config.get("voice")
+        self.greeting: Optional[str] = config.get("greeting")
+        self.max_calls = int(config.get("max_calls", 0))
+        self.calls_per_second = float(config.get("calls_per_second", 0))
+        self.call_budget_usd = float(config.get("call_budget_usd", 0))
+        self.daily_budget_usd = float(config.get("daily_budget_usd", 0))
+        if bool(self.twilio_account_sid) != bool(self.twilio_auth_token):
+            raise ValueError(f"tenant {tenant_id!r}: twilio_account_sid and twilio_auth_token go together")
+
+    @property
+    def caller_id(self) -> Optional[str]:
+        return self.numbers[0] if self.numbers else None
+
+
+def load_json(path: str) -> Dict[str, dict]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f).get("tenants", {})
+
+
+def load_sqlite(path: str) -> Dict[str, dict]:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return {row[0]: json.loads(row[1]) for row in conn.execute("SELECT id, config FROM tenants")}
+    finally:
+        conn.close()
+
+
+class TenantDirectory:
+    """
+    租户配置的内存缓存
+    get() / for_number() 只读当前快照的字典；reload() 在线程中读取数据源并构建新快照
+    """
+
+    def __init__(self, source: str = TENANTS_SOURCE, reload_interval: float = TENANTS_RELOAD_INTERVAL):
+        self.source = source
+        self.reload_interval = reload_interval
+        self.sqlite = source.endswith((".db", ".sqlite"))
+        self.tenants: Dict[str, Tenant] = {}
+        self.by_number: Dict[str, Tenant] = {}
+        self.version: Optional[Tuple[float, ...]] = None
+        self._task: Optional[asyncio.Task] = None
+        if source:
+            self.reload()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.source)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            await asyncio.to_thread(self.reload)
+
+    def _version(self) -> Optional[Tuple[float, ...]]:
+        # SQLite 的 WAL 模式下提交先写入 -wal 文件，两个文件的修改时间一起比较
+        paths = [self.source, self.source + "-wal"] if self.sqlite else [self.source]
+        version = []
+        for path in paths:
+            try:
+                version.append(os.stat(path).st_mtime)
+            except FileNotFoundError:
+                if path == self.source:
+                    return None
+        return tuple(version)
+
+    def reload(self) -> bool:
+        version = self._version()
+        if version is None:
+            logger.error(f"❌ 租户配置 {self.source} 不存在")
+            return False
+        if version == self.version:
+            return False
+        try:
+            configs = load_sqlite(self.source) if self.sqlite else load_json(self.source)
+            tenants = {tenant_id: Tenant(tenant_id, config) for tenant_id, config in configs.items()}
+        except (OSError, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+            # 保留旧配置，修好后下次检查时再加载
+            logger.error(f"❌ 租户配置 {self.source} 加载失败，继续使用旧配置: {e}")
+            self.version = version
+            return False
+
+        by_number = {}
+        for tenant in tenants.values():
+            for number in tenant.numbers:
+                key = digits(number)
+                if key in by_number:
+                    logger.warning(f"⚠️ 号码 {number} 同时属于 {by_number[key].id} 和 {tenant.id}，使用前者")
+                    continue
+                by_number[key] = tenant
+        # 整体替换：进行中的查找仍使用旧快照
+        self.tenants, self.by_number, self.version = tenants, by_number, version
+        logger.info(f"🏢 已加载租户配置: {len(tenants)} 个租户，{len(by_number)} 个号码")
+        return True
+
+    def get(self, tenant_id: Optional[str]) -> Optional[Tenant]:
+        return self.tenants.get(tenant_id) if tenant_id else None
+
+    def for_number(self, number: Optional[str]) -> Optional[Tenant]:
+        """来电按被叫号码确定租户"""
+        return self.by_number.get(digits(number)) if number else None
+
+
+class TenantUsage:
+    """单个租户在本进程内的用量和配额状态"""
+
+    __slots__ = ("reservations", "active", "tokens", "refilled_at", "calls", "rejected",
+                 "peak_active", "call_seconds")
+
+    def __init__(self, now: float):
+        self.reservations: Dict[str, float] = {}  # key → 过期时间
+        self.active: Dict[str, float] = {}  # call_sid → 开始时间
+        self.tokens: Optional[float] = None  # 每秒呼叫数令牌桶，首次使用时装满
+        self.refilled_at = now
+        self.calls = 0
+        self.rejected: Dict[str, int] = {}
+        self.peak_active = 0
+        self.call_seconds = 0.0
+
+
+class TenantQuotas:
+    """
+    按租户的并发数和每秒呼叫数限制，只做计算不做 I/O
+    try_reserve() 在发起外呼或接受来电时占用名额，start() 在媒体流建立时把名额转为活动通话，
+    end() 在通话结束时释放并累计通话时长；没有预留就直接建立的媒体流也在 start() 中检查并发数
+    """
+
+    def __init__(self, reservation_ttl: float = TENANT_RESERVATION_TTL):
+        self.reservation_ttl = reservation_ttl
+        self.usage: Dict[str, TenantUsage] = {}
+
+    def _usage(self, tenant: Tenant, now: float) -> TenantUsage:
+        usage = self.usage.get(tenant.id)
+        if usage is None:
+            usage = self.usage[tenant.id] = TenantUsage(now)
+        if usage.reservations:
+            for key in [key for key, expires in usage.reservations.items() if expires < now]:
+                del usage.reservations[key]
+        return usage
+
+    def _reject(self, usage: TenantUsage, reason: str) -> str:
+        usage.rejected[reason] = usage.rejected.get(reason, 0) + 1
+        return reason
+
+    def _take_token(self, tenant: Tenant, usage: TenantUsage, now: float) -> bool:
+        rate = tenant.calls_per_second
+        if rate <= 0:
+            return True
+        burst = max(1.0, rate)
+        tokens = burst if usage.tokens is None else min(burst, usage.tokens + (now - usage.refilled_at) * rate)
+        usage.refilled_at = now
+        if tokens < 1.0:
+            usage.tokens = tokens
+            return False
+        usage.tokens = tokens - 1.0
+        return True
+
+    def try_reserve(self, tenant: Tenant, key: str, now: Optional[float] = None) -> Optional[str]:
+        """占用一个名额；超出配额时返回原因（max_calls / calls_per_second），否则返回 None"""
+        now = time.monotonic() if now is None else now
+        usage = self._usage(tenant, now)
+        if key in usage.reservations or key in usage.active:
+            return None
+        if tenant.max_calls and len(usage.active) + len(usage.reservations) >= tenant.max_calls:
+            return self._reject(usage, "max_calls")
+        if not self._take_token(tenant, usage, now):
+            return self._reject(usage, "calls_per_second")
+        usage.reservations[key] = now + self.reservation_ttl
+        return None
+
+    def rebind(self, tenant: Tenant, key: str, new_key: str):
+        """把名额转到新的键上（例如拿到 CallSid 之后）"""
+        usage = self.usage.get(tenant.id)
+        expires = usage.reservations.pop(key, None) if usage else None
+        if expires is not None:
+            usage.reservations[new_key] = expires
+
+    def release(self, tenant: Tenant, key: str):
+        usage = self.usage.get(tenant.id)
+        if usage:
+            usage.reservations.pop(key, None)
+
+    def start(self, tenant: Tenant, call_sid: str, now: Optional[float] = None) -> Optional[str]:
+        """媒体流建立：有预留时直接转为活动通话，否则按并发数检查；超出时返回原因"""
+        now = time.monotonic() if now is None else now
+        usage = self._usage(tenant, now)
+        if call_sid in usage.active:
+            return None
+        if usage.reservations.pop(call_sid, None) is None:
+            if tenant.max_calls and len(usage.active) + len(usage.reservations) >= tenant.max_calls:
+                return self._reject(usage, "max_calls")
+        usage.active[call_sid] = now
+        usage.calls += 1
+        usage.peak_active = max(usage.peak_active, len(usage.active))
+        return None
+
+    def end(self, tenant: Tenant, call_sid: str, now: Optional[float] = None):
+        usage = self.usage.get(tenant.id)
+        started = usage.active.pop(call_sid, None) if usage else None
+        if started is not None:
+            usage.call_seconds += (time.monotonic() if now is None else now) - started
+
+    def stats(self, directory: Optional[TenantDirectory] = None) -> Dict[str, dict]:
+        """每个租户的用量；传入 directory 时同时列出配额"""
+        now = time.monotonic()
+        result = {}
+        for tenant_id, usage in self.usage.items():
+            entry = {
+                "active_calls": len(usage.active),
+                "reserved_calls": len(usage.reservations),
+                "peak_active_calls": usage.peak_active,
+                "calls": usage.calls,
+                "rejected": dict(usage.rejected),
+                "call_seconds": round(usage.call_seconds + sum(now - started for started in usage.active.values()), 1),
+            }
+            tenant = directory.get(tenant_id) if directory else None
+            if tenant:
+                entry["max_calls"] = tenant.max_calls
+                entry["calls_per_second"] = tenant.calls_per_second
+            result[tenant_id] = entry
+        return result
+
+
+if __name__ == "__main__":
+    # 租户数很多时的查找和配额检查开销，以及 JSON / SQLite 数据源的加载时间
+    import random
+    import statistics
+    import tempfile
+
+    rng = random.Random(11)
+    TENANTS = 10000
+    configs = {
+        f"tenant_{index}": {
+            "twilio_account_sid": f"AC{index:032d}", "twilio_auth_token": "token",
+            "numbers": [f"+1415{index * 3 + offset:07d}" for offset in range(3)],
+            "openai_api_key": f"sk-{index}", "instructions": f"租户 {index} 的客服",
+            "max_calls": 5, "calls_per_second": 1,
+        }
+        for index in range(TENANTS)
+    }
+    workdir = tempfile.mkdtemp(prefix="tenants-")
+
+    json_path = os.path.join(workdir, "tenants.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump({"tenants": configs}, f)
+    db_path = os.path.join(workdir, "tenants.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE tenants (id TEXT PRIMARY KEY, config TEXT NOT NULL)")
+    conn.executemany("INSERT INTO tenants VALUES (?, ?)", [(k, json.dumps(v)) for k, v in configs.items()])
+    conn.commit()
+    conn.close()
+
+    for label, path in [("JSON", json_path), ("SQLite", db_path)]:
+        started = time.perf_counter()
+        directory = TenantDirectory(path)
+        print(f"{label} 加载 {len(directory.tenants)} 个租户: {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    ids = rng.sample(list(configs), 1000)
+    numbers = [configs[tenant_id]["numbers"][1] for tenant_id in ids]
+
+    def bench(fn, items) -> float:
+        samples = []
+        for _ in range(20):
+            for item in items:
+                started = time.perf_counter()
+                fn(item)
+                samples.append((time.perf_counter() - started) * 1e6)
+        return statistics.median(samples)
+
+    print(f"查找（µs，中位数）: 按 ID {bench(directory.get, ids):.2f}，按号码 {bench(directory.for_number, numbers):.2f}")
+
+    # 模拟一个租户的突发外呼：配额 5 路并发、每秒 1 通
+    quotas = TenantQuotas()
+    tenant = directory.get("tenant_0")
+    now = 0.0
+    outcomes = {}
+    for index in range(40):
+        now += 0.25
+        reason = quotas.try_reserve(tenant, f"CA{index}", now)
+        outcomes[reason or "accepted"] = outcomes.get(reason or "accepted", 0) + 1
+        if reason is None:
+            quotas.start(tenant, f"CA{index}", now)
+        # 每通电话持续 8 秒
+        for call_sid, started in list(quotas.usage[tenant.id].active.items()):
+            if now - started >= 8:
+                quotas.end(tenant, call_sid, now)
+    print(f"10 秒内 40 次外呼（5 路并发、1 通/秒）: {outcomes}，峰值并发 {quotas.usage[tenant.id].peak_active}")
+
+    quotas = TenantQuotas()
+    tenants = [directory.get(tenant_id) for tenant_id in ids]
+    samples = []
+    for index, tenant in enumerate(tenants * 5):
+        started = time.perf_counter()
+        if quotas.try_reserve(tenant, f"CA{index}") is None:
+            quotas.start(tenant, f"CA{index}")
+            quotas.end(tenant, f"CA{index}")
+        samples.append((time.perf_counter() - started) * 1e6)
+    print(f"配额检查 + 开始 + 结束（µs，中位数）: {statistics.median(samples):.2f}")
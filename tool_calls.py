@@ -0,0 +1,410 @@
+"""
+函数调用（工具）引擎
+ToolRegistry 保存所有通话共享的工具定义，在 session.update 中声明给模型；
+ToolCallSession 挂在单通电话的事件分发器上，收到 response.function_call_arguments.done 后立即并发执行工具，
+每个工具有独立超时，结果以 function_call_output 写回会话，本轮所有调用完成且响应结束后再发送 response.create。
+工具结果按（租户，工具名，参数）缓存，带 TTL 和 LRU 上限，重复查询（订单状态、账户信息等）立即返回；
+同一参数的并发调用只执行一次，不同租户之间既不共享缓存，也不合并执行。
+
+自定义工具：在 TOOLS_MODULE 指定的模块中实现 register_tools(registry)，例如
+
+    def register_tools(registry):
+        @registry.tool("get_order_status", "查询订单状态",
+                       {"type": "object", "properties": {"order_id": {"type": "string"}}, "required": ["order_id"]})
+        async def get_order_status(order_id: str):
+            return {"order_id": order_id, "status": "已发货"}
+"""
+
+import os
+import json
+import time
+import asyncio
+import inspect
+import logging
+import importlib
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+TOOLS_MODULE = os.getenv("TOOLS_MODULE")  # 提供 register_tools(registry) 的模块
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "8"))  # 单个工具的默认超时（秒）
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "60"))  # 结果缓存有效期（秒），0 表示不缓存
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", "1024"))
+
+RESPONSE_CREATE = json.dumps({"type": "response.create"})
+
+
+def cache_key(name: str, arguments: dict, tenant: Optional[str] = None) -> str:
+    """参数顺序不同的同一次调用使用同一个缓存键；租户不同的调用键不同，结果不会串到别的租户"""
+    key = f"{name}:{json.dumps(arguments, sort_keys=True, ensure_ascii=False)}"
+    return f"{tenant}/{key}" if tenant else key
+
+
+class ToolResultCache:
+    """带 TTL 的 LRU 结果缓存"""
+
+    def __init__(self, ttl: float = TOOL_CACHE_TTL, max_entries: int = TOOL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # key → (过期时间, 输出)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, output: str, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, output)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class InflightCall:
+    """正在执行的一次工具调用及等待它的调用方数量"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class Tool:
+    """一个可供模型调用的工具"""
+
+    def __init__(self, name: str, description: str, parameters: dict, handler: Callable,
+                 timeout: float = TOOL_TIMEOUT, cache_ttl: Optional[float] = None):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.handler = handler
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl  # None 使用缓存默认值，0 表示该工具不缓存（如下单、转账）
+
+    def definition(self) -> dict:
+        return {
+            "type": "function",
+            "name": self.name,
+            "description": self.description,
+            "parameters": self.parameters,
+        }
+
+
+class ToolRegistry:
+    """所有通话共享的工具表和结果缓存"""
+
+    def __init__(self, cache: Optional[ToolResultCache] = None):
+        self.tools: Dict[str, Tool] = {}
+        self.cache = cache or ToolResultCache()
+        self._inflight: Dict[str, InflightCall] = {}
+
+    def register(self, name: str, description: str, parameters: dict, handler: Callable,
+                 timeout: float = TOOL_TIMEOUT, cache_ttl: Optional[float] = None):
+        self.tools[name] = Tool(name, description, parameters, handler, timeout, cache_ttl)
+
+    def tool(self, name: str, description: str, parameters: dict,
+             timeout: float = TOOL_TIMEOUT, cache_ttl: Optional[float] = None):
+        """装饰器形式的 register"""
+        def decorator(handler: Callable):
+            self.register(name, description, parameters, handler, timeout, cache_ttl)
+            return handler
+        return decorator
+
+    def definitions(self, names: Optional[Iterable[str]] = None) -> List[dict]:
+        """全部工具的声明；names 不为 None 时只声明其中列出的工具"""
+        if names is None:
+            return [tool.definition() for tool in self.tools.values()]
+        return [self.tools[name].definition() for name in names if name in self.tools]
+
+    def __len__(self):
+        return len(self.tools)
+
+    async def execute(self, name: str, arguments: str, tenant: Optional[str] = None) -> str:
+        """
+        执行一次工具调用，返回写回给模型的 output 字符串；出错时返回错误说明而不是抛异常
+
+        工具在独立的任务中执行，调用方只是等待它：某通电话结束被取消时，
+        同一参数的其他等待方照常拿到结果；所有等待方都离开后才取消执行本身
+        """
+        tool = self.tools.get(name)
+        if tool is None:
+            return json.dumps({"error": f"unknown tool: {name}"})
+        try:
+            kwargs = json.loads(arguments or "{}")
+        except json.JSONDecodeError:
+            return json.dumps({"error": "invalid arguments"})
+
+        cacheable = tool.cache_ttl != 0
+        key = cache_key(name, kwargs, tenant)
+        call = None
+        if cacheable:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            # 同一参数的调用正在执行时直接等它的结果
+            call = self._inflight.get(key)
+        if call is None:
+            call = InflightCall(asyncio.create_task(self._call(tool, kwargs, key, cacheable)))
+            if cacheable:
+                self._inflight[key] = call
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # 最后一个等待方也被取消（如通话结束）时才取消执行
+            if call.waiters == 1:
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    async def _call(self, tool: Tool, kwargs: dict, key: str, cacheable: bool) -> str:
+        try:
+            output, ok = await self._run(tool, kwargs)
+            if ok and cacheable:
+                self.cache.put(key, output, tool.cache_ttl)
+            return output
+        finally:
+            call = self._inflight.get(key)
+            if call is not None and call.task is asyncio.current_task():
+                del self._inflight[key]
+
+    async def _run(self, tool: Tool, kwargs: dict):
+        """返回 (output, 是否成功)"""
+        try:
+            if inspect.iscoroutinefunction(tool.handler):
+                result = await asyncio.wait_for(tool.handler(**kwargs), timeout=tool.timeout)
+            else:
+                # 同步工具放到线程池，避免阻塞音频转发
+                result = await asyncio.wait_for(asyncio.to_thread(tool.handler, **kwargs), timeout=tool.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ 工具 {tool.name} 超时（{tool.timeout}s）")
+            return json.dumps({"error": "timeout"}), False
+        except Exception as e:
+            logger.error(f"❌ 工具 {tool.name} 执行失败: {e}")
+            return json.dumps({"error": str(e)}, ensure_ascii=False), False
+
+        if isinstance(result, str):
+            return result, True
+        return json.dumps(result, ensure_ascii=False), True
+
+
+def load_tools(module_name: Optional[str] = TOOLS_MODULE) -> ToolRegistry:
+    """创建工具表，配置了 TOOLS_MODULE 时由该模块注册工具"""
+    registry = ToolRegistry()
+    if module_name:
+        importlib.import_module(module_name).register_tools(registry)
+        logger.info(f"🧰 已加载 {len(registry)} 个工具: {', '.join(registry.tools)}")
+    return registry
+
+
+class ToolCallSession:
+    """
+    单通电话的函数调用处理
+    同一轮响应中的多个调用并发执行；本轮全部输出写回且 response.done 已到达后发送一次 response.create
+    """
+
+    EVENT_TYPES = ("response.function_call_arguments.done", "response.done")
+
+    def __init__(self, bridge, registry: ToolRegistry, allowed: Optional[Set[str]] = None,
+                 tenant: Optional[str] = None):
+        self.bridge = bridge
+        self.registry = registry
+        self.allowed = allowed  # 本通电话可用的工具，None 表示全部
+        self.tenant = tenant  # 结果缓存和合并执行按租户隔离
+        self.pending: Dict[str, Set[asyncio.Task]] = {}  # response_id → 执行中的调用
+        self.finished_responses: Set[str] = set()
+        self.awaiting_response = False  # 已写回结果并发送 response.create，等待模型的后续回复
+        bridge.dispatcher.subscribe("response.function_call_arguments.done", self.on_arguments_done)
+        bridge.dispatcher.subscribe("response.done", self.on_response_done)
+
+    def busy(self) -> bool:
+        """有工具正在执行，或正在等待模型基于工具结果的回复"""
+        return self.awaiting_response or any(self.pending.values())
+
+    def on_arguments_done(self, data: dict):
+        response_id = data.get("response_id", "")
+        task = asyncio.create_task(self.run_call(response_id, data))
+        self.pending.setdefault(response_id, set()).add(task)
+
+    async def on_response_done(self, data: dict):
+        response_id = (data.get("response") or {}).get("id", "")
+        self.awaiting_response = False
+        if response_id in self.pending:
+            self.finished_responses.add(response_id)
+            await self.maybe_respond(response_id)
+
+    async def run_call(self, response_id: str, data: dict):
+        call_sid = self.bridge.call_sid
+        call_id = data.get("call_id")
+        name = data.get("name", "")
+        arguments = data.get("arguments", "")
+        started = time.monotonic()
+        logger.info(f"[{call_sid}] 🧰 调用工具 {name}({arguments})")
+        try:
+            if self.allowed is not None and name not in self.allowed:
+                output = json.dumps({"error": f"unknown tool: {name}"})
+            else:
+                output = await self.registry.execute(name, arguments, self.tenant)
+            logger.info(f"[{call_sid}] 🧰 工具 {name} 完成 ({(time.monotonic() - started) * 1000:.0f} ms)")
+
+            # 断线期间等重连后发送，发送成功后写入对话日志，之后再断线由重放补发
+            conversation = self.bridge.session["conversation"]
+            await self.bridge.send_item({
+                "type": "conversation.item.create",
+                "item": {"type": "function_call_output", "call_id": call_id, "output": output}
+            }, lambda: conversation.add_function_call(call_id, name, arguments, output))
+        finally:
+            self.pending.get(response_id, set()).discard(asyncio.current_task())
+        await self.maybe_respond(response_id)
+
+    async def maybe_respond(self, response_id: str):
+        if response_id not in self.finished_responses or self.pending.get(response_id):
+            return
+        self.finished_responses.discard(response_id)
+        self.pending.pop(response_id, None)
+        self.awaiting_response = True
+        # 断线期间进入 pending_audio，重连并重放对话后按顺序补发
+        await self.bridge.send_openai(RESPONSE_CREATE)
+
+    def cancel(self):
+        """通话结束时取消仍在执行的工具"""
+        for tasks in self.pending.values():
+            for task in tasks:
+                task.cancel()
+        self.pending.clear()
+
+
+if __name__ == "__main__":
+    # 用本地模拟的 Realtime 服务验证：并发执行、超时、缓存命中和 response.create 时机
+    import sys
+    import tempfile
+
+    import websockets
+
+    os.environ.setdefault("TRANSCRIPT_SINK", "none")
+    os.environ.setdefault("GREETING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tool-calls-greetings"))
+
+    from call_bridge import BridgeServices, CallBridge
+
+    logging.basicConfig(level=logging.WARNING)
+
+    TOOL_LATENCY = 0.5
+    registry = ToolRegistry()
+
+    @registry.tool("get_order_status", "查询订单状态",
+                   {"type": "object", "properties": {"order_id": {"type": "string"}}, "required": ["order_id"]})
+    async def get_order_status(order_id: str):
+        await asyncio.sleep(TOOL_LATENCY)
+        return {"order_id": order_id, "status": "已发货"}
+
+    @registry.tool("get_account", "查询账户信息",
+                   {"type": "object", "properties": {"phone": {"type": "string"}}, "required": ["phone"]})
+    def get_account(phone: str):
+        time.sleep(TOOL_LATENCY)
+        return {"phone": phone, "level": "gold"}
+
+    @registry.tool("slow_lookup", "总是超时的查询", {"type": "object", "properties": {}}, timeout=0.2)
+    async def slow_lookup():
+        await asyncio.sleep(5)
+
+    # 每一轮：模型发起的调用列表
+    TURNS = [
+        [("get_order_status", {"order_id": "A100"}), ("get_account", {"phone": "+8613800000000"})],
+        [("get_order_status", {"order_id": "A100"})],
+        [("slow_lookup", {})],
+    ]
+    results = []
+
+    async def mock_realtime(ws):
+        """模拟 Realtime 服务：每轮发出函数调用，收齐输出和 response.create 后进入下一轮"""
+        config = json.loads(await ws.recv())
+        advertised = [tool["name"] for tool in config["session"].get("tools", [])]
+        for turn, calls in enumerate(TURNS):
+            response_id = f"resp_{turn}"
+            for index, (name, arguments) in enumerate(calls):
+                await ws.send(json.dumps({
+                    "type": "response.function_call_arguments.done", "response_id": response_id,
+                    "call_id": f"call_{turn}_{index}", "name": name, "arguments": json.dumps(arguments)
+                }))
+            await ws.send(json.dumps({"type": "response.done", "response": {"id": response_id, "output": []}}))
+            started = time.monotonic()
+
+            outputs = []
+            while True:
+                event = json.loads(await ws.recv())
+                if event["type"] == "conversation.item.create":
+                    outputs.append(event["item"]["output"])
+                elif event["type"] == "response.create":
+                    break
+            results.append((turn, len(outputs) == len(calls), (time.monotonic() - started) * 1000, outputs))
+        results.append(("tools", advertised))
+        finished.set()
+        await ws.wait_closed()
+
+    class NullTransport:
+        """模拟 Twilio：所有轮次结束后挂断"""
+
+        async def receive_text(self):
+            await finished.wait()
+            return None
+
+        async def send_text(self, text: str):
+            pass
+
+        async def close(self, code: int = 1000):
+            pass
+
+    async def main():
+        global finished
+        finished = asyncio.Event()
+        async with websockets.serve(mock_realtime, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            services = BridgeServices(f"ws://127.0.0.1:{port}", "test", "test", tools=registry)
+            bridge = CallBridge("CA-tools", NullTransport(), services, "test", "alloy")
+            await asyncio.wait_for(bridge.run(), timeout=10)
+
+    async def shared_calls():
+        """两通电话等待同一次执行，先发起的一方被取消后另一方仍拿到结果；不同租户不合并"""
+        first = asyncio.create_task(registry.execute("get_order_status", '{"order_id": "B200"}', "acme"))
+        second = asyncio.create_task(registry.execute("get_order_status", '{"order_id": "B200"}', "acme"))
+        other = asyncio.create_task(registry.execute("get_order_status", '{"order_id": "B200"}', "globex"))
+        await asyncio.sleep(0.05)
+        inflight = len(registry._inflight)
+        first.cancel()
+        output = await second
+        await other
+        return first.cancelled(), json.loads(output).get("status"), inflight
+
+    asyncio.run(main())
+    first_cancelled, survivor_status, inflight = asyncio.run(shared_calls())
+
+    print(f"声明的工具: {results[-1][1]}")
+    failed = False
+    for turn, complete, elapsed_ms, outputs in results[:-1]:
+        print(f"第 {turn + 1} 轮: {elapsed_ms:6.0f} ms {'✅' if complete else '❌'} {outputs}")
+        failed = failed or not complete
+    print(f"缓存: {registry.cache.stats()}")
+    shared_ok = first_cancelled and survivor_status == "已发货" and inflight == 2
+    print(f"取消首个调用方后其他调用方拿到结果、租户隔离: {'✅' if shared_ok else '❌'}")
+    failed = failed or not shared_ok
+    # 两个 0.5s 的工具并发执行；第二轮命中缓存
+    failed = failed or results[0][2] > TOOL_LATENCY * 1000 * 1.5 or results[1][2] > 50
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,219 @@
+"""
+慢工具垫话
+工具调用超过 TOOL_FILLER_DELAY_MS 仍未返回时，先播放一句垫话（"好的，我帮您查一下"），
+垫话播完工具还没结束就循环播放保持音乐，避免来电者听到长时间静音而挂断或插话。
+模型的回复音频一到，素材播放按 interleave 模式立即停止并清掉 Twilio 端缓冲，无缝切换到模型语音。
+
+垫话来源（按优先级）：
+1. TOOL_FILLER_PHRASES 中的句子，用本通电话的指令和语音预先合成并存放在问候缓存中；
+   未命中时在后台合成，供之后的通话使用
+2. 素材库中名为 TOOL_FILLER_ASSET 的素材
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+
+from audio_assets import AssetPlayback, MemoryAsset
+
+logger = logging.getLogger(__name__)
+
+# 工具调用开始后多久仍无结果就播放垫话（毫秒）
+TOOL_FILLER_DELAY_MS = float(os.getenv("TOOL_FILLER_DELAY_MS", "300"))
+# 以 | 分隔的垫话文本，按通话轮换
+TOOL_FILLER_PHRASES = [phrase for phrase in os.getenv("TOOL_FILLER_PHRASES", "").split("|") if phrase.strip()]
+TOOL_FILLER_ASSET = os.getenv("TOOL_FILLER_ASSET", "filler")
+TOOL_HOLD_ASSET = os.getenv("TOOL_HOLD_ASSET", "hold_music")
+
+# 等待垫话播完时的检查间隔（秒）
+POLL_INTERVAL = 0.05
+
+
+class ToolFiller:
+    """单通电话的慢工具垫话，挂在 ToolCallSession 之上"""
+
+    def __init__(self, bridge, tool_calls, delay_ms: float = TOOL_FILLER_DELAY_MS,
+                 phrases: Optional[List[str]] = None, filler_asset: str = TOOL_FILLER_ASSET,
+                 hold_asset: str = TOOL_HOLD_ASSET):
+        self.bridge = bridge
+        self.tool_calls = tool_calls
+        self.delay = delay_ms / 1000
+        self.phrases = TOOL_FILLER_PHRASES if phrases is None else phrases
+        self.filler_asset = filler_asset
+        self.hold_asset = hold_asset
+        self.playback: Optional[AssetPlayback] = None
+        self.task: Optional[asyncio.Task] = None
+        self.fillers_played = 0
+        bridge.dispatcher.subscribe("response.function_call_arguments.done", self.on_tool_call)
+        bridge.dispatcher.subscribe("response.done", self.on_response_done)
+
+    def available(self) -> bool:
+        services = self.bridge.services
+        return bool(self.phrases and services.greeting_cache) or bool(
+            services.audio_assets and (services.audio_assets.get(self.filler_asset)
+                                       or services.audio_assets.get(self.hold_asset)))
+
+    def on_tool_call(self, data: dict):
+        if (self.task is None or self.task.done()) and self.available():
+            self.task = asyncio.create_task(self.watch(time.monotonic()))
+
+    def on_response_done(self, data: dict):
+        # 后续回复结束时没有音频（也没有新的工具调用）则停止垫话
+        if not self.tool_calls.busy() and self.playing():
+            asyncio.create_task(self.bridge.stop_asset_playback())
+
+    def playing(self) -> bool:
+        return self.playback is not None and self.bridge.session.get("asset_playback") is self.playback
+
+    async def watch(self, started: float):
+        session = self.bridge.session
+        await asyncio.sleep(self.delay)
+        # 模型自己还在说话（例如"我帮您查一下"）时等它说完
+        while self.tool_calls.busy() and session["model_audio_until"] > time.monotonic():
+            await asyncio.sleep(session["model_audio_until"] - time.monotonic())
+        if not self.tool_calls.busy() or session.get("asset_playback"):
+            return
+
+        playback = self.filler_playback()
+        if playback:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            logger.info(f"[{self.bridge.call_sid}] ⏳ 工具已等待 {elapsed_ms:.0f} ms，播放垫话")
+            await self.play(playback)
+            while self.playing():
+                await asyncio.sleep(POLL_INTERVAL)
+
+        if not self.tool_calls.busy() or session.get("asset_playback"):
+            return
+        audio_assets = self.bridge.services.audio_assets
+        hold = audio_assets.playback(self.hold_asset, loop=True) if audio_assets else None
+        if hold:
+            logger.info(f"[{self.bridge.call_sid}] ⏳ 工具仍未返回，播放保持音乐")
+            await self.play(hold)
+
+    def filler_playback(self) -> Optional[AssetPlayback]:
+        """优先使用按本通电话语音合成的垫话，其次使用素材库中的通用垫话"""
+        services = self.bridge.services
+        if self.phrases and services.greeting_cache:
+            phrase = self.phrases[self.fillers_played % len(self.phrases)]
+            self.fillers_played += 1
+            audio = services.greeting_cache.get(self.bridge.speech_key(phrase))
+            if audio is not None:
+                return AssetPlayback(MemoryAsset(phrase, audio))
+            self.bridge.render_speech(phrase)
+        if services.audio_assets:
+            return services.audio_assets.playback(self.filler_asset)
+        return None
+
+    async def play(self, playback: AssetPlayback):
+        self.playback = playback
+        self.bridge.start_playback(playback)
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+
+if __name__ == "__main__":
+    # 对比有无垫话时，从模型发起慢工具调用到来电者听到第一帧音频的间隔
+    import sys
+    import json
+    import base64
+    import tempfile
+
+    import websockets
+
+    os.environ.setdefault("TRANSCRIPT_SINK", "none")
+
+    from audio_assets import AudioAssetLibrary
+    from call_bridge import BridgeServices, CallBridge
+    from tool_calls import ToolRegistry
+
+    logging.basicConfig(level=logging.WARNING)
+
+    TOOL_LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    MODEL_LATENCY = 0.3  # 模型收到工具结果后生成首个音频包的耗时
+
+    registry = ToolRegistry()
+
+    @registry.tool("lookup", "慢查询", {"type": "object", "properties": {}}, cache_ttl=0)
+    async def lookup():
+        await asyncio.sleep(TOOL_LATENCY)
+        return {"ok": True}
+
+    asset_dir = tempfile.mkdtemp(prefix="tool-filler-")
+    with open(os.path.join(asset_dir, "filler.ulaw"), "wb") as f:
+        f.write(b"\x7f" * 8000)  # 1 秒垫话
+    with open(os.path.join(asset_dir, "hold_music.ulaw"), "wb") as f:
+        f.write(b"\x7e" * 16000)
+
+    async def mock_realtime(ws):
+        await ws.recv()
+        await asyncio.sleep(0.2)
+        await ws.send(json.dumps({"type": "response.function_call_arguments.done", "response_id": "resp_0",
+                                  "call_id": "call_0", "name": "lookup", "arguments": "{}"}))
+        await ws.send(json.dumps({"type": "response.done", "response": {"id": "resp_0", "output": []}}))
+        async for message in ws:
+            if json.loads(message)["type"] == "response.create":
+                await asyncio.sleep(MODEL_LATENCY)
+                delta = base64.b64encode(bytes(4800)).decode("utf-8")
+                for _ in range(5):
+                    await ws.send(json.dumps({"type": "response.audio.delta", "delta": delta}))
+                await ws.send(json.dumps({"type": "response.done", "response": {"id": "resp_1", "output": []}}))
+
+    class RecordingTransport:
+        """模拟 Twilio：记录每条发给来电者的消息及时间"""
+
+        def __init__(self):
+            self.sent = []
+            self.started = False
+            self.hangup = asyncio.Event()
+
+        async def receive_text(self):
+            if not self.started:
+                self.started = True
+                return json.dumps({"event": "start", "start": {"streamSid": "MZ-filler"}})
+            await self.hangup.wait()
+            return None
+
+        async def send_text(self, text: str):
+            self.sent.append((time.monotonic(), json.loads(text)))
+
+        async def close(self, code: int = 1000):
+            self.hangup.set()
+
+    async def run(with_filler: bool):
+        async with websockets.serve(mock_realtime, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            services = BridgeServices(f"ws://127.0.0.1:{port}", "test", "test", tools=registry,
+                                      audio_assets=AudioAssetLibrary(asset_dir) if with_filler else None)
+            transport = RecordingTransport()
+            bridge = CallBridge("CA-filler", transport, services, "test", "alloy")
+            task = asyncio.create_task(bridge.run())
+
+            called_at = None
+            while called_at is None:
+                await asyncio.sleep(0.01)
+                if bridge.tool_calls.pending:
+                    called_at = time.monotonic()
+            await asyncio.sleep(TOOL_LATENCY + MODEL_LATENCY + 0.5)
+            transport.hangup.set()
+            await task
+
+        media = [(at, message) for at, message in transport.sent if message["event"] == "media"]
+        first_audio_ms = (media[0][0] - called_at) * 1000 if media else float("inf")
+        # 模型音频是 24kHz PCM 转出的帧（每条 1600 字节），素材帧为 160 字节
+        model = [at for at, message in media if len(base64.b64decode(message["media"]["payload"])) > 160]
+        model_ms = (model[0] - called_at) * 1000 if model else float("inf")
+        clears = sum(1 for _, message in transport.sent if message["event"] == "clear")
+        return first_audio_ms, model_ms, clears
+
+    async def main():
+        print(f"工具耗时 {TOOL_LATENCY * 1000:.0f} ms，模型首包 {MODEL_LATENCY * 1000:.0f} ms")
+        for with_filler in (False, True):
+            first_audio_ms, model_ms, clears = await run(with_filler)
+            label = "有垫话" if with_filler else "无垫话"
+            print(f"  {label}: 来电者听到首帧 {first_audio_ms:6.0f} ms，模型语音 {model_ms:6.0f} ms，clear {clears} 次")
+
+    asyncio.run(main())
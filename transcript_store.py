@@ -0,0 +1,222 @@
+"""
+对话转录持久化
+音频协程只把每轮对话（CallSid、角色、文本、时间戳、延迟）放入内存队列，
+后台任务按批取出，在线程池中以单个事务写入 SQLite（WAL 模式）或 JSONL 文件，
+磁盘变慢时也不会阻塞媒体转发。
+默认关闭（TRANSCRIPT_SINK=none）；开启后数据库/文件在第一次写入或查询时才创建，导入模块不会在磁盘上留下文件。
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPT_SINK = os.getenv("TRANSCRIPT_SINK", "none")  # sqlite / jsonl / none
+TRANSCRIPT_PATH = os.getenv("TRANSCRIPT_PATH", "transcripts.jsonl" if TRANSCRIPT_SINK == "jsonl" else "transcripts.db")
+TRANSCRIPT_BATCH_SIZE = int(os.getenv("TRANSCRIPT_BATCH_SIZE", "200"))
+TRANSCRIPT_BATCH_INTERVAL = float(os.getenv("TRANSCRIPT_BATCH_INTERVAL", "1.0"))
+TRANSCRIPT_QUEUE_SIZE = int(os.getenv("TRANSCRIPT_QUEUE_SIZE", "10000"))
+
+
+class SQLiteSink:
+    """SQLite 存储，WAL 模式下写入不阻塞查询"""
+
+    def __init__(self, path: str = TRANSCRIPT_PATH):
+        self.path = path
+        self._local = threading.local()
+        # 表结构在第一次连接时创建（写线程或查询线程，谁先到谁建）
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每个线程一个连接：写线程与查询线程互不干扰
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            if not self._schema_ready:
+                self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS turns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    call_sid TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    latency_ms REAL,
+                    extra TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_turns_call_sid ON turns (call_sid, created_at)")
+            conn.commit()
+            self._schema_ready = True
+
+    def write_batch(self, records: List[dict]):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO turns (call_sid, role, text, created_at, latency_ms, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (r["call_sid"], r["role"], r["text"], r["created_at"], r.get("latency_ms"),
+                     json.dumps(r["extra"], ensure_ascii=False) if r.get("extra") else None)
+                    for r in records
+                ]
+            )
+
+    def query(self, call_sid: str) -> List[dict]:
+        if not self._schema_ready and not os.path.exists(self.path):
+            # 还没有写入过任何记录，不为一次查询创建空库
+            return []
+        rows = self._connect().execute(
+            "SELECT call_sid, role, text, created_at, latency_ms, extra FROM turns "
+            "WHERE call_sid = ? ORDER BY created_at, id",
+            (call_sid,)
+        ).fetchall()
+        return [
+            {"call_sid": row[0], "role": row[1], "text": row[2], "created_at": row[3],
+             "latency_ms": row[4], "extra": json.loads(row[5]) if row[5] else None}
+            for row in rows
+        ]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class JsonlSink:
+    """JSONL 文件存储，每批一次顺序追加"""
+
+    def __init__(self, path: str = "transcripts.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write_batch(self, records: List[dict]):
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def query(self, call_sid: str) -> List[dict]:
+        if not os.path.exists(self.path):
+            return []
+        needle = json.dumps(call_sid)
+        results = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                # 先做字符串匹配，避免逐行解析整个文件
+                if needle in line:
+                    record = json.loads(line)
+                    if record.get("call_sid") == call_sid:
+                        results.append(record)
+        return results
+
+    def close(self):
+        pass
+
+
+def create_sink(kind: str = TRANSCRIPT_SINK, path: str = TRANSCRIPT_PATH):
+    if kind == "sqlite":
+        return SQLiteSink(path)
+    if kind == "jsonl":
+        return JsonlSink(path)
+    return None
+
+
+class TranscriptStore:
+    """
+    批量持久化管道
+    record() 只做一次 put_nowait，队列满时丢弃并计数，绝不等待
+    """
+
+    def __init__(self, sink, batch_size: int = TRANSCRIPT_BATCH_SIZE,
+                 batch_interval: float = TRANSCRIPT_BATCH_INTERVAL, queue_size: int = TRANSCRIPT_QUEUE_SIZE):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task: Optional[asyncio.Task] = None
+        # 单独的写线程：批次按顺序落盘，慢磁盘只会让队列变长
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcript-writer")
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, call_sid: str, role: str, text: str, latency_ms: Optional[float] = None, **extra):
+        record = {
+            "call_sid": call_sid,
+            "role": role,
+            "text": text,
+            "created_at": time.time(),
+            "latency_ms": latency_ms,
+        }
+        if extra:
+            record["extra"] = extra
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: List[dict]):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._writer, self.sink.write_batch, batch)
+            self.written += len(batch)
+        except Exception as e:
+            logger.error(f"❌ 转录写入失败（{len(batch)} 条）: {e}")
+
+    async def query(self, call_sid: str) -> List[dict]:
+        return await asyncio.to_thread(self.sink.query, call_sid)
+
+    async def close(self):
+        """写完队列中剩余的记录后停止后台任务"""
+        if self._task is not None:
+            await self.queue.put(None)
+            await self._task
+            self._task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer, self.sink.close)
+        self._writer.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "written": self.written, "dropped": self.dropped}
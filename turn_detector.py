@@ -0,0 +1,289 @@
+"""
+本地断句（客户端轮次检测）
+在解码后的 8kHz μ-law 来电音频上运行能量 VAD 和一个轻量的断句规则，
+由本服务决定用户何时说完，直接发送 input_audio_buffer.commit 和 response.create，
+不必等音频传到 OpenAI 后再由服务端 VAD 判断。TURN_DETECTION=local 时启用，会话中关闭服务端 turn_detection。
+
+断句规则：
+- 噪声底随通话自适应，高于噪声底 LOCAL_VAD_RATIO_DB 的帧视为语音
+- 语音之后连续静音达到阈值即判定说完；阈值按本通电话观察到的句中停顿自适应（停顿 p90 + 余量），
+  限制在 TURN_SILENCE_MIN_MS ~ TURN_SILENCE_MAX_MS 之间；停顿样本不足时不低于已见过的最长停顿 + 余量
+- 句尾约 600ms 的能量明显下降（陈述句收尾）时阈值缩短，但不短于已见过的最长停顿；明显上扬（话没说完）时阈值放宽
+- 判定说完后很快又开口，视为误断：该停顿计入统计，之后的阈值随之变长
+"""
+
+import os
+import audioop
+import logging
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TURN_DETECTION = os.getenv("TURN_DETECTION", "server")  # server / local
+LOCAL_VAD_RATIO_DB = float(os.getenv("LOCAL_VAD_RATIO_DB", "12"))  # 高于噪声底多少 dB 视为语音
+LOCAL_VAD_MIN_RMS = int(os.getenv("LOCAL_VAD_MIN_RMS", "300"))  # 语音帧的最低能量（16 位 PCM RMS）
+TURN_SILENCE_MS = float(os.getenv("TURN_SILENCE_MS", "500"))  # 初始静音阈值（与服务端默认相同，停顿样本足够后再自适应）
+TURN_SILENCE_MIN_MS = float(os.getenv("TURN_SILENCE_MIN_MS", "200"))
+TURN_SILENCE_MAX_MS = float(os.getenv("TURN_SILENCE_MAX_MS", "800"))
+
+# 连续多少毫秒语音才算开口（过滤咳嗽、按键音等短噪声）
+SPEECH_START_MS = 60
+# 一轮里语音总时长不足则不触发回复
+MIN_TURN_SPEECH_MS = 200
+# 说完后多久之内又开口算误断
+FALSE_ENDPOINT_MS = 600
+# 计入统计的最短句中停顿
+MIN_PAUSE_MS = 80
+# 阈值 = 停顿 p90 + 余量
+PAUSE_MARGIN_MS = 80
+# 用于判断句尾能量走势的帧数（20ms 一帧）：要跨过两三个音节，否则只是单个音节的起伏
+TAIL_FRAMES = 30
+# 句尾后半段能量低于前半段的此比例算收尾，高于此比例算上扬
+TAIL_FALLING_RATIO = 0.6
+TAIL_RISING_RATIO = 1.3
+# 收尾缩短阈值时，至少比最长的句中停顿多出这么多
+FALLING_PAUSE_MARGIN_MS = 20
+
+
+class TurnDetector:
+    """
+    单通电话的本地断句状态机，只做计算不做 I/O
+    process() 每收到一帧来电音频调用一次，返回：
+        "speech_started"  用户开口（新一轮）
+        "turn_ended"      用户说完，应提交音频并请求回复
+        "turn_resumed"    刚判定说完又接着说（误断），应取消尚未开始播放的回复
+        None              无变化
+    """
+
+    def __init__(self, silence_ms: float = TURN_SILENCE_MS, min_silence_ms: float = TURN_SILENCE_MIN_MS,
+                 max_silence_ms: float = TURN_SILENCE_MAX_MS, ratio_db: float = LOCAL_VAD_RATIO_DB,
+                 min_rms: int = LOCAL_VAD_MIN_RMS, adaptive: bool = True):
+        self.base_silence_ms = silence_ms
+        self.min_silence_ms = min_silence_ms
+        self.max_silence_ms = max_silence_ms
+        self.ratio = 10 ** (ratio_db / 20)
+        self.min_rms = min_rms
+        self.adaptive = adaptive
+
+        self.noise_floor = float(min_rms) / self.ratio
+        self.in_turn = False
+        self.voiced_run_ms = 0.0
+        self.silence_run_ms = 0.0
+        self.turn_speech_ms = 0.0
+        self.since_turn_end_ms: Optional[float] = None  # 距上次判定说完的时长，用于识别误断
+        self.last_endpoint_ms = 0.0
+        self.tail = deque(maxlen=TAIL_FRAMES)
+        self.pauses = deque(maxlen=50)
+
+        self.time_ms = 0.0  # 已处理的音频时长
+        self.speech_end_ms = 0.0  # 最近一次语音结束的位置
+        self.turns = 0
+        self.false_endpoints = 0
+
+    @property
+    def silence_threshold_ms(self) -> float:
+        """当前的静音阈值（未考虑句尾走势）"""
+        if not self.adaptive or not self.pauses:
+            return self.base_silence_ms
+        if len(self.pauses) < 3:
+            # 样本太少算不出分位数，至少不要截断已经见过的停顿
+            return min(self.max_silence_ms, max(self.base_silence_ms, max(self.pauses) + PAUSE_MARGIN_MS))
+        pauses = sorted(self.pauses)
+        p90 = pauses[min(len(pauses) - 1, int(len(pauses) * 0.9))]
+        return min(self.max_silence_ms, max(self.min_silence_ms, p90 + PAUSE_MARGIN_MS))
+
+    def _endpoint_ms(self) -> float:
+        """结合句尾能量走势的断句阈值"""
+        threshold = self.silence_threshold_ms
+        if not self.adaptive or len(self.tail) < TAIL_FRAMES:
+            return threshold
+        half = TAIL_FRAMES // 2
+        tail = list(self.tail)
+        head_energy = sum(tail[:half])
+        end_energy = sum(tail[half:])
+        if end_energy < head_energy * TAIL_FALLING_RATIO:
+            threshold *= 0.8
+            if self.pauses:
+                threshold = max(threshold, max(self.pauses) + FALLING_PAUSE_MARGIN_MS)
+        elif end_energy > head_energy * TAIL_RISING_RATIO:
+            threshold *= 1.25
+        return min(self.max_silence_ms, max(self.min_silence_ms, threshold))
+
+    def process(self, mulaw: bytes) -> Optional[str]:
+        frame_ms = len(mulaw) / 8
+        self.time_ms += frame_ms
+        rms = audioop.rms(audioop.ulaw2lin(mulaw, 2), 2)
+        voiced = rms >= max(self.min_rms, self.noise_floor * self.ratio)
+
+        if voiced:
+            self.voiced_run_ms += frame_ms
+            if self.voiced_run_ms < SPEECH_START_MS:
+                return None
+            return self._on_voice(frame_ms, rms)
+
+        # 只在非语音帧上更新噪声底：下降快、上升慢
+        if rms < self.noise_floor:
+            self.noise_floor = self.noise_floor * 0.9 + rms * 0.1
+        else:
+            self.noise_floor = self.noise_floor * 0.995 + rms * 0.005
+        self.voiced_run_ms = 0.0
+        return self._on_silence(frame_ms)
+
+    def _on_voice(self, frame_ms: float, rms: int) -> Optional[str]:
+        event = None
+        if not self.in_turn:
+            self.in_turn = True
+            self.turn_speech_ms = 0.0
+            self.tail.clear()
+            if self.since_turn_end_ms is not None and self.since_turn_end_ms < FALSE_ENDPOINT_MS:
+                # 刚判定说完又开口：这次停顿其实是句中停顿
+                self.false_endpoints += 1
+                self.pauses.append(self.since_turn_end_ms + self.last_endpoint_ms)
+                event = "turn_resumed"
+            else:
+                event = "speech_started"
+            self.since_turn_end_ms = None
+        elif self.silence_run_ms >= MIN_PAUSE_MS:
+            self.pauses.append(self.silence_run_ms)
+
+        # 开口判定前累积的语音帧也计入本轮
+        if self.voiced_run_ms == SPEECH_START_MS or event:
+            self.turn_speech_ms += self.voiced_run_ms
+        else:
+            self.turn_speech_ms += frame_ms
+        self.silence_run_ms = 0.0
+        self.speech_end_ms = self.time_ms
+        self.tail.append(rms)
+        return event
+
+    def _on_silence(self, frame_ms: float) -> Optional[str]:
+        if self.since_turn_end_ms is not None:
+            self.since_turn_end_ms += frame_ms
+        if not self.in_turn:
+            return None
+
+        self.silence_run_ms += frame_ms
+        endpoint_ms = self._endpoint_ms()
+        if self.silence_run_ms < endpoint_ms:
+            return None
+
+        self.in_turn = False
+        if self.turn_speech_ms < MIN_TURN_SPEECH_MS:
+            # 太短的声音不算一轮
+            return None
+        self.turns += 1
+        self.last_endpoint_ms = self.silence_run_ms
+        self.since_turn_end_ms = 0.0
+        return "turn_ended"
+
+    def stats(self) -> dict:
+        return {
+            "turns": self.turns,
+            "false_endpoints": self.false_endpoints,
+            "silence_threshold_ms": round(self.silence_threshold_ms),
+            "noise_floor": round(self.noise_floor),
+        }
+
+
+if __name__ == "__main__":
+    # 离线对比：用录音（CallRecorder 生成的立体声 WAV，取来电方声道）或合成的通话音频，
+    # 比较服务端式固定 500ms 静音判定与本地自适应断句的"说完 → 判定"延迟和误断次数。
+    # 参考断句点：语音之后静音超过 1.2 秒的位置视为真正说完。
+    import sys
+    import math
+    import random
+    import statistics
+
+    from audio_assets import FRAME_BYTES, iter_frames
+
+    TRUE_GAP_MS = 1200
+
+    def read_caller_audio(path: str) -> bytes:
+        with open(path, "rb") as f:
+            data = f.read()
+        start = data.find(b"data") + 8
+        channels = int.from_bytes(data[22:24], "little")
+        audio = data[start:]
+        return audio[0::2] if channels == 2 else audio
+
+    def synth_call(seed: int, pause_range, turns: int = 20) -> bytes:
+        """合成一通电话的来电方音频：音节包络调制的噪声，句中停顿按来电者习惯分布，一轮话的结尾能量渐弱"""
+        rng = random.Random(seed)
+        samples = []
+
+        def silence(ms):
+            samples.extend(rng.gauss(0, 60) for _ in range(int(ms * 8)))
+
+        silence(1000)
+        for _ in range(turns):
+            phrases = rng.randint(1, 3)
+            for phrase in range(phrases):
+                syllables = rng.randint(3, 10)
+                last_phrase = phrase == phrases - 1
+                for index in range(syllables):
+                    length = int(rng.uniform(150, 250) * 8)
+                    # 一轮话的最后几个音节逐渐变弱
+                    fade = 1.0 - 0.6 * max(0, index - syllables + 3) / 3 if last_phrase else 1.0
+                    amplitude = rng.uniform(2500, 6000) * fade
+                    samples.extend(amplitude * math.sin(math.pi * i / length) * rng.gauss(0, 1)
+                                   for i in range(length))
+                if not last_phrase:
+                    silence(rng.uniform(*pause_range))
+            silence(rng.uniform(1500, 3000))
+
+        pcm = b"".join(int(max(-32767, min(32767, s))).to_bytes(2, "little", signed=True) for s in samples)
+        return audioop.lin2ulaw(pcm, 2)
+
+    def reference_ends(audio: bytes):
+        """用宽松的阈值找出真正的说完时刻（ms）"""
+        detector = TurnDetector(silence_ms=TRUE_GAP_MS, adaptive=False)
+        ends = []
+        for frame in iter_frames(audio, FRAME_BYTES):
+            if detector.process(bytes(frame)) == "turn_ended":
+                ends.append(detector.speech_end_ms)
+        return ends
+
+    def evaluate(audio: bytes, detector: TurnDetector, truth):
+        latencies, false_endpoints = [], 0
+        remaining = list(truth)
+        for frame in iter_frames(audio, FRAME_BYTES):
+            if detector.process(bytes(frame)) != "turn_ended":
+                continue
+            end = detector.speech_end_ms
+            match = next((t for t in remaining if abs(t - end) < 1), None)
+            if match is None:
+                false_endpoints += 1
+            else:
+                remaining.remove(match)
+                latencies.append(detector.time_ms - end)
+        return latencies, false_endpoints, len(remaining)
+
+    if len(sys.argv) > 1:
+        corpus = [(os.path.basename(path), read_caller_audio(path)) for path in sys.argv[1:]]
+    else:
+        corpus = [
+            ("合成-停顿短", synth_call(1, (120, 300))),
+            ("合成-停顿中", synth_call(2, (250, 450))),
+            ("合成-停顿长", synth_call(3, (400, 650))),
+        ]
+
+    strategies = [
+        ("固定 500ms（服务端同款）", lambda: TurnDetector(silence_ms=500, adaptive=False)),
+        ("固定 300ms", lambda: TurnDetector(silence_ms=300, adaptive=False)),
+        ("本地自适应", lambda: TurnDetector()),
+    ]
+    print("说完 → 判定延迟（ms，均值 / p90），误断 / 漏判 / 总轮数")
+    print("（服务端 VAD 还要再加上音频上行到 OpenAI 的网络时间，本地判定没有这部分）")
+    for name, audio in corpus:
+        truth = reference_ends(audio)
+        print(f"{name}（{len(audio) / 8000:.0f} 秒，{len(truth)} 轮）")
+        for label, factory in strategies:
+            latencies, false_endpoints, missed = evaluate(audio, factory(), truth)
+            if latencies:
+                latencies.sort()
+                p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+                print(f"  {label:<20} {statistics.mean(latencies):6.0f} / {p90:6.0f}   "
+                      f"误断 {false_endpoints:>2}  漏判 {missed:>2}")
+            else:
+                print(f"  {label:<20} 未检测到轮次")
@@ -0,0 +1,310 @@
+"""
+服务端轮次检测的通话内自适应调参
+server_vad 的 threshold / silence_duration_ms 对所有来电者都一样：停顿多的人会被打断，说话干脆的人要多等。
+TurnTuner 观察本通电话的轮次统计，在限定范围内用通话中的 session.update 调整 turn_detection：
+- 误插话（模型说话时出现很短的"语音"，多为噪声或附和声）多 → 提高 threshold
+- 被截断（服务端判定说完后来电者很快又接着说）→ 按观察到的停顿加长 silence_duration_ms
+- 静音时长已到上限仍频繁被截断 → 切换到 semantic_vad（eagerness 从 low 开始）
+- 连续多轮没有截断 → 逐步缩短 silence_duration_ms，等待时间（静音 + 首包延迟）偏长时步子更大，
+  但不低于下限：缩短后被截断，则逐级退回缩短前的值并以它为下限；其他截断把下限抬到"最长截断停顿 + 余量"
+每次调整都写入日志和转录存储（role=turn_tuning），通话结束时再写一条汇总，便于离线评估策略。
+TURN_TUNING=true 且 TURN_DETECTION=server 时启用。
+"""
+
+import os
+import json
+import time
+import logging
+from collections import deque
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TURN_TUNING = os.getenv("TURN_TUNING", "false").lower() == "true"
+TURN_TUNE_SILENCE_MIN_MS = int(os.getenv("TURN_TUNE_SILENCE_MIN_MS", "300"))
+TURN_TUNE_SILENCE_MAX_MS = int(os.getenv("TURN_TUNE_SILENCE_MAX_MS", "1200"))
+TURN_TUNE_THRESHOLD_MAX = float(os.getenv("TURN_TUNE_THRESHOLD_MAX", "0.8"))
+TURN_TUNE_SEMANTIC = os.getenv("TURN_TUNE_SEMANTIC", "true").lower() == "true"  # 是否允许切换到 semantic_vad
+
+# 统计窗口（轮）；每次调整后清空，新配置重新积累
+TUNE_WINDOW = 4
+# 两次调整之间至少间隔的轮数
+TUNE_COOLDOWN = 2
+SILENCE_STEP_MS = 100
+THRESHOLD_STEP = 0.1
+# 判定说完后多久之内又开口算被截断
+CUTOFF_WINDOW_MS = 1500
+# 模型说话时出现的语音短于此值算误插话
+FALSE_BARGE_MS = 600
+# 静音时长 = 观察到的最长停顿 + 余量
+PAUSE_MARGIN_MS = 150
+# 来电者说完到听到回复的目标等待时间，超过时缩短静音的步子加倍
+TARGET_WAIT_MS = 1200
+# semantic_vad 的 eagerness 从等得最久到最积极
+EAGERNESS_LEVELS = ("low", "medium", "high")
+
+
+class TurnTuningPolicy:
+    """
+    调参策略，只做计算不做 I/O，便于离线回放
+    每轮在开口时 start_turn()，说完时 decide()；返回 (新 turn_detection, 原因) 或 None
+    """
+
+    def __init__(self, turn_detection: dict, silence_min_ms: int = TURN_TUNE_SILENCE_MIN_MS,
+                 silence_max_ms: int = TURN_TUNE_SILENCE_MAX_MS, threshold_max: float = TURN_TUNE_THRESHOLD_MAX,
+                 semantic: bool = TURN_TUNE_SEMANTIC):
+        self.config = dict(turn_detection)
+        self.silence_min_ms = silence_min_ms
+        self.silence_max_ms = silence_max_ms
+        self.threshold_max = threshold_max
+        self.semantic = semantic
+        self.turns = deque(maxlen=TUNE_WINDOW)
+        self.turns_since_change = 0
+        self.changes = 0
+        # 缩短静音时长的下限：只升不降，避免"缩短 → 截断 → 加长 → 再缩短"来回振荡
+        self.silence_floor_ms = silence_min_ms
+        # 每次缩短前的静音时长（栈）：缩短后被截断就逐级退回
+        self.shrunk_from_ms: List[int] = []
+        self.totals = {"turns": 0, "cutoffs": 0, "false_barge_ins": 0, "wait_ms": 0.0, "waits": 0}
+
+    def silence_ms(self) -> int:
+        return self.config.get("silence_duration_ms", 0)
+
+    def start_turn(self, cutoff_pause_ms: Optional[float] = None):
+        """新一轮开口；cutoff_pause_ms 不为 None 表示上一轮被截断，值为来电者实际停顿时长"""
+        self.turns.append({"cutoff_pause_ms": cutoff_pause_ms, "false_barge_in": False, "wait_ms": None})
+        self.totals["turns"] += 1
+        if cutoff_pause_ms is not None:
+            self.totals["cutoffs"] += 1
+
+    def mark_false_barge_in(self):
+        if self.turns:
+            self.turns[-1]["false_barge_in"] = True
+        self.totals["false_barge_ins"] += 1
+
+    def mark_wait(self, wait_ms: float):
+        """上一轮来电者说完到听到回复的等待时间"""
+        if self.turns:
+            self.turns[-1]["wait_ms"] = wait_ms
+        self.totals["wait_ms"] += wait_ms
+        self.totals["waits"] += 1
+
+    def window_stats(self) -> dict:
+        waits = [turn["wait_ms"] for turn in self.turns if turn["wait_ms"] is not None]
+        return {
+            "turns": len(self.turns),
+            "cutoff_pauses_ms": [round(turn["cutoff_pause_ms"]) for turn in self.turns
+                                 if turn["cutoff_pause_ms"] is not None],
+            "false_barge_ins": sum(1 for turn in self.turns if turn["false_barge_in"]),
+            "mean_wait_ms": round(sum(waits) / len(waits)) if waits else None,
+        }
+
+    def decide(self) -> Optional[Tuple[dict, str]]:
+        self.turns_since_change += 1
+        if self.turns_since_change < TUNE_COOLDOWN:
+            return None
+        stats = self.window_stats()
+        if self.config.get("type") == "semantic_vad":
+            change = self._decide_semantic(stats)
+        else:
+            change = self._decide_server_vad(stats)
+        if change:
+            silence = change[0].get("silence_duration_ms")
+            if silence is not None and silence < self.silence_ms():
+                self.shrunk_from_ms.append(self.silence_ms())
+            self.config = change[0]
+            self.turns.clear()
+            self.turns_since_change = 0
+            self.changes += 1
+        return change
+
+    def _decide_server_vad(self, stats: dict) -> Optional[Tuple[dict, str]]:
+        config = self.config
+        silence = config["silence_duration_ms"]
+        cutoffs = stats["cutoff_pauses_ms"]
+
+        if stats["false_barge_ins"] >= 2 and config["threshold"] < self.threshold_max:
+            threshold = round(min(self.threshold_max, config["threshold"] + THRESHOLD_STEP), 2)
+            return dict(config, threshold=threshold), "false_barge_in"
+
+        if cutoffs:
+            floor = max(cutoffs) + PAUSE_MARGIN_MS
+            if self.shrunk_from_ms and max(cutoffs) <= self.shrunk_from_ms[-1]:
+                # 缩短后被截断，且缩短前的值不会截断这些停顿：它已经过一整个窗口的验证，退回去并以它为下限
+                floor = self.shrunk_from_ms.pop()
+            self.silence_floor_ms = int(min(self.silence_max_ms, max(self.silence_floor_ms, floor)))
+            if silence >= self.silence_max_ms and len(cutoffs) >= 2 and self.semantic:
+                return {"type": "semantic_vad", "eagerness": EAGERNESS_LEVELS[0]}, "cutoff_at_max_silence"
+            target = max(silence + SILENCE_STEP_MS, self.silence_floor_ms)
+            target = int(min(self.silence_max_ms, target))
+            if target > silence:
+                return dict(config, silence_duration_ms=target), "cutoff"
+            return None
+
+        if stats["turns"] == TUNE_WINDOW and silence > self.silence_floor_ms:
+            slow = stats["mean_wait_ms"] is not None and stats["mean_wait_ms"] > TARGET_WAIT_MS
+            step = SILENCE_STEP_MS * (2 if slow else 1)
+            target = int(max(self.silence_floor_ms, silence - step))
+            return dict(config, silence_duration_ms=target), "slow_response" if slow else "no_cutoff"
+        return None
+
+    def _decide_semantic(self, stats: dict) -> Optional[Tuple[dict, str]]:
+        level = EAGERNESS_LEVELS.index(self.config.get("eagerness", "low")) \
+            if self.config.get("eagerness") in EAGERNESS_LEVELS else 0
+        if stats["cutoff_pauses_ms"] and level > 0:
+            return dict(self.config, eagerness=EAGERNESS_LEVELS[level - 1]), "cutoff"
+        if (stats["turns"] == TUNE_WINDOW and not stats["cutoff_pauses_ms"] and level < len(EAGERNESS_LEVELS) - 1
+                and stats["mean_wait_ms"] is not None and stats["mean_wait_ms"] > TARGET_WAIT_MS):
+            return dict(self.config, eagerness=EAGERNESS_LEVELS[level + 1]), "slow_response"
+        return None
+
+    def summary(self) -> dict:
+        totals = self.totals
+        return {
+            "turn_detection": self.config,
+            "changes": self.changes,
+            "silence_floor_ms": self.silence_floor_ms,
+            "turns": totals["turns"],
+            "cutoffs": totals["cutoffs"],
+            "false_barge_ins": totals["false_barge_ins"],
+            "mean_wait_ms": round(totals["wait_ms"] / totals["waits"]) if totals["waits"] else None,
+        }
+
+
+class TurnTuner:
+    """单通电话的调参器：订阅服务端 VAD 事件，把调整通过 session.update 发给 OpenAI"""
+
+    def __init__(self, bridge, policy: Optional[TurnTuningPolicy] = None):
+        self.bridge = bridge
+        self.policy = policy or TurnTuningPolicy(bridge.session["session_config"]["session"]["turn_detection"])
+        self.speech_started_at: Optional[float] = None
+        self.speech_stopped_at: Optional[float] = None
+        self.barge_in = False
+        bridge.dispatcher.subscribe("input_audio_buffer.speech_started", self.on_speech_started)
+        bridge.dispatcher.subscribe("input_audio_buffer.speech_stopped", self.on_speech_stopped)
+
+    def on_speech_started(self, data: dict):
+        session = self.bridge.session
+        now = time.monotonic()
+        # 上一轮的等待时间 = 服务端静音判定 + 说完到首个音频包
+        if session.get("response_latency_ms") is not None:
+            self.policy.mark_wait(self.policy.silence_ms() + session["response_latency_ms"])
+
+        cutoff_pause_ms = None
+        if self.speech_stopped_at is not None:
+            gap_ms = (now - self.speech_stopped_at) * 1000
+            if gap_ms < CUTOFF_WINDOW_MS:
+                # speech_stopped 在静音持续 silence_duration_ms 后才发出
+                cutoff_pause_ms = self.policy.silence_ms() + gap_ms
+        self.barge_in = cutoff_pause_ms is None and session["model_audio_until"] > now
+        self.speech_started_at = now
+        self.policy.start_turn(cutoff_pause_ms)
+
+    async def on_speech_stopped(self, data: dict):
+        now = time.monotonic()
+        if self.barge_in and self.speech_started_at is not None:
+            speech_ms = (now - self.speech_started_at) * 1000 - self.policy.silence_ms()
+            if speech_ms < FALSE_BARGE_MS:
+                self.policy.mark_false_barge_in()
+            self.barge_in = False
+        self.speech_stopped_at = now
+
+        before = self.policy.config
+        stats = self.policy.window_stats()
+        change = self.policy.decide()
+        if change:
+            await self.apply(before, change[0], change[1], stats)
+
+    async def apply(self, before: dict, after: dict, reason: str, stats: dict):
+        bridge = self.bridge
+        # 重连时发送的会话配置也随之更新
+        bridge.session["session_config"]["session"]["turn_detection"] = after
+        await bridge.send_openai(json.dumps({
+            "type": "session.update",
+            "session": {"type": "realtime", "turn_detection": after}
+        }))
+        logger.info(f"[{bridge.call_sid}] 🎛️ 调整轮次检测（{reason}）: {before} → {after}，窗口统计 {stats}")
+        if bridge.services.transcript_store:
+            bridge.services.transcript_store.record(bridge.call_sid, "turn_tuning", reason,
+                                                    before=before, after=after, stats=stats)
+
+    def finish(self):
+        """通话结束时记录汇总，供离线对比不同策略"""
+        bridge = self.bridge
+        summary = self.policy.summary()
+        logger.info(f"[{bridge.call_sid}] 🎛️ 轮次检测调参汇总: {summary}")
+        if bridge.services.transcript_store:
+            bridge.services.transcript_store.record(bridge.call_sid, "turn_tuning", "summary", **summary)
+
+
+if __name__ == "__main__":
+    # 合成来电者离线对比：固定 server_vad 参数 vs 通话内自适应调参
+    # 服务端 VAD 按简化模型处理：句中停顿超过 silence_duration_ms 即截断，
+    # 噪声强度超过 threshold 即触发插话；semantic_vad 假定只在很长的停顿处截断
+    import random
+
+    MODEL_LATENCY_MS = 700
+    TURNS = 40
+    CALLS = 50
+    SEMANTIC_CUTOFF_MS = {"low": 2000, "medium": 1400, "high": 900}
+    SEMANTIC_WAIT_MS = {"low": 900, "medium": 600, "high": 400}
+
+    CALLERS = {
+        "说话干脆": {"pause_ms": (150, 350), "pauses": (0, 2), "noise": 0.3},
+        "常有停顿": {"pause_ms": (300, 900), "pauses": (1, 3), "noise": 0.4},
+        "环境嘈杂": {"pause_ms": (200, 500), "pauses": (0, 2), "noise": 0.75},
+    }
+    BASELINE = {"type": "server_vad", "threshold": 0.5, "prefix_padding_ms": 300, "silence_duration_ms": 500}
+
+    def cut_and_wait(config: dict):
+        if config["type"] == "semantic_vad":
+            return SEMANTIC_CUTOFF_MS[config["eagerness"]], SEMANTIC_WAIT_MS[config["eagerness"]]
+        return config["silence_duration_ms"], config["silence_duration_ms"]
+
+    def simulate_call(profile: dict, tune: bool, rng: random.Random) -> dict:
+        policy = TurnTuningPolicy(BASELINE)
+        cutoffs = false_barges = 0
+        waits = []
+
+        def speech_stopped():
+            if tune:
+                policy.decide()
+
+        for _ in range(TURNS):
+            # 来电者一轮话中的停顿：超过截断阈值的每一次都被服务端提前结束，来电者随后接着说
+            policy.start_turn()
+            for _ in range(rng.randint(*profile["pauses"])):
+                pause = rng.uniform(*profile["pause_ms"])
+                if pause > cut_and_wait(policy.config)[0]:
+                    cutoffs += 1
+                    speech_stopped()
+                    policy.start_turn(pause)
+            speech_stopped()
+
+            wait_ms = cut_and_wait(policy.config)[1] + MODEL_LATENCY_MS
+            waits.append(wait_ms)
+
+            # 模型回复期间的背景噪声或附和声
+            config = policy.config
+            if config["type"] == "server_vad" and rng.random() < profile["noise"] \
+                    and rng.uniform(0.3, 1.0) > config["threshold"]:
+                false_barges += 1
+                policy.start_turn()
+                policy.mark_false_barge_in()
+                speech_stopped()
+            policy.mark_wait(wait_ms)
+        return {"cutoffs": cutoffs, "false_barges": false_barges, "wait": sum(waits) / len(waits),
+                "changes": policy.changes, "final": policy.config}
+
+    print(f"每类来电者 {CALLS} 通 × {TURNS} 轮，模型首包 {MODEL_LATENCY_MS} ms")
+    print(f"{'来电者':<8} {'策略':<6} {'截断/通':>8} {'误插话/通':>10} {'平均等待 ms':>12} {'调整次数':>8}")
+    for name, profile in CALLERS.items():
+        for tune in (False, True):
+            rng = random.Random(7)
+            results = [simulate_call(profile, tune, rng) for _ in range(CALLS)]
+            print(f"{name:<8} {'自适应' if tune else '固定':<6} "
+                  f"{sum(r['cutoffs'] for r in results) / CALLS:>8.1f} "
+                  f"{sum(r['false_barges'] for r in results) / CALLS:>10.1f} "
+                  f"{sum(r['wait'] for r in results) / CALLS:>12.0f} "
+                  f"{sum(r['changes'] for r in results) / CALLS:>8.1f}")
+        print(f"{'':<8} 示例最终配置: {results[0]['final']}")
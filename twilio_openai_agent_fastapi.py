@@ -6,21 +6,50 @@ Twilio + OpenAI Realtime API 语音代理 (FastAPI 版本)
 
 import os
 import json
-import base64
+import time
 import asyncio
-import audioop
+import uuid
+import signal
+from datetime import datetime
 from typing import Dict, Optional
 from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
-from twilio.rest import Client
 from twilio.twiml.voice_response import VoiceResponse, Connect, Stream
 import websockets
 from dotenv import load_dotenv
 import logging
 
+# 先加载 .env：下面的模块在导入时读取各自的配置
 load_dotenv()
 
+from call_recorder import RECORDING_ENABLED, CallRecorder
+from audio_assets import AudioAssetLibrary
+from greeting_cache import GreetingCache
+from transcript_store import TranscriptStore, create_sink
+from context_window import CONTEXT_STRATEGY
+from admission import AdmissionController
+from call_bridge import BridgeServices, CallBridge
+from asgi_bridge import media_stream_fast_path
+from call_registry import create_registry
+from tool_calls import load_tools
+from turn_detector import TURN_DETECTION
+from turn_tuner import TURN_TUNING
+from answering_machine import AMD_ENABLED, AMD_TWILIO
+from audio_shaping import OUTBOUND_SHAPING
+from call_routing import CallRouter
+from tenants import TenantDirectory, TenantQuotas
+from prompt_templates import PromptCacheReport, PromptLibrary
+from cost_accounting import CALL_BUDGET_USD, COST_TRACKING, CallBudget, CostLedger
+from openai_sip import (
+    RealtimeCallControl,
+    WebhookDeduplicator,
+    build_accept_config,
+    sip_header,
+    sip_user,
+    verify_webhook,
+)
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -43,11 +72,23 @@ TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
 # OpenAI 配置
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = "gpt-realtime"
+# 接口地址可指向本地 openai_sip_stub.py 进行测试
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_REALTIME_URL = os.getenv("OPENAI_REALTIME_URL", "wss://api.openai.com/v1/realtime")
+OPENAI_WEBHOOK_SECRET = os.getenv("OPENAI_WEBHOOK_SECRET")  # SIP 直连模式的 webhook 签名密钥
+# OpenAI WebSocket 意外断开后的重连时限（秒），超时则结束通话
+OPENAI_RECONNECT_TIMEOUT = float(os.getenv("OPENAI_RECONNECT_TIMEOUT", "5"))
 
 # 服务器配置
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "5000"))
 PUBLIC_URL = os.getenv("PUBLIC_URL")  # 公网访问地址（如 ngrok URL）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # 管理接口的 Bearer Token，未配置时不校验
+
+# 排空模式：等待活动通话结束的最长时间（秒），超时后直接退出
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "600"))
+# 收到 SIGTERM 时先排空再退出（Windows 不支持信号处理，仅可用管理接口）
+DRAIN_ON_SIGTERM = os.getenv("DRAIN_ON_SIGTERM", "true").lower() == "true"
 
 # AI 助手配置
 DEFAULT_INSTRUCTIONS = os.getenv(
@@ -55,10 +96,74 @@ DEFAULT_INSTRUCTIONS = os.getenv(
     "你是一个友好、专业的客服助手。用中文与用户交流，保持礼貌和耐心。"
 )
 DEFAULT_VOICE = os.getenv("AI_VOICE", "alloy")
+DEFAULT_GREETING = os.getenv("AI_GREETING")  # 开场问候语，配置后从缓存立即播放
+
+# 外呼的最终状态：以这些状态结束时不会再有媒体流来释放拨号名额
+TERMINAL_CALL_STATUSES = ("completed", "busy", "no-answer", "failed", "canceled")
 
 # 存储活动会话
 active_sessions: Dict[str, dict] = {}
 
+# Twilio REST 客户端：导入 twilio.rest 较慢且只有外呼用得到，首次外呼时再创建并复用（按账号缓存）
+twilio_clients: Dict[tuple, object] = {}
+
+# 多租户配置（TENANTS_SOURCE 未配置时不启用）和按租户的配额、用量
+tenant_directory = TenantDirectory()
+tenant_quotas = TenantQuotas()
+
+# 多 worker 部署（serve.py）时登记本进程持有的通话
+call_registry = create_registry()
+
+# 准入控制：过载时新外呼排队或拒绝，来电返回忙音提示
+admission = AdmissionController(lambda: len(active_sessions))
+drain_task: Optional[asyncio.Task] = None
+
+# 预合成的问候音频缓存（所有通话共享）
+greeting_cache = GreetingCache()
+
+# 保持音乐、垫话等预编码素材（所有通话共享同一份 mmap）
+audio_assets = AudioAssetLibrary()
+
+# 通话录音（可选），写盘由后台线程完成
+call_recorder = CallRecorder() if RECORDING_ENABLED else None
+
+# 对话转录持久化（默认关闭，TRANSCRIPT_SINK=sqlite/jsonl 时开启）
+transcript_sink = create_sink()
+transcript_store = TranscriptStore(transcript_sink) if transcript_sink else None
+
+# 来电路由表（ROUTES_FILE 不存在时所有来电使用默认配置）
+call_router = CallRouter()
+
+# 提示词模板（启动时编译）和按模板汇总的缓存命中率
+prompt_library = PromptLibrary()
+prompt_report = PromptCacheReport()
+
+# token 用量与费用统计（COST_TRACKING=false 时关闭，预算也随之不生效）
+cost_ledger = CostLedger() if COST_TRACKING else None
+
+# 模型可调用的工具（TOOLS_MODULE 未配置时为空，不声明任何工具）
+tool_registry = load_tools()
+
+# 通话桥接共享的配置和组件
+bridge_services = BridgeServices(
+    OPENAI_REALTIME_URL,
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    greeting_cache=greeting_cache,
+    audio_assets=audio_assets,
+    recorder=call_recorder,
+    transcript_store=transcript_store,
+    context_strategy=CONTEXT_STRATEGY,
+    reconnect_timeout=OPENAI_RECONNECT_TIMEOUT,
+    tools=tool_registry,
+    turn_detection=TURN_DETECTION,
+    turn_tuning=TURN_TUNING,
+    outbound_shaping=OUTBOUND_SHAPING,
+    prompt_report=prompt_report,
+    cost_ledger=cost_ledger,
+    prompt_library=prompt_library
+)
+
 
 # ==================== Pydantic 模型 ====================
 
@@ -66,7 +171,11 @@ class CallRequest(BaseModel):
     """发起呼叫请求模型"""
     to: str  # 被叫号码（E.164格式）
     instructions: Optional[str] = None  # AI 指令
-    voice: Optional[str] = "alloy"  # 语音风格
+    voice: Optional[str] = None  # 语音风格
+    greeting: Optional[str] = None  # 开场问候语
+    tenant: Optional[str] = None  # 租户 ID，使用该租户的账号、号码、默认配置和配额
+    template: Optional[str] = None  # 提示词模板名称，指定时忽略 instructions
+    variables: Optional[Dict[str, str]] = None  # 模板中本通电话的变量
 
 
 class CallResponse(BaseModel):
@@ -79,180 +188,230 @@ class CallResponse(BaseModel):
     error: Optional[str] = None
 
 
+class AssetPlaybackRequest(BaseModel):
+    """播放音频素材请求模型"""
+    asset: str  # 素材名称（文件名，不含扩展名）
+    loop: bool = False  # 是否循环播放（保持音乐）
+    mode: str = "interleave"  # interleave：模型说话时停止；mix：作为背景音混入
+
+
 class HealthResponse(BaseModel):
     """健康检查响应"""
     status: str
     service: str
     active_sessions: int
+    capacity: Optional[dict] = None
 
 
-# ==================== 音频处理 ====================
+# ==================== 媒体流桥接 ====================
 
-class AudioProcessor:
-    """音频格式转换处理器"""
+class FastAPITransport:
+    """FastAPI WebSocket 的 CallBridge 传输适配器"""
 
-    @staticmethod
-    def mulaw_to_pcm24k(mulaw_data: bytes) -> bytes:
-        """
-        将 μ-law 8kHz 转换为 PCM 24kHz
-        Twilio 使用 μ-law, OpenAI 使用 PCM
-        """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+
+    async def receive_text(self) -> Optional[str]:
         try:
-            # μ-law 解码为 PCM 16-bit
-            pcm_8k = audioop.ulaw2lin(mulaw_data, 2)
-            # 重采样 8kHz → 24kHz
-            pcm_24k, _ = audioop.ratecv(pcm_8k, 2, 1, 8000, 24000, None)
-            return pcm_24k
-        except Exception as e:
-            logger.error(f"音频转换错误 (μ-law→PCM): {e}")
-            return b""
-
-    @staticmethod
-    def pcm24k_to_mulaw(pcm_data: bytes) -> bytes:
-        """
-        将 PCM 24kHz 转换为 μ-law 8kHz
-        OpenAI 输出 PCM, Twilio 需要 μ-law
-        """
+            return await self.websocket.receive_text()
+        except WebSocketDisconnect:
+            return None
+
+    async def send_text(self, text: str):
+        await self.websocket.send_text(text)
+
+    async def close(self, code: int = 1000):
+        await self.websocket.close(code)
+
+
+async def run_media_stream(transport, params):
+    """FastAPI 路由和原生 ASGI 入口共用的媒体流处理"""
+    call_sid = params.get("call_sid", "unknown")
+    tenant = tenant_directory.get(params.get("tenant"))
+    default_instructions = (tenant and tenant.instructions) or DEFAULT_INSTRUCTIONS
+    default_voice = (tenant and tenant.voice) or DEFAULT_VOICE
+    default_greeting = (tenant and tenant.greeting) or DEFAULT_GREETING
+    instructions = params.get("instructions", default_instructions)
+    voice = params.get("voice", default_voice)
+    greeting = params.get("greeting", default_greeting)
+    tools = None
+    template = None
+    if params.get("template"):
+        # 外呼模板在这里渲染，URL 里只带模板名和变量
         try:
-            # 重采样 24kHz → 8kHz
-            pcm_8k, _ = audioop.ratecv(pcm_data, 2, 1, 24000, 8000, None)
-            # PCM 编码为 μ-law
-            mulaw = audioop.lin2ulaw(pcm_8k, 2)
-            return mulaw
-        except Exception as e:
-            logger.error(f"音频转换错误 (PCM→μ-law): {e}")
-            return b""
-
-
-# ==================== 音频转发任务 ====================
-
-async def forward_twilio_to_openai(websocket: WebSocket, call_sid: str):
-    """转发音频：Twilio → OpenAI"""
-    logger.info(f"[{call_sid}] 开始转发 Twilio → OpenAI")
-    session = active_sessions.get(call_sid)
-
-    if not session:
-        logger.error(f"[{call_sid}] 会话不存在")
-        return
-
-    openai_ws = session["openai_ws"]
+            variables = json.loads(params.get("variables") or "{}")
+        except ValueError:
+            variables = {}
+        instructions, template = render_call_template(call_sid, params["template"], variables, default_instructions)
+    # 来电路由选中的配置；路由表在此期间被删改时退回默认配置
+    profile = call_router.profile(params.get("profile"))
+    if profile:
+        instructions = profile.get("instructions", default_instructions)
+        voice = profile.get("voice", default_voice)
+        greeting = profile.get("greeting", default_greeting)
+        tools = profile.get("tools")
+        if profile.get("template"):
+            instructions, template = render_profile_template(call_sid, profile, instructions)
 
+    logger.info(f"[{call_sid}] 🔌 WebSocket 连接已建立")
+    await release_reservation(call_sid, tenant)
+
+    if tenant:
+        reason = tenant_quotas.start(tenant, call_sid)
+        if reason:
+            logger.warning(f"[{call_sid}] ⚠️ 租户 {tenant.id} 超出配额 ({reason})，拒绝媒体流")
+            await transport.close()
+            return
+
+    budget = CallBudget(tenant.id, tenant.call_budget_usd or CALL_BUDGET_USD, tenant.daily_budget_usd) \
+        if tenant else CallBudget()
+    bridge = CallBridge(call_sid, transport, bridge_services, instructions, voice, greeting,
+                        screen=params.get("amd") == "1", tools=tools,
+                        api_key=tenant.openai_api_key if tenant else None, template=template, budget=budget,
+                        tenant=tenant.id if tenant else None)
+    active_sessions[call_sid] = bridge.session
+    if call_registry:
+        call_registry.register(call_sid)
     try:
-        while True:
-            # 从 Twilio WebSocket 接收消息
-            try:
-                message = await websocket.receive_text()
-            except WebSocketDisconnect:
-                logger.info(f"[{call_sid}] Twilio WebSocket 断开连接")
-                break
-
-            data = json.loads(message)
-
-            # 保存 stream SID
-            if data.get("event") == "start":
-                stream_sid = data["start"]["streamSid"]
-                session["stream_sid"] = stream_sid
-                logger.info(f"[{call_sid}] 媒体流已启动: {stream_sid}")
-
-            # 处理音频数据
-            elif data.get("event") == "media":
-                payload = data["media"]["payload"]
-                # Twilio 发送的是 base64 编码的 μ-law 音频
-                mulaw_data = base64.b64decode(payload)
-                # 转换为 PCM 24kHz
-                pcm_data = AudioProcessor.mulaw_to_pcm24k(mulaw_data)
-
-                if pcm_data:
-                    # 发送给 OpenAI (base64 编码)
-                    pcm_base64 = base64.b64encode(pcm_data).decode("utf-8")
-                    await openai_ws.send(json.dumps({
-                        "type": "input_audio_buffer.append",
-                        "audio": pcm_base64
-                    }))
-
-            # 呼叫结束
-            elif data.get("event") == "stop":
-                logger.info(f"[{call_sid}] Twilio 媒体流已停止")
-                break
+        await bridge.run()
+    finally:
+        active_sessions.pop(call_sid, None)
+        if tenant:
+            tenant_quotas.end(tenant, call_sid)
+        if call_registry:
+            call_registry.unregister(call_sid)
+        logger.info(f"[{call_sid}] 🔚 会话已结束")
 
-    except Exception as e:
-        logger.error(f"[{call_sid}] Twilio→OpenAI 转发错误: {e}")
 
+def render_profile_template(call_sid: str, profile: dict, fallback: str):
+    """用路由配置指定的模板渲染来电的指令；变量为配置中的 variables 加上 call_sid 和当前日期时间"""
+    now = datetime.now()
+    variables = {**profile.get("variables", {}), "call_sid": call_sid,
+                 "date": now.strftime("%Y-%m-%d"), "time": now.strftime("%H:%M")}
+    return render_call_template(call_sid, profile["template"], variables, fallback)
 
-async def forward_openai_to_twilio(websocket: WebSocket, call_sid: str):
-    """转发音频：OpenAI → Twilio"""
-    logger.info(f"[{call_sid}] 开始转发 OpenAI → Twilio")
-    session = active_sessions.get(call_sid)
 
-    if not session:
-        logger.error(f"[{call_sid}] 会话不存在")
+def render_call_template(call_sid: str, name: str, variables: Optional[dict], fallback: str):
+    """渲染模板指令，返回 (指令, 模板名)；模板已被删除或缺少变量时使用 fallback"""
+    try:
+        return prompt_library.render(name, variables), name
+    except KeyError as e:
+        logger.error(f"[{call_sid}] ❌ 提示词模板 {name} 渲染失败（缺少 {e}），使用默认指令")
+        return fallback, None
+
+
+async def forward_to_owner(request: Request, call_sid: str) -> Optional[Response]:
+    """多 worker 部署时，通话不在本进程则把请求转发给持有它的 worker"""
+    if call_sid in active_sessions or not call_registry:
+        return None
+    port = call_registry.lookup(call_sid)
+    if port is None or port == call_registry.port:
+        return None
+
+    import httpx
+    headers = {"content-type": request.headers.get("content-type", "application/json")}
+    if "authorization" in request.headers:
+        # 持有通话的 worker 会再次校验管理 Token
+        headers["authorization"] = request.headers["authorization"]
+    try:
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            upstream = await client.request(
+                request.method,
+                f"http://127.0.0.1:{port}{request.url.path}",
+                content=await request.body(),
+                headers=headers
+            )
+    except httpx.ConnectError as e:
+        # 持有方 worker 已退出（崩溃时来不及注销），清掉过期登记后按本进程没有该通话处理
+        logger.warning(f"[{call_sid}] ⚠️ worker {port} 不可达，移除过期的通话登记: {e}")
+        call_registry.evict(call_sid, port)
+        return None
+    except httpx.HTTPError as e:
+        logger.warning(f"[{call_sid}] ⚠️ 转发到 worker {port} 失败: {e}")
+        raise HTTPException(status_code=502, detail=f"Owner worker unavailable: {port}")
+    return Response(content=upstream.content, status_code=upstream.status_code,
+                    media_type=upstream.headers.get("content-type"))
+
+
+async def release_reservation(call_sid: str, tenant):
+    """
+    媒体流已建立，释放拨号阶段占用的名额
+    多 worker 部署时名额可能由另一个 worker 占用（媒体流落到了其他进程），
+    此时通知占用方释放它的准入名额和租户名额；本进程的租户名额由 tenant_quotas.start 接管
+    """
+    admission.release(call_sid)
+    if not call_registry:
+        return
+    port = call_registry.reservation_owner(call_sid)
+    if port is None or port == call_registry.port:
+        call_registry.release_reservation(call_sid)
         return
 
-    openai_ws = session["openai_ws"]
-
+    import httpx
     try:
-        async for message in openai_ws:
-            data = json.loads(message)
-            event_type = data.get("type")
-
-            # 记录重要事件
-            if event_type == "session.created":
-                logger.info(f"[{call_sid}] OpenAI 会话已创建")
-
-            elif event_type == "session.updated":
-                logger.info(f"[{call_sid}] OpenAI 会话已更新")
-
-            elif event_type == "response.audio.delta":
-                # OpenAI 返回的音频增量
-                audio_base64 = data.get("delta")
-
-                if audio_base64 and session:
-                    # 解码 PCM 音频
-                    pcm_data = base64.b64decode(audio_base64)
-                    # 转换为 μ-law 8kHz
-                    mulaw_data = AudioProcessor.pcm24k_to_mulaw(pcm_data)
-
-                    if mulaw_data:
-                        # 发送给 Twilio (base64 编码)
-                        mulaw_base64 = base64.b64encode(mulaw_data).decode("utf-8")
-                        stream_sid = session.get("stream_sid")
-
-                        if stream_sid:
-                            await websocket.send_json({
-                                "event": "media",
-                                "streamSid": stream_sid,
-                                "media": {
-                                    "payload": mulaw_base64
-                                }
-                            })
-
-            elif event_type == "response.audio_transcript.done":
-                transcript = data.get("transcript", "")
-                logger.info(f"[{call_sid}] AI 回复: {transcript}")
-
-            elif event_type == "conversation.item.input_audio_transcription.completed":
-                transcript = data.get("transcript", "")
-                logger.info(f"[{call_sid}] 用户说: {transcript}")
-
-            elif event_type == "error":
-                error_msg = data.get("error", {})
-                logger.error(f"[{call_sid}] OpenAI 错误: {error_msg}")
-
-    except websockets.exceptions.ConnectionClosed:
-        logger.info(f"[{call_sid}] OpenAI WebSocket 连接已关闭")
-    except Exception as e:
-        logger.error(f"[{call_sid}] OpenAI→Twilio 转发错误: {e}")
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            await client.post(f"http://127.0.0.1:{port}/internal/reservations/{call_sid}/release",
+                              params={"tenant": tenant.id} if tenant else None)
+    except httpx.HTTPError as e:
+        # 占用方的名额会在 TTL 后自动过期
+        logger.warning(f"[{call_sid}] ⚠️ 通知 worker {port} 释放名额失败: {e}")
+
+
+def get_twilio_client(tenant=None):
+    """首次调用时导入 Twilio SDK 并创建客户端；租户配置了自己的账号时使用该账号"""
+    if tenant and tenant.twilio_account_sid:
+        account_sid, auth_token = tenant.twilio_account_sid, tenant.twilio_auth_token
+    else:
+        account_sid, auth_token = TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN
+    # 按（账号，token）缓存：租户更换 token 后自动使用新客户端
+    client = twilio_clients.get((account_sid, auth_token))
+    if client is None:
+        from twilio.rest import Client
+        client = twilio_clients[(account_sid, auth_token)] = Client(account_sid, auth_token)
+    return client
+
+
+def over_daily_budget(tenant) -> bool:
+    return bool(tenant and cost_ledger and cost_ledger.over_daily_budget(tenant.id, tenant.daily_budget_usd))
+
+
+def reserve_inbound(call_sid: str, tenant) -> Optional[str]:
+    """来电占用租户和本机的名额，任一不足时返回原因"""
+    if over_daily_budget(tenant):
+        return f"tenant {tenant.id}: daily_budget"
+    if tenant:
+        reason = tenant_quotas.try_reserve(tenant, call_sid)
+        if reason:
+            return f"tenant {tenant.id}: {reason}"
+    if not admission.try_reserve(call_sid):
+        if tenant:
+            tenant_quotas.release(tenant, call_sid)
+        return admission.overload_reason()
+    if call_registry:
+        call_registry.reserve(call_sid)
+    return None
+
+
+def busy_response() -> Response:
+    response = VoiceResponse()
+    response.say("当前线路繁忙，请稍后再拨。", language="zh-CN")
+    response.hangup()
+    return Response(content=str(response), media_type="text/xml")
 
 
 # ==================== FastAPI 路由 ====================
 
 @app.get("/", response_model=HealthResponse)
-async def index():
-    """健康检查"""
+async def index(response: Response):
+    """健康检查，过载时返回 503 供负载均衡器分流"""
+    capacity = admission.capacity()
+    if not capacity["accepting"]:
+        response.status_code = 503
     return HealthResponse(
-        status="running",
+        status="running" if capacity["accepting"] else "overloaded",
         service="Twilio + OpenAI Realtime Agent",
-        active_sessions=len(active_sessions)
+        active_sessions=len(active_sessions),
+        capacity=capacity
     )
 
 
@@ -267,40 +426,109 @@ async def make_call(call_request: CallRequest):
     Returns:
         CallResponse: 呼叫结果
     """
+    if call_request.template:
+        # 先校验模板和变量；渲染后的指令可能很长，留到建立媒体流时再渲染，URL 只带模板名和变量
+        template = prompt_library.get(call_request.template)
+        if template is None:
+            raise HTTPException(status_code=404, detail=f"Unknown template: {call_request.template}")
+        try:
+            template.render(call_request.variables)
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Missing template variable: {e.args[0]}")
+
+    tenant = None
+    if call_request.tenant:
+        tenant = tenant_directory.get(call_request.tenant)
+        if tenant is None:
+            raise HTTPException(status_code=404, detail=f"Unknown tenant: {call_request.tenant}")
+
+    if over_daily_budget(tenant):
+        logger.warning(f"⚠️ 租户 {tenant.id} 今日费用已达预算，拒绝外呼: {call_request.to}")
+        raise HTTPException(status_code=402, detail="Tenant daily budget exhausted")
+
+    reservation = uuid.uuid4().hex
+    # 租户配额不排队，超出时立即拒绝
+    if tenant:
+        reason = tenant_quotas.try_reserve(tenant, reservation)
+        if reason:
+            logger.warning(f"⚠️ 租户 {tenant.id} 超出配额，拒绝外呼: {call_request.to} ({reason})")
+            raise HTTPException(status_code=429, detail=f"Tenant quota exceeded: {reason}",
+                                headers={"Retry-After": "1" if reason == "calls_per_second" else "5"})
+
+    # 过载时排队等待名额，超时或队列已满则拒绝
+    if not await admission.acquire(reservation):
+        if tenant:
+            tenant_quotas.release(tenant, reservation)
+        capacity = admission.capacity()
+        logger.warning(f"⚠️ 容量不足，拒绝外呼: {call_request.to} ({capacity['reason']})")
+        raise HTTPException(status_code=503, detail=f"Server at capacity: {capacity['reason']}",
+                            headers={"Retry-After": "5"})
+
     try:
         to_number = call_request.to
-        instructions = call_request.instructions or DEFAULT_INSTRUCTIONS
-        voice = call_request.voice or DEFAULT_VOICE
+        from_number = (tenant and tenant.caller_id) or TWILIO_PHONE_NUMBER
+        instructions = call_request.instructions or (tenant and tenant.instructions) or DEFAULT_INSTRUCTIONS
+        voice = call_request.voice or (tenant and tenant.voice) or DEFAULT_VOICE
+        greeting = call_request.greeting or (tenant and tenant.greeting) or DEFAULT_GREETING
 
-        # 初始化 Twilio 客户端
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        client = get_twilio_client(tenant)
 
         # 发起呼叫
-        logger.info(f"📞 发起呼叫: {TWILIO_PHONE_NUMBER} → {to_number}")
+        logger.info(f"📞 发起呼叫: {from_number} → {to_number}" + (f" (租户 {tenant.id})" if tenant else ""))
 
         # URL 编码参数
         from urllib.parse import quote
-        twiml_url = f"{PUBLIC_URL}/twiml?instructions={quote(instructions)}&voice={voice}"
+        twiml_url = f"{PUBLIC_URL}/twiml?voice={voice}"
+        if call_request.template:
+            twiml_url += f"&template={quote(call_request.template)}"
+            if call_request.variables:
+                twiml_url += f"&variables={quote(json.dumps(call_request.variables, ensure_ascii=False))}"
+        else:
+            twiml_url += f"&instructions={quote(instructions)}"
+        if greeting:
+            twiml_url += f"&greeting={quote(greeting)}"
+        if tenant:
+            twiml_url += f"&tenant={quote(tenant.id)}"
+
+        # 同时启用 Twilio 的异步答录机检测，结果回调到 /amd-status 与本地检测合并
+        amd_options = {}
+        if AMD_ENABLED and AMD_TWILIO:
+            amd_options = {
+                "machine_detection": "DetectMessageEnd",
+                "async_amd": "true",
+                "async_amd_status_callback": f"{PUBLIC_URL}/amd-status",
+                "async_amd_status_callback_method": "POST"
+            }
 
         call = client.calls.create(
             to=to_number,
-            from_=TWILIO_PHONE_NUMBER,
+            from_=from_number,
             url=twiml_url,
-            status_callback=f"{PUBLIC_URL}/call-status",
-            status_callback_event=["initiated", "ringing", "answered", "completed"]
+            status_callback=f"{PUBLIC_URL}/call-status" + (f"?tenant={quote(tenant.id)}" if tenant else ""),
+            status_callback_event=["initiated", "ringing", "answered", "completed"],
+            **amd_options
         )
 
         logger.info(f"✅ 呼叫已创建: {call.sid}")
+        # 名额保留到媒体流建立
+        admission.rebind(reservation, call.sid)
+        if tenant:
+            tenant_quotas.rebind(tenant, reservation, call.sid)
+        if call_registry:
+            call_registry.reserve(call.sid)
 
         return CallResponse(
             success=True,
             call_sid=call.sid,
             to=to_number,
-            from_=TWILIO_PHONE_NUMBER,
+            from_=from_number,
             status=call.status
         )
 
     except Exception as e:
+        admission.release(reservation)
+        if tenant:
+            tenant_quotas.release(tenant, reservation)
         logger.error(f"❌ 发起呼叫失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -311,17 +539,27 @@ async def twiml(request: Request):
     TwiML 响应端点
     当呼叫接通后，Twilio 会请求此端点获取指令
     """
-    # 获取 URL 参数
-    params = request.query_params
-    instructions = params.get("instructions", DEFAULT_INSTRUCTIONS)
-    voice = params.get("voice", DEFAULT_VOICE)
-
     # 获取表单数据
     form_data = await request.form()
     call_sid = form_data.get("CallSid")
+    inbound = form_data.get("Direction") == "inbound"
+
+    # 外呼由 /make-call 指定租户，来电按被叫号码确定租户
+    params = request.query_params
+    tenant = tenant_directory.for_number(form_data.get("To")) if inbound else tenant_directory.get(params.get("tenant"))
+    instructions = params.get("instructions", (tenant and tenant.instructions) or DEFAULT_INSTRUCTIONS)
+    voice = params.get("voice", (tenant and tenant.voice) or DEFAULT_VOICE)
+    greeting = params.get("greeting", (tenant and tenant.greeting) or DEFAULT_GREETING)
 
     logger.info(f"[{call_sid}] 📋 生成 TwiML 响应")
 
+    # 本机或租户已满载时拦下来电；外呼已在 /make-call 占用名额，且多 worker 时可能落在其他进程，不在这里拦
+    if inbound:
+        reason = reserve_inbound(call_sid, tenant)
+        if reason:
+            logger.warning(f"[{call_sid}] ⚠️ 容量不足，返回忙音提示 ({reason})")
+            return busy_response()
+
     response = VoiceResponse()
 
     # 使用 <Connect><Stream> 将音频流转发到 WebSocket
@@ -330,7 +568,20 @@ async def twiml(request: Request):
     # 构建 WebSocket URL（使用 wss:// 协议）
     ws_host = PUBLIC_URL.replace("https://", "").replace("http://", "")
     from urllib.parse import quote
-    ws_url = f"wss://{ws_host}/media-stream?call_sid={call_sid}&instructions={quote(instructions)}&voice={voice}"
+    ws_url = f"wss://{ws_host}/media-stream?call_sid={call_sid}&voice={voice}"
+    if params.get("template"):
+        ws_url += f"&template={quote(params['template'])}"
+        if params.get("variables"):
+            ws_url += f"&variables={quote(params['variables'])}"
+    else:
+        ws_url += f"&instructions={quote(instructions)}"
+    if greeting:
+        ws_url += f"&greeting={quote(greeting)}"
+    if tenant:
+        ws_url += f"&tenant={quote(tenant.id)}"
+    # 外呼先做答录机检测，确认是真人再连接 OpenAI
+    if AMD_ENABLED and (form_data.get("Direction") or "").startswith("outbound"):
+        ws_url += "&amd=1"
 
     stream = Stream(url=ws_url)
     connect.append(stream)
@@ -339,84 +590,339 @@ async def twiml(request: Request):
     return Response(content=str(response), media_type="text/xml")
 
 
+@app.post("/voice")
+async def voice(request: Request):
+    """
+    来电 TwiML 端点（在 Twilio 号码的 A call comes in 中配置）
+    按被叫、主叫号码和时间查路由表选择坐席配置，配置内容在建立媒体流时再取
+    """
+    form_data = await request.form()
+    call_sid = form_data.get("CallSid")
+    tenant = tenant_directory.for_number(form_data.get("To"))
+
+    reason = reserve_inbound(call_sid, tenant)
+    if reason:
+        logger.warning(f"[{call_sid}] ⚠️ 容量不足，返回忙音提示 ({reason})")
+        return busy_response()
+
+    name, _ = call_router.route(form_data.get("To"), form_data.get("From"))
+    logger.info(f"[{call_sid}] 🧭 来电 {form_data.get('From')} → {form_data.get('To')} 路由到 {name or '默认配置'}"
+                + (f" (租户 {tenant.id})" if tenant else ""))
+
+    def build(sid: str) -> str:
+        from urllib.parse import quote
+        ws_host = PUBLIC_URL.replace("https://", "").replace("http://", "")
+        ws_url = f"wss://{ws_host}/media-stream?call_sid={sid}"
+        if name:
+            ws_url += f"&profile={quote(name)}"
+        if tenant:
+            ws_url += f"&tenant={quote(tenant.id)}"
+        response = VoiceResponse()
+        connect = Connect()
+        connect.append(Stream(url=ws_url))
+        response.append(connect)
+        return str(response)
+
+    key = f"{name or ''}@{tenant.id}" if tenant else name or ""
+    return Response(content=call_router.twiml(key, call_sid, build), media_type="text/xml")
+
+
 @app.post("/call-status")
-async def call_status(request: Request):
-    """呼叫状态回调"""
+async def call_status(request: Request, tenant: Optional[str] = None):
+    """
+    呼叫状态回调
+    外呼以忙线、无人接听、失败或取消结束时不会建立媒体流，在这里释放拨号阶段占用的名额，
+    不必等 TTL 过期（已建立媒体流的通话名额早已释放，重复释放没有影响）
+    """
     form_data = await request.form()
     call_sid = form_data.get("CallSid")
     call_status = form_data.get("CallStatus")
 
     logger.info(f"[{call_sid}] 📞 呼叫状态: {call_status}")
 
+    if call_sid and call_status in TERMINAL_CALL_STATUSES:
+        tenant_config = tenant_directory.get(tenant)
+        await release_reservation(call_sid, tenant_config)
+        if tenant_config:
+            tenant_quotas.release(tenant_config, call_sid)
+
+    return Response(status_code=200)
+
+
+@app.post("/amd-status")
+async def amd_status(request: Request):
+    """Twilio 异步答录机检测结果回调"""
+    # 先缓存请求体：解析表单后转发给其他 worker 时还要用
+    await request.body()
+    form_data = await request.form()
+    call_sid = form_data.get("CallSid")
+    forwarded = await forward_to_owner(request, call_sid)
+    if forwarded:
+        return forwarded
+
+    session = active_sessions.get(call_sid)
+    bridge = session.get("bridge") if session else None
+    if bridge and bridge.screener:
+        bridge.screener.on_twilio_result(form_data.get("AnsweredBy", "unknown"))
     return Response(status_code=200)
 
 
+@app.post("/calls/{call_sid}/audio")
+async def play_asset(call_sid: str, playback_request: AssetPlaybackRequest, request: Request):
+    """在通话中播放保持音乐、垫话或固定提示音"""
+    check_admin_token(request)
+    forwarded = await forward_to_owner(request, call_sid)
+    if forwarded:
+        return forwarded
+    session = active_sessions.get(call_sid)
+    if not session or "bridge" not in session:
+        raise HTTPException(status_code=404, detail="Call not found")
+    bridge = session["bridge"]
+    if not bridge.start_asset_playback(playback_request.asset, playback_request.loop, playback_request.mode):
+        raise HTTPException(status_code=404, detail=f"Unknown asset: {playback_request.asset}")
+    return {"success": True, "asset": playback_request.asset}
+
+
+@app.delete("/calls/{call_sid}/audio")
+async def stop_asset(call_sid: str, request: Request):
+    """停止通话中正在播放的素材"""
+    check_admin_token(request)
+    forwarded = await forward_to_owner(request, call_sid)
+    if forwarded:
+        return forwarded
+    session = active_sessions.get(call_sid)
+    if not session or "bridge" not in session:
+        raise HTTPException(status_code=404, detail="Call not found")
+    await session["bridge"].stop_asset_playback()
+    return {"success": True}
+
+
+@app.get("/calls/{call_sid}/transcript")
+async def get_transcript(call_sid: str, request: Request):
+    """按 CallSid 查询已持久化的对话记录"""
+    check_admin_token(request)
+    if not transcript_store:
+        raise HTTPException(status_code=404, detail="Transcript persistence is disabled")
+    return {"call_sid": call_sid, "turns": await transcript_store.query(call_sid)}
+
+
+async def drain_and_exit():
+    """
+    排空模式：停止接受新通话并在健康检查中报告未就绪，
+    等待活动通话（以及已拨出尚未接通的外呼）结束后退出进程
+    """
+    admission.draining = True
+    logger.info(f"🚰 进入排空模式，等待 {len(active_sessions)} 通通话结束（最长 {DRAIN_TIMEOUT:.0f} 秒）")
+
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while admission.load and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+
+    if active_sessions:
+        logger.warning(f"⚠️ 排空超时，仍有 {len(active_sessions)} 通通话将被中断")
+    else:
+        logger.info("✅ 所有通话已结束，准备退出")
+    # 交给 uvicorn 按正常流程关闭
+    signal.raise_signal(signal.SIGINT)
+
+
+def start_drain():
+    global drain_task
+    if drain_task is None:
+        drain_task = asyncio.create_task(drain_and_exit())
+
+
+def check_admin_token(request: Request):
+    if ADMIN_TOKEN and request.headers.get("Authorization") != f"Bearer {ADMIN_TOKEN}":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+@app.post("/admin/drain", status_code=202)
+async def admin_drain(request: Request):
+    """进入排空模式，活动通话全部结束后进程退出"""
+    check_admin_token(request)
+    start_drain()
+    return {"draining": True, "active_sessions": len(active_sessions), "timeout": DRAIN_TIMEOUT}
+
+
+@app.get("/admin/drain")
+async def drain_status(request: Request):
+    """查看排空进度"""
+    check_admin_token(request)
+    return {"draining": admission.draining, "active_sessions": len(active_sessions),
+            "pending_dials": len(admission.reservations)}
+
+
+@app.get("/admin/tenants")
+async def tenant_usage(request: Request):
+    """各租户在本进程内的活动通话、拒绝次数和通话时长"""
+    check_admin_token(request)
+    return {"enabled": tenant_directory.enabled, "tenants": len(tenant_directory.tenants),
+            "usage": tenant_quotas.stats(tenant_directory)}
+
+
+@app.get("/admin/prompts")
+async def prompt_cache_report(request: Request):
+    """各提示词模板的缓存命中率（按 response.done 的 usage 统计）"""
+    check_admin_token(request)
+    return {"templates": sorted(prompt_library.templates), "cache": prompt_report.summary()}
+
+
+@app.get("/admin/usage")
+async def usage_report(request: Request):
+    """本进程内所有通话的 token 用量和费用：总计、按租户、当日花费和预算触发次数"""
+    check_admin_token(request)
+    if cost_ledger is None:
+        raise HTTPException(status_code=404, detail="Cost tracking disabled")
+    return cost_ledger.summary()
+
+
+@app.post("/internal/reservations/{call_sid}/release", include_in_schema=False)
+async def release_reservation_internal(call_sid: str, request: Request, tenant: Optional[str] = None):
+    """另一个 worker 接起了本进程占用名额的通话：释放名额，只接受本机控制端口上的请求"""
+    server = request.scope.get("server")
+    if not call_registry or not server or server[1] != call_registry.port:
+        raise HTTPException(status_code=404, detail="Not Found")
+    admission.release(call_sid)
+    tenant_config = tenant_directory.get(tenant)
+    if tenant_config:
+        tenant_quotas.release(tenant_config, call_sid)
+    call_registry.release_reservation(call_sid)
+    logger.info(f"[{call_sid}] 🔓 媒体流由其他 worker 接起，已释放本进程占用的名额")
+    return {"released": True}
+
+
 @app.websocket("/media-stream")
 async def media_stream(websocket: WebSocket):
     """
     WebSocket 端点：接收 Twilio 的媒体流
+    生产环境通过 asgi_app 启动时由原生 ASGI 入口处理，不经过这里
     """
     await websocket.accept()
+    await run_media_stream(FastAPITransport(websocket), websocket.query_params)
 
-    # 获取参数
-    call_sid = websocket.query_params.get("call_sid", "unknown")
-    instructions = websocket.query_params.get("instructions", DEFAULT_INSTRUCTIONS)
-    voice = websocket.query_params.get("voice", DEFAULT_VOICE)
 
-    logger.info(f"[{call_sid}] 🔌 WebSocket 连接已建立")
+# ==================== OpenAI SIP 直连模式 ====================
+
+# 呼叫控制客户端在首次收到来电时创建
+sip_call_control: Optional[RealtimeCallControl] = None
+webhook_deduplicator = WebhookDeduplicator()
+
 
-    # 连接到 OpenAI Realtime API
-    url = f"wss://api.openai.com/v1/realtime?model={OPENAI_MODEL}"
+async def sip_control_session(call_id: str, greeting: Optional[str]):
+    """
+    SIP 直连模式的控制通道
+    媒体由 OpenAI 直接终结，这里只收发控制事件和转录
+    """
+    url = f"{OPENAI_REALTIME_URL}?call_id={call_id}"
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
 
     try:
         async with websockets.connect(url, additional_headers=headers) as openai_ws:
-            logger.info(f"[{call_sid}] ✅ OpenAI WebSocket 已连接")
-
-            # 配置 OpenAI 会话
-            session_config = {
-                "type": "session.update",
-                "session": {
-                    "type": "realtime",
-                    "model": OPENAI_MODEL,
-                    "instructions": instructions,
-                    "input_audio_format": "pcm16",
-                    "output_audio_format": "pcm16",
-                    "voice": voice,
-                    "turn_detection": {
-                        "type": "server_vad",
-                        "threshold": 0.5,
-                        "prefix_padding_ms": 300,
-                        "silence_duration_ms": 500
-                    },
-                    "input_audio_transcription": {
-                        "model": "whisper-1"
-                    }
-                }
-            }
+            logger.info(f"[{call_id}] ✅ SIP 控制通道已连接")
+            active_sessions[call_id]["openai_ws"] = openai_ws
 
-            await openai_ws.send(json.dumps(session_config))
-            logger.info(f"[{call_sid}] ⚙️ 已发送会话配置")
+            if greeting:
+                await openai_ws.send(json.dumps({
+                    "type": "response.create",
+                    "response": {"instructions": greeting}
+                }))
 
-            # 存储会话信息
-            active_sessions[call_sid] = {
-                "openai_ws": openai_ws,
-                "stream_sid": None
-            }
+            async for message in openai_ws:
+                data = json.loads(message)
+                event_type = data.get("type")
 
-            # 创建两个并发任务处理双向音频流
-            await asyncio.gather(
-                forward_twilio_to_openai(websocket, call_sid),
-                forward_openai_to_twilio(websocket, call_sid),
-                return_exceptions=True
-            )
+                if event_type == "response.output_audio_transcript.done":
+                    logger.info(f"[{call_id}] AI 回复: {data.get('transcript', '')}")
+                    if transcript_store:
+                        transcript_store.record(call_id, "assistant", data.get("transcript", ""))
+
+                elif event_type == "conversation.item.input_audio_transcription.completed":
+                    logger.info(f"[{call_id}] 用户说: {data.get('transcript', '')}")
+                    if transcript_store:
+                        transcript_store.record(call_id, "user", data.get("transcript", ""))
 
+                elif event_type == "error":
+                    logger.error(f"[{call_id}] OpenAI 错误: {data.get('error', {})}")
+
+    except websockets.exceptions.ConnectionClosed:
+        logger.info(f"[{call_id}] SIP 控制通道已关闭")
     except Exception as e:
-        logger.error(f"[{call_sid}] ❌ 错误: {e}")
+        logger.error(f"[{call_id}] ❌ SIP 控制通道错误: {e}")
     finally:
-        if call_sid in active_sessions:
-            del active_sessions[call_sid]
-        logger.info(f"[{call_sid}] 🔚 会话已结束")
+        active_sessions.pop(call_id, None)
+        logger.info(f"[{call_id}] 🔚 SIP 会话已结束")
+
+
+@app.post("/openai-webhook")
+async def openai_webhook(request: Request):
+    """
+    OpenAI webhook 端点：处理 realtime.call.incoming 来电事件
+    与 /voice 一样按 SIP To/From 头中的被叫、主叫号码查路由表选择指令、音色和问候语
+    """
+    global sip_call_control
+
+    body = await request.body()
+    if OPENAI_WEBHOOK_SECRET and not verify_webhook(body, request.headers, OPENAI_WEBHOOK_SECRET):
+        logger.warning("⚠️ webhook 签名校验失败")
+        raise HTTPException(status_code=400, detail="Invalid signature")
+
+    # OpenAI 重试投递时 webhook-id 不变
+    webhook_id = request.headers.get("webhook-id")
+    if webhook_deduplicator.seen(webhook_id):
+        return Response(status_code=200)
+
+    event = json.loads(body)
+    if event.get("type") != "realtime.call.incoming":
+        return Response(status_code=200)
+
+    data = event.get("data", {})
+    call_id = data["call_id"]
+    from_header, to_header = sip_header(data, "From"), sip_header(data, "To")
+    name, profile = call_router.route(sip_user(to_header), sip_user(from_header))
+    instructions, voice, greeting = DEFAULT_INSTRUCTIONS, DEFAULT_VOICE, None
+    if profile:
+        instructions = profile.get("instructions", DEFAULT_INSTRUCTIONS)
+        voice = profile.get("voice", DEFAULT_VOICE)
+        greeting = profile.get("greeting")
+        if profile.get("template"):
+            instructions, _ = render_profile_template(call_id, profile, instructions)
+
+    logger.info(f"[{call_id}] 📲 SIP 来电: {from_header} → {to_header} 路由到 {name or '默认配置'}")
+
+    if sip_call_control is None:
+        sip_call_control = RealtimeCallControl(OPENAI_API_KEY, OPENAI_API_BASE)
+
+    # 接听或拒接成功后才记为已处理，失败时 OpenAI 的重试仍会被受理
+    webhook_deduplicator.start(webhook_id)
+    handled = False
+    try:
+        if admission.overload_reason():
+            logger.warning(f"[{call_id}] ⚠️ 容量不足，以 486 拒接 ({admission.overload_reason()})")
+            try:
+                await sip_call_control.reject(call_id, 486)
+                handled = True
+            except Exception as e:
+                logger.error(f"[{call_id}] ❌ 拒接失败: {e}")
+            return Response(status_code=200)
+
+        try:
+            await sip_call_control.accept(call_id, build_accept_config(OPENAI_MODEL, instructions, voice))
+            handled = True
+        except Exception as e:
+            logger.error(f"[{call_id}] ❌ 接听失败: {e}")
+            raise HTTPException(status_code=502, detail=str(e))
+    finally:
+        webhook_deduplicator.finish(webhook_id, handled)
+
+    active_sessions[call_id] = {
+        "mode": "sip",
+        "openai_ws": None,
+        "stream_sid": None
+    }
+    asyncio.create_task(sip_control_session(call_id, greeting))
+
+    return Response(status_code=200)
 
 
 # ==================== 启动事件 ====================
@@ -448,13 +954,45 @@ async def startup_event():
     logger.info(f"🌐 公网地址: {PUBLIC_URL}")
     logger.info("=" * 60)
 
+    if transcript_store:
+        transcript_store.start()
+    admission.start()
+    call_router.start()
+    tenant_directory.start()
+
+    if DRAIN_ON_SIGTERM:
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, start_drain)
+        except (NotImplementedError, RuntimeError):
+            logger.warning("⚠️ 当前平台不支持信号处理，请使用 POST /admin/drain 排空")
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时执行"""
     logger.info("🔚 应用正在关闭...")
-    # 清理所有活动会话
-    active_sessions.clear()
+    # 排空模式下到这里时通常已没有活动通话
+    if active_sessions:
+        logger.warning(f"⚠️ 关闭时仍有 {len(active_sessions)} 通通话，将被中断")
+
+    await admission.stop()
+    await call_router.stop()
+    await tenant_directory.stop()
+
+    if sip_call_control is not None:
+        await sip_call_control.aclose()
+
+    # 写完剩余的转录记录
+    if transcript_store is not None:
+        await transcript_store.close()
+
+    # 等待录音缓冲全部写盘
+    if call_recorder is not None:
+        await asyncio.to_thread(call_recorder.stop)
+
+
+# 原生 ASGI 入口：/media-stream 跳过框架路由，其余请求交给 FastAPI
+asgi_app = media_stream_fast_path(app, run_media_stream)
 
 
 # ==================== 主程序 ====================
@@ -463,7 +1001,7 @@ if __name__ == "__main__":
     import uvicorn
 
     uvicorn.run(
-        "twilio_openai_agent_fastapi:app",
+        "twilio_openai_agent_fastapi:asgi_app",
         host=SERVER_HOST,
         port=SERVER_PORT,
         reload=True,  # 开发模式下自动重载
@@ -5,20 +5,17 @@ Twilio + OpenAI Realtime API 语音代理 (Quart 版本)
 """
 
 import os
-import json
-import base64
-import asyncio
-import audioop
 from typing import Dict
 from quart import Quart, request, Response, websocket
-from twilio.rest import Client
 from twilio.twiml.voice_response import VoiceResponse, Connect, Stream
-import websockets
 from dotenv import load_dotenv
 import logging
 
 load_dotenv()
 
+from call_bridge import BridgeServices, CallBridge
+from asgi_bridge import media_stream_fast_path
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -37,6 +34,7 @@ TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
 # OpenAI 配置
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = "gpt-realtime"
+OPENAI_REALTIME_URL = os.getenv("OPENAI_REALTIME_URL", "wss://api.openai.com/v1/realtime")
 
 # 服务器配置
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
@@ -53,150 +51,50 @@ DEFAULT_VOICE = os.getenv("AI_VOICE", "alloy")
 # 存储活动会话
 active_sessions: Dict[str, dict] = {}
 
+# Twilio REST 客户端：首次外呼时再导入 SDK 并创建，之后复用
+twilio_client = None
 
-class AudioProcessor:
-    """音频格式转换处理器"""
-
-    @staticmethod
-    def mulaw_to_pcm24k(mulaw_data: bytes) -> bytes:
-        """
-        将 μ-law 8kHz 转换为 PCM 24kHz
-        Twilio 使用 μ-law, OpenAI 使用 PCM
-        """
-        try:
-            # μ-law 解码为 PCM 16-bit
-            pcm_8k = audioop.ulaw2lin(mulaw_data, 2)
-            # 重采样 8kHz → 24kHz
-            pcm_24k, _ = audioop.ratecv(pcm_8k, 2, 1, 8000, 24000, None)
-            return pcm_24k
-        except Exception as e:
-            logger.error(f"音频转换错误 (μ-law→PCM): {e}")
-            return b""
-
-    @staticmethod
-    def pcm24k_to_mulaw(pcm_data: bytes) -> bytes:
-        """
-        将 PCM 24kHz 转换为 μ-law 8kHz
-        OpenAI 输出 PCM, Twilio 需要 μ-law
-        """
-        try:
-            # 重采样 24kHz → 8kHz
-            pcm_8k, _ = audioop.ratecv(pcm_data, 2, 1, 24000, 8000, None)
-            # PCM 编码为 μ-law
-            mulaw = audioop.lin2ulaw(pcm_8k, 2)
-            return mulaw
-        except Exception as e:
-            logger.error(f"音频转换错误 (PCM→μ-law): {e}")
-            return b""
-
-
-async def forward_twilio_to_openai(call_sid: str):
-    """转发音频：Twilio → OpenAI"""
-    logger.info(f"[{call_sid}] 开始转发 Twilio → OpenAI")
-    session = active_sessions.get(call_sid)
-
-    if not session:
-        return
-
-    openai_ws = session["openai_ws"]
+# 通话桥接共享的配置（Quart 版本不启用问候缓存、素材和录音）
+bridge_services = BridgeServices(OPENAI_REALTIME_URL, OPENAI_API_KEY, OPENAI_MODEL)
 
-    try:
-        while True:
-            # 从 Twilio WebSocket 接收消息
-            message = await websocket.receive()
-            data = json.loads(message)
-
-            # 保存 stream SID
-            if data.get("event") == "start":
-                stream_sid = data["start"]["streamSid"]
-                session["stream_sid"] = stream_sid
-                logger.info(f"[{call_sid}] 媒体流已启动: {stream_sid}")
-
-            # 处理音频数据
-            elif data.get("event") == "media":
-                payload = data["media"]["payload"]
-                # Twilio 发送的是 base64 编码的 μ-law 音频
-                mulaw_data = base64.b64decode(payload)
-                # 转换为 PCM 24kHz
-                pcm_data = AudioProcessor.mulaw_to_pcm24k(mulaw_data)
-
-                if pcm_data:
-                    # 发送给 OpenAI (base64 编码)
-                    pcm_base64 = base64.b64encode(pcm_data).decode("utf-8")
-                    await openai_ws.send(json.dumps({
-                        "type": "input_audio_buffer.append",
-                        "audio": pcm_base64
-                    }))
-
-            # 呼叫结束
-            elif data.get("event") == "stop":
-                logger.info(f"[{call_sid}] Twilio 媒体流已停止")
-                break
 
-    except Exception as e:
-        logger.error(f"[{call_sid}] Twilio→OpenAI 转发错误: {e}")
+def get_twilio_client():
+    """首次调用时导入 Twilio SDK 并创建客户端"""
+    global twilio_client
+    if twilio_client is None:
+        from twilio.rest import Client
+        twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    return twilio_client
 
 
-async def forward_openai_to_twilio(call_sid: str):
-    """转发音频：OpenAI → Twilio"""
-    logger.info(f"[{call_sid}] 开始转发 OpenAI → Twilio")
-    session = active_sessions.get(call_sid)
+class QuartTransport:
+    """Quart WebSocket 的 CallBridge 传输适配器，Twilio 断开时 Quart 会直接取消处理任务"""
 
-    if not session:
-        return
+    async def receive_text(self):
+        return await websocket.receive()
 
-    openai_ws = session["openai_ws"]
+    async def send_text(self, text: str):
+        await websocket.send(text)
 
-    try:
-        async for message in openai_ws:
-            data = json.loads(message)
-            event_type = data.get("type")
-
-            # 记录重要事件
-            if event_type == "session.created":
-                logger.info(f"[{call_sid}] OpenAI 会话已创建")
-
-            elif event_type == "session.updated":
-                logger.info(f"[{call_sid}] OpenAI 会话已更新")
-
-            elif event_type == "response.audio.delta":
-                # OpenAI 返回的音频增量
-                audio_base64 = data.get("delta")
-
-                if audio_base64 and session:
-                    # 解码 PCM 音频
-                    pcm_data = base64.b64decode(audio_base64)
-                    # 转换为 μ-law 8kHz
-                    mulaw_data = AudioProcessor.pcm24k_to_mulaw(pcm_data)
-
-                    if mulaw_data:
-                        # 发送给 Twilio (base64 编码)
-                        mulaw_base64 = base64.b64encode(mulaw_data).decode("utf-8")
-                        stream_sid = session.get("stream_sid")
-
-                        if stream_sid:
-                            await websocket.send(json.dumps({
-                                "event": "media",
-                                "streamSid": stream_sid,
-                                "media": {
-                                    "payload": mulaw_base64
-                                }
-                            }))
-
-            elif event_type == "response.audio_transcript.done":
-                transcript = data.get("transcript", "")
-                logger.info(f"[{call_sid}] AI 回复: {transcript}")
-
-            elif event_type == "conversation.item.input_audio_transcription.completed":
-                transcript = data.get("transcript", "")
-                logger.info(f"[{call_sid}] 用户说: {transcript}")
-
-            elif event_type == "error":
-                error_msg = data.get("error", {})
-                logger.error(f"[{call_sid}] OpenAI 错误: {error_msg}")
+    async def close(self, code: int = 1000):
+        await websocket.close(code)
 
-    except Exception as e:
-        logger.error(f"[{call_sid}] OpenAI→Twilio 转发错误: {e}")
+
+async def run_media_stream(transport, args):
+    """Quart 路由和原生 ASGI 入口共用的媒体流处理"""
+    call_sid = args.get("call_sid", "unknown")
+    instructions = args.get("instructions", DEFAULT_INSTRUCTIONS)
+    voice = args.get("voice", DEFAULT_VOICE)
+
+    logger.info(f"[{call_sid}] 🔌 WebSocket 连接已建立")
+
+    bridge = CallBridge(call_sid, transport, bridge_services, instructions, voice)
+    active_sessions[call_sid] = bridge.session
+    try:
+        await bridge.run()
+    finally:
+        active_sessions.pop(call_sid, None)
+        logger.info(f"[{call_sid}] 🔚 会话已结束")
 
 
 # ==================== Quart 路由 ====================
@@ -233,8 +131,7 @@ async def make_call():
         instructions = data.get("instructions", DEFAULT_INSTRUCTIONS)
         voice = data.get("voice", DEFAULT_VOICE)
 
-        # 初始化 Twilio 客户端
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        client = get_twilio_client()
 
         # 发起呼叫
         logger.info(f"📞 发起呼叫: {TWILIO_PHONE_NUMBER} → {to_number}")
@@ -315,65 +212,11 @@ async def media_stream():
     """
     WebSocket 端点：接收 Twilio 的媒体流
     """
-    args = request.args
-    call_sid = args.get("call_sid", "unknown")
-    instructions = args.get("instructions", DEFAULT_INSTRUCTIONS)
-    voice = args.get("voice", DEFAULT_VOICE)
+    await run_media_stream(QuartTransport(), websocket.args)
 
-    logger.info(f"[{call_sid}] 🔌 WebSocket 连接已建立")
 
-    # 连接到 OpenAI Realtime API
-    url = f"wss://api.openai.com/v1/realtime?model={OPENAI_MODEL}"
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-    try:
-        async with websockets.connect(url, additional_headers=headers) as openai_ws:
-            logger.info(f"[{call_sid}] ✅ OpenAI WebSocket 已连接")
-
-            # 配置 OpenAI 会话
-            session_config = {
-                "type": "session.update",
-                "session": {
-                    "type": "realtime",
-                    "model": OPENAI_MODEL,
-                    "instructions": instructions,
-                    "input_audio_format": "pcm16",
-                    "output_audio_format": "pcm16",
-                    "voice": voice,
-                    "turn_detection": {
-                        "type": "server_vad",
-                        "threshold": 0.5,
-                        "prefix_padding_ms": 300,
-                        "silence_duration_ms": 500
-                    },
-                    "input_audio_transcription": {
-                        "model": "whisper-1"
-                    }
-                }
-            }
-
-            await openai_ws.send(json.dumps(session_config))
-            logger.info(f"[{call_sid}] ⚙️ 已发送会话配置")
-
-            # 存储会话信息
-            active_sessions[call_sid] = {
-                "openai_ws": openai_ws,
-                "stream_sid": None
-            }
-
-            # 创建两个并发任务处理双向音频流
-            await asyncio.gather(
-                forward_twilio_to_openai(call_sid),
-                forward_openai_to_twilio(call_sid),
-                return_exceptions=True
-            )
-
-    except Exception as e:
-        logger.error(f"[{call_sid}] ❌ 错误: {e}")
-    finally:
-        if call_sid in active_sessions:
-            del active_sessions[call_sid]
-        logger.info(f"[{call_sid}] 🔚 会话已结束")
+# 原生 ASGI 入口：/media-stream 跳过框架路由，其余请求交给 Quart
+asgi_app = media_stream_fast_path(app, run_media_stream)
 
 
 # ==================== 主程序 ====================